@@ -4,15 +4,12 @@
 __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
 import datetime
-import itertools
-import json
 import urlparse
 
 import appengine_config
 
 # need to import modules with model class definitions, e.g. facebook, for
 # template rendering.
-from granary import source as gr_source
 from oauth_dropins import blogger_v2 as oauth_blogger_v2
 from oauth_dropins import facebook as oauth_facebook
 from oauth_dropins import googleplus as oauth_googleplus
@@ -25,7 +22,7 @@ from blogger import Blogger
 from tumblr import Tumblr
 from wordpress_rest import WordPress
 import models
-from models import BlogPost, BlogWebmention, Publish, Response, Source
+from models import BlogPost, BlogWebmention, Publish, Response, ResponseSummary, Source
 import util
 
 import blogger
@@ -37,8 +34,9 @@ import tumblr
 import twitter
 import wordpress_rest
 
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-from google.appengine.ext.ndb.stats import KindStat, KindPropertyNameStat
 import webapp2
 
 canonicalize_domain = webutil_handlers.redirect('brid-gy.appspot.com', 'www.brid.gy')
@@ -69,24 +67,38 @@ class DashboardHandler(webutil_handlers.TemplateHandler, util.Handler):
 
 
 class CachedPageHandler(DashboardHandler):
-  """Handle a page that may be cached with CachedPage."""
+  """Handle a page that may be cached with CachedPage.
+
+  Serves expired pages and re-renders them in a tasks.RefreshCachedPage task,
+  which requests them again with the REFRESH_HEADER set. App Engine strips
+  X-AppEngine-* headers from external requests, so only tasks can set it.
+  """
+  REFRESH_HEADER = 'X-AppEngine-QueueName'
 
   EXPIRES = None  # subclasses can override
+  # query params that are part of the cache key. requests with any other
+  # params aren't cached. subclasses can override.
+  CACHE_PARAMS = ()
 
   @canonicalize_domain
   def get(self, cache=True):
-    # don't cache when running in in dev_appserver or if there are query params
-    if not cache or appengine_config.DEBUG or self.request.params:
+    # don't cache when running in in dev_appserver or if there are other query
+    # params
+    if (not cache or appengine_config.DEBUG or
+        set(self.request.params) - set(self.CACHE_PARAMS)):
       return super(DashboardHandler, self).get()
 
     self.response.headers['Content-Type'] = self.content_type()
-    cached = util.CachedPage.load(self.request.path)
+    path = self.request.path_qs
+    cached = (None if self.REFRESH_HEADER in self.request.headers
+              else util.CachedPage.load(path))
     if cached:
       self.response.write(cached.html)
+      if cached.stale():
+        util.CachedPage.add_refresh_task(path)
     else:
       super(DashboardHandler, self).get()
-      util.CachedPage.store(self.request.path, self.response.body,
-                            expires=self.EXPIRES)
+      util.CachedPage.store(path, self.response.body, expires=self.EXPIRES)
 
 
 class FrontPageHandler(CachedPageHandler):
@@ -98,32 +110,17 @@ class FrontPageHandler(CachedPageHandler):
     return 'templates/index.html'
 
   def template_vars(self):
-    """Use datastore stats to show stats for various things.
-
-    https://developers.google.com/appengine/docs/python/ndb/admin#Statistics_queries
-    """
-    def count(query):
-      stat = query.get()  # no datastore stats in dev_appserver
-      return stat.count if stat else 0
-
-    def kind_count(kind):
-      return count(KindStat.query(KindStat.kind_name == kind))
-
-    num_users = sum(kind_count(cls.__name__) for cls in models.sources.values())
-    link_counts = {
-      property: sum(count(KindPropertyNameStat.query(
-          KindPropertyNameStat.kind_name == kind,
-          KindPropertyNameStat.property_name == property))
-                    for kind in ('BlogPost', 'Response'))
-      for property in ('sent', 'unsent', 'error', 'failed', 'skipped')}
+    """Show stats for various things from the StatCounter shards."""
+    counts = models.StatCounter.totals()
     vars = {
-      'users': num_users,
-      'responses': kind_count('Response'),
-      'links': sum(link_counts.values()),
-      'webmentions': link_counts['sent'] + kind_count('BlogPost'),
-      'publishes': kind_count('Publish'),
-      'blogposts': kind_count('BlogPost'),
-      'webmentions_received': kind_count('BlogWebmention'),
+      'users': counts['users'],
+      'responses': counts['responses'],
+      'links': sum(counts['links_' + state]
+                   for state in models.Webmentions.LINK_STATES),
+      'webmentions': counts['links_sent'] + counts['blogposts'],
+      'publishes': counts['publishes'],
+      'blogposts': counts['blogposts'],
+      'webmentions_received': counts['webmentions_received'],
       }
 
     # add comma separator between thousands
@@ -133,40 +130,36 @@ class FrontPageHandler(CachedPageHandler):
 class UsersHandler(CachedPageHandler):
   """Handler for /users.
 
-  Semi-optimized. Pages by source name. Queries each source type for results
-  with name greater than the start_name query param, then merge sorts the
-  results and truncates at PAGE_SIZE.
-
-  The start_name param is expected to be capitalized because capital letters
-  sort lexicographically before lower case letters. An alternative would be to
-  store a lower cased version of the name in another property and query on that.
+  Pages through SourceListings, which cover all source kinds, in lower cased
+  name order with ndb cursors. Each page is one query plus a get_multi of the
+  sources. Every page is cached, keyed by its cursor query param. Source's put
+  hook invalidates them when a listing changes.
   """
 
   PAGE_SIZE = 100
-
-  @canonicalize_domain
-  def get(self):
-    # only cache the first page
-    return super(UsersHandler, self).get(cache=not self.request.params)
+  CACHE_PARAMS = ('cursor',)
 
   def template_file(self):
     return 'templates/users.html'
 
   def template_vars(self):
-    start_name = self.request.get('start_name')
-    queries = [cls.query(cls.name >= start_name).fetch_async(self.PAGE_SIZE)
-               for cls in models.sources.values()]
-
-    sources = sorted(itertools.chain(*[q.get_result() for q in queries]),
-                     key=lambda s: (s.name.lower(), s.GR_CLASS.NAME))
-    sources = [self.preprocess_source(s) for s in sources
-               if s.name.lower() >= start_name.lower() and s.features
-               ][:self.PAGE_SIZE]
+    cursor = self.request.get('cursor')
+    try:
+      cursor = Cursor(urlsafe=cursor) if cursor else None
+    except datastore_errors.BadValueError:
+      self.abort(400, 'Invalid cursor')
+
+    keys, next_cursor, more = models.SourceListing.query(
+      models.SourceListing.listed == True
+      ).order(models.SourceListing.name_lower
+      ).fetch_page(self.PAGE_SIZE, start_cursor=cursor, keys_only=True)
+    sources = [self.preprocess_source(s) for s in
+               ndb.get_multi([key.parent() for key in keys]) if s]
 
     vars = super(UsersHandler, self).template_vars()
     vars.update({
         'sources': sources,
-        'PAGE_SIZE': self.PAGE_SIZE,
+        'next_cursor': next_cursor.urlsafe() if more and next_cursor else None,
         })
     return vars
 
@@ -178,7 +171,10 @@ class UserHandler(DashboardHandler):
   def get(self, source_short_name, id):
     self.source = models.sources[source_short_name].lookup(id)
     if self.source and self.source.features:
-      self.source.verify()
+      # verifying can fetch the user's web site, so do it in the background
+      # and render from what we have now.
+      if not self.source.verified():
+        util.add_verify_task(self.source)
       self.source = self.preprocess_source(self.source)
     else:
       self.response.status_int = 404
@@ -210,55 +206,42 @@ class UserHandler(DashboardHandler):
       else:
         for domain in self.source.domains:
           if ('.blogspot.' in domain and  # Blogger uses country TLDs
-              not Blogger.query(Blogger.domains == domain).get()):
+              not Blogger.get_by_domain(domain)):
             vars['blogger_promo'] = True
           elif (domain.endswith('tumblr.com') and
-                not Tumblr.query(Tumblr.domains == domain).get()):
+                not Tumblr.get_by_domain(domain)):
             vars['tumblr_promo'] = True
           elif (domain.endswith('wordpress.com') and
-                not WordPress.query(WordPress.domains == domain).get()):
+                not WordPress.get_by_domain(domain)):
             vars['wordpress_promo'] = True
 
     # Responses
     if 'listen' in self.source.features:
-      vars['responses'] = []
-      for i, r in enumerate(Response.query()
-                              .filter(Response.source == self.source.key)\
-                              .order(-Response.updated)):
-        r.response = json.loads(r.response_json)
-        if r.activity_json:  # handle old entities
-          r.activities_json.append(r.activity_json)
-        r.activities = [json.loads(a) for a in r.activities_json]
-
-        if (not gr_source.Source.is_public(r.response) or
-            not all(gr_source.Source.is_public(a) for a in r.activities)):
-          continue
-
-        r.actor = r.response.get('author') or r.response.get('actor', {})
-        if not r.response.get('content'):
-          phrases = {
-            'like': 'liked this',
-            'repost': 'reposted this',
-            'rsvp-yes': 'is attending',
-            'rsvp-no': 'is not attending',
-            'rsvp-maybe': 'might attend',
-            'invite': 'is invited',
-          }
-          r.response['content'] = '%s %s.' % (
-            r.actor.get('displayName') or '',
-            phrases.get(r.type) or phrases.get(r.response.get('verb')))
-
+      summaries = ResponseSummary.query(
+        ResponseSummary.source == self.source.key,
+        ResponseSummary.public == True).order(-ResponseSummary.updated).fetch(10)
+      if not summaries:
+        # responses stored before ResponseSummary existed
+        summaries = []
+        for i, r in enumerate(Response.query()
+                                .filter(Response.source == self.source.key)\
+                                .order(-Response.updated)):
+          summary = ResponseSummary.from_response(r)
+          if summary.public:
+            summaries.append(summary)
+          if len(summaries) >= 10 or i > 200:
+            break
+
+      for r in summaries:
         # convert image URL to https if we're serving over SSL
-        image_url = r.actor.setdefault('image', {}).get('url')
+        image_url = r.actor['image'].get('url')
         if image_url:
           r.actor['image']['url'] = util.update_scheme(image_url, self)
 
         # generate original post links
         r.links = self.process_webmention_links(r)
 
-        vars['responses'].append(r)
-        if len(vars['responses']) >= 10 or i > 200:
-          break
+      vars['responses'] = summaries
 
     # Publishes
     if 'publish' in self.source.features:
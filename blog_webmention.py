@@ -20,6 +20,9 @@ import webapp2
 import webmention
 import wordpress_rest
 
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
 
 def first_value(props, name):
   return next(iter(props.get(name, [])), None)
@@ -27,6 +30,10 @@ def first_value(props, name):
 
 class BlogWebmentionHandler(webmention.WebmentionHandler):
   """Handler for incoming webmentions against blog providers.
+
+  If the request has a Prefer: respond-async header (RFC 7240), only runs the
+  checks that don't fetch anything, stores a new BlogWebmention, returns 202,
+  and processes it in a BlogWebmentionTaskHandler task.
   """
 
   def post(self, source_short_name):
@@ -35,6 +42,53 @@ class BlogWebmentionHandler(webmention.WebmentionHandler):
     self.source_url = urlparse.urldefrag(util.get_required_param(self, 'source'))[0]
     self.target_url = urlparse.urldefrag(util.get_required_param(self, 'target'))[0]
 
+    if 'respond-async' in self.request.headers.get('Prefer', ''):
+      self.enqueue(source_short_name)
+    else:
+      self.process(source_short_name)
+
+  def enqueue(self, source_short_name):
+    """Stores a new BlogWebmention, adds a task to process it, and returns 202.
+
+    The entity's key uses the target URL as given, since we don't follow
+    redirects here. If the task finds that it redirects, it stores the result
+    under the final target URL and deletes this entity.
+
+    If the target's domain doesn't match a source, it may redirect to one, so
+    processes the webmention inline instead.
+    """
+    domain = util.domain_from_link(self.target_url)
+    source_cls = models.sources[source_short_name]
+    self.source = next((s for s in source_cls.get_by_domain(domain.lower())
+                        if 'webmention' in s.features and s.status == 'enabled'),
+                       None) if domain else None
+    if not self.source:
+      return self.process(source_short_name)
+
+    if urlparse.urlparse(self.target_url).path in ('', '/'):
+      return self.error('Home page webmentions are not currently supported.')
+
+    id = u'%s %s' % (self.source_url, self.target_url)
+    self.entity = BlogWebmention.get_or_insert(id, source=self.source.key)
+    if self.entity.status == 'complete':
+      # TODO: response message saying update isn't supported
+      self.response.write(self.entity.published)
+      return
+
+    task = taskqueue.add(queue_name='blog-webmention', params={
+      'source': self.source_url,
+      'target': self.target_url,
+      'source_short_name': source_short_name,
+      'key': self.entity.key.urlsafe(),
+    }, target=taskqueue.DEFAULT_APP_VERSION)
+    logging.info('Added blog-webmention task %s for %s',
+                 task.name, self.entity.key.urlsafe())
+
+    self.response.set_status(202)
+    self.response.write(json.dumps({'status': self.entity.status}))
+
+  def process(self, source_short_name):
+    """Processes the webmention and creates the comment."""
     # follow target url through any redirects, strip utm_* query params
     resp = util.follow_redirects(self.target_url)
     redirected_target_urls = [r.url for r in resp.history]
@@ -48,11 +102,9 @@ class BlogWebmentionHandler(webmention.WebmentionHandler):
     # look up source by domain
     source_cls = models.sources[source_short_name]
     domain = domain.lower()
-    self.source = (source_cls.query()
-                   .filter(source_cls.domains == domain)
-                   .filter(source_cls.features == 'webmention')
-                   .filter(source_cls.status == 'enabled')
-                   .get())
+    self.source = next((s for s in source_cls.get_by_domain(domain)
+                        if 'webmention' in s.features and s.status == 'enabled'),
+                       None)
     if not self.source:
       return self.error(
         'Could not find %s account for %s. Is it registered with Bridgy?' %
@@ -130,6 +182,7 @@ class BlogWebmentionHandler(webmention.WebmentionHandler):
     # write results to datastore
     self.entity.status = 'complete'
     self.entity.put()
+    models.StatCounter.increment('webmentions_received')
     self.response.write(json.dumps(self.entity.published))
 
   def find_mention_item(self, data):
@@ -194,6 +247,43 @@ class BlogWebmentionHandler(webmention.WebmentionHandler):
     return False
 
 
+class BlogWebmentionTaskHandler(BlogWebmentionHandler):
+  """Task handler that processes a webmention queued by enqueue().
+
+  Only returns an error HTTP status for server errors, so that permanent
+  failures aren't retried.
+
+  Request parameters:
+    source: string source URL
+    target: string target URL, as given in the webmention
+    source_short_name: string, e.g. 'tumblr'
+    key: string key of the BlogWebmention stored by enqueue()
+  """
+
+  def post(self):
+    logging.info('Params: %s', self.request.params.items())
+    self.source_url = util.get_required_param(self, 'source')
+    self.target_url = util.get_required_param(self, 'target')
+    queued = ndb.Key(urlsafe=util.get_required_param(self, 'key'))
+
+    # errors before process() stores the final entity should mark this one
+    # failed.
+    self.entity = queued.get()
+    if self.entity and self.entity.status == 'complete':
+      logging.warning('Already processed %s. Dropping task.', queued)
+      return
+
+    self.process(util.get_required_param(self, 'source_short_name'))
+
+    if self.entity and self.entity.key != queued:
+      logging.info('Target redirected. Deleting %s', queued)
+      queued.delete()
+
+  def error(self, error, status=400, **kwargs):
+    super(BlogWebmentionTaskHandler, self).error(error, status=status, **kwargs)
+    if int(status) < 500:
+      self.response.set_status(200)
+
 
 application = webapp2.WSGIApplication([
     ('/webmention/(blogger|fake|tumblr|wordpress)', BlogWebmentionHandler),
@@ -129,16 +129,23 @@ class Blogger(models.Source):
     if client is None:
       client = self.auth_entity.get().api()
 
-    # extract the post's path and look up its post id
+    # extract the post's path and look up its post id. the gdata query is slow,
+    # so we cache the result.
     path = urlparse.urlparse(post_url).path
-    logging.info('Looking up post id for %s', path)
-    feed = client.get_posts(self.key.id(), query=Query(path=path))
 
-    if not feed.entry:
+    def lookup():
+      logging.info('Looking up post id for %s', path)
+      feed = client.get_posts(self.key.id(), query=Query(path=path))
+      if not feed.entry:
+        return None
+      elif len(feed.entry) > 1:
+        logging.warning('Found %d Blogger posts for path %s , expected 1',
+                        len(feed.entry), path)
+      return feed.entry[0].get_post_id()
+
+    post_id = models.CachedPostId.get_or_fetch(self, path, lookup)
+    if not post_id:
       return self.error('Could not find Blogger post %s' % post_url)
-    elif len(feed.entry) > 1:
-      logging.warning('Found %d Blogger posts for path %s , expected 1', path)
-    post_id = feed.entry[0].get_post_id()
 
     # create the comment
     content = u'<a href="%s">%s</a>: %s' % (author_url, author_name, content)
@@ -154,8 +161,10 @@ class Blogger(models.Source):
         # known errors. e.g. https://github.com/snarfed/bridgy/issues/175
         # https://groups.google.com/d/topic/bloggerdev/szGkT5xA9CE/discussion
         return {'error': msg}
-      else:
-        raise
+      elif getattr(e, 'status', None) == 404:
+        # the post may have been deleted. look it up again next time.
+        models.CachedPostId.invalidate(self, path)
+      raise
 
     resp = {'id': comment.get_comment_id(), 'response': comment.to_string()}
     logging.info('Response: %s', resp)
@@ -3,6 +3,7 @@
 
 __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
+import calendar
 import datetime
 import itertools
 import json
@@ -92,11 +93,30 @@ def maybe_update_picture(source, new_actor, handler):
   logging.info('Updating profile picture for %s from %s to %s',
                source.bridgy_url(handler), source.picture, new_pic)
   update()
-  util.CachedPage.invalidate('/users')
+  util.CachedPage.invalidate_prefix('/users')
+
+
+class SeedStatCounters(webapp2.RequestHandler):
+  """Starts the tasks.SeedStatCounters chain.
+
+  Not in cron.yaml. Run once by hand, right after deploying the counters.
+
+  Request parameters:
+    cutoff: integer POSIX timestamp, optional. Entities created after it are
+      already counted by the StatCounter writers. Defaults to now.
+  """
+
+  def get(self):
+    cutoff = self.request.get('cutoff') or calendar.timegm(
+      datetime.datetime.utcnow().utctimetuple())
+    util.add_seed_stat_counters_task({'cutoff': cutoff, 'batch': 0})
+    self.response.write('Seeding counters from entities created before %s' %
+                        cutoff)
 
 
 application = webapp2.WSGIApplication([
     ('/cron/replace_poll_tasks', ReplacePollTasks),
     ('/cron/update_twitter_pictures', UpdateTwitterPictures),
     ('/cron/update_instagram_pictures', UpdateInstagramPictures),
+    ('/cron/seed_stat_counters', SeedStatCounters),
     ], debug=appengine_config.DEBUG)
@@ -30,11 +30,13 @@ import urlparse
 import appengine_config
 
 from granary import facebook as gr_facebook
+from granary import source as gr_source
 from oauth_dropins import facebook as oauth_facebook
 from granary.source import SELF
 import models
 import util
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from google.appengine.ext.webapp import template
 import webapp2
@@ -47,11 +49,20 @@ API_USER_RSVPS_NOT_REPLIED = 'me/events/not_replied'
 # Ideally this fields arg would just be [default fields plus comments], but
 # there's no way to ask for that. :/
 # https://developers.facebook.com/docs/graph-api/using-graph-api/v2.1#fields
-API_EVENT = '%s?fields=comments,description,end_time,id,likes,name,owner,picture,privacy,start_time,timezone,updated_time,venue'
+API_EVENT = '%s?fields=attending_count,comments,declined_count,description,end_time,id,likes,maybe_count,name,noreply_count,owner,picture,privacy,start_time,timezone,updated_time,venue'
 # WARNING: this edge is deprecated in API v2.4 and will stop working in 2017.
 # https://developers.facebook.com/docs/apps/changelog#v2_4_deprecations
 API_EVENT_RSVPS = '%s/invited'
 
+# how long urlopen() keeps responses in memcache for conditional requests
+ETAG_CACHE_TIME = 60 * 60 * 24 * 7  # seconds
+
+# Event fields that we store in the poll's activity cache as a per-event
+# watermark. If none of them have changed since the last poll, the RSVPs
+# haven't either, so we don't re-fetch them.
+EVENT_WATERMARK_FIELDS = ('updated_time', 'attending_count', 'declined_count',
+                          'maybe_count', 'noreply_count')
+
 
 class FacebookPage(models.Source):
   """A facebook profile or page.
@@ -97,9 +108,87 @@ class FacebookPage(models.Source):
     """Returns the Facebook account URL, e.g. https://facebook.com/foo."""
     return self.gr_source.user_url(self.username or self.key.id())
 
-  def get_data(self, url):
-    """Simple wrapper around gr_source.urlopen() that returns 'data' list."""
-    return self.gr_source.urlopen(url).get('data', [])
+  def get_data(self, url, cache=None):
+    """Simple wrapper around urlopen() that returns 'data' list."""
+    return self.urlopen(url, cache=cache).get('data', [])
+
+  def urlopen(self, url, cache=None):
+    """Wraps gr_source.urlopen() and uses ETags for conditional requests.
+
+    If cache is provided, stores the response's ETag in it, and the parsed
+    response in memcache for up to ETAG_CACHE_TIME. The next call for the same
+    URL sends If-None-Match, and if the API returns 304 Not Modified, we use the
+    memcached response instead of downloading and parsing it again. If the
+    memcached response has expired or been evicted, we drop the ETag and don't
+    send If-None-Match. ETags for URLs we stop fetching age out of the poll
+    activity cache along with its other entries.
+
+    Args:
+      url: string, relative API URL
+      cache: dict-like poll activity cache, optional
+
+    Returns: decoded JSON response
+    """
+    if cache is None:
+      return self.gr_source.urlopen(url)
+
+    etag_key = 'FETAG ' + url
+    data_key = 'FEDATA %s %s' % (self.key.id(), url)
+    etag = cache.get(etag_key)
+    cached = memcache.get(data_key) if etag else None
+
+    headers = {}
+    if cached and cached.get('etag') == etag:
+      headers['If-None-Match'] = etag
+    elif etag:
+      del cache[etag_key]
+
+    try:
+      resp = self.gr_source.urlopen(url, parse_response=False, headers=headers)
+    except urllib2.HTTPError as e:
+      if e.code == 304 and headers:
+        logging.debug('%s not modified, using cached response', url)
+        return cached['data']
+      raise
+
+    data = json.loads(resp.read())
+    etag = resp.info().get('ETag')
+    if etag:
+      try:
+        memcache.set(data_key, {'etag': etag, 'data': data},
+                     time=ETAG_CACHE_TIME)
+        cache[etag_key] = etag
+        return data
+      except ValueError:
+        logging.info("Couldn't cache %s, probably too big", data_key,
+                     exc_info=True)
+
+    if etag_key in cache:
+      del cache[etag_key]
+    return data
+
+  def get_data_pages(self, url, cache=None):
+    """Generator that fetches a paginated API edge one page at a time.
+
+    Follows the 'after' cursor in each response's 'paging' field. Yields each
+    page's 'data' list, so callers can process and discard pages as they go
+    instead of holding the whole edge in memory. Each page is fetched with
+    urlopen(), so it uses ETags if cache is provided.
+
+    https://developers.facebook.com/docs/graph-api/using-graph-api/v2.2#paging
+
+    Args:
+      url: string, relative API URL
+      cache: dict-like poll activity cache, optional
+    """
+    next_url = url
+    while next_url:
+      resp = self.urlopen(next_url, cache=cache)
+      yield resp.get('data', [])
+      paging = resp.get('paging', {})
+      after = paging.get('cursors', {}).get('after')
+      next_url = (util.add_query_params(url, {'after': after})
+                  if paging.get('next') and after else None)
 
   def get_activities_response(self, **kwargs):
     # TODO: use batch API to get photos, events, etc in one request
@@ -115,26 +204,31 @@ class FacebookPage(models.Source):
       # multiple photos into albums, and the album post object won't have the
       # post content, comments, etc. from the individual photo posts.
       # http://stackoverflow.com/questions/12785120
-      #
-      # TODO: save and use ETag for all of these extra calls
-      photos = self.get_data(API_PHOTOS)
+      cache = kwargs.get('cache')
+      photos = self.get_data(API_PHOTOS, cache=cache)
 
       # also get events and RSVPs
       # https://developers.facebook.com/docs/graph-api/reference/user/events/
       # https://developers.facebook.com/docs/graph-api/reference/event#edges
       # TODO: also fetch and use API_USER_RSVPS_DECLINED
-      user_rsvps = self.get_data(API_USER_RSVPS)
+      user_rsvps = self.get_data(API_USER_RSVPS, cache=cache)
 
       # have to re-fetch the events because the user rsvps response doesn't
       # include the event description, which we need for original post links.
-      events = [self.gr_source.urlopen(API_EVENT % r['id'])
+      if cache is not None:
+        # look up all of the events' cache entries at once
+        ids = [r['id'] for r in user_rsvps if r.get('id')]
+        cache.get_multi(['FETAG ' + API_EVENT % id for id in ids] +
+                        ['FETAG ' + API_EVENT_RSVPS % id for id in ids] +
+                        ['FER ' + id for id in ids])
+      events = [self.urlopen(API_EVENT % r['id'], cache=cache)
                 for r in user_rsvps if r.get('id')]
 
       # also, only process events that the user is the owner of. avoids (but
       # doesn't prevent) processing big non-indieweb events with tons of
       # attendees that put us over app engine's instance memory limit. details:
       # https://github.com/snarfed/bridgy/issues/77
-      events_and_rsvps = [(e, self.get_data(API_EVENT_RSVPS % e['id']))
+      event_activities = [self.event_to_activity(e, cache=cache)
                           for e in events
                           if e.get('owner', {}).get('id') == self.key.id()]
 
@@ -184,11 +278,45 @@ class FacebookPage(models.Source):
         activities.append(photo_activity)
 
     # add events
-    activities += [self.gr_source.event_to_activity(e, rsvps=r)
-                   for e, r in events_and_rsvps]
+    activities += event_activities
 
     return util.trim_nulls(resp)
 
+  def event_to_activity(self, event, cache=None):
+    """Converts an event to an activity and adds its RSVPs.
+
+    If cache is provided, it's checked for a watermark of the event's
+    EVENT_WATERMARK_FIELDS from the last poll. If they haven't changed, we
+    don't fetch the RSVPs at all. Otherwise, we fetch and convert them one page
+    at a time and store the new watermark.
+
+    Args:
+      event: Facebook event dict, from API_EVENT
+      cache: dict-like poll activity cache, optional
+
+    Returns: ActivityStreams activity dict
+    """
+    activity = self.gr_source.event_to_activity(event)
+    id = event.get('id')
+    if not id:
+      return activity
+
+    cache_key = 'FER ' + id
+    watermark = [event.get(field) for field in EVENT_WATERMARK_FIELDS]
+    if (cache is not None and watermark[0] and
+        cache.get(cache_key) == watermark):
+      logging.info("Event %s hasn't changed since last poll, skipping RSVPs", id)
+      return activity
+
+    obj = activity.setdefault('object', {})
+    for rsvps in self.get_data_pages(API_EVENT_RSVPS % id, cache=cache):
+      gr_source.Source.add_rsvps_to_event(
+        obj, [self.gr_source.rsvp_to_object(r, event=event) for r in rsvps])
+
+    if cache is not None:
+      cache[cache_key] = watermark
+    return activity
+
   def canonicalize_syndication_url(self, url):
     """Facebook-specific standardization of syndicated urls. Canonical form is
     https://www.facebook.com/0123456789
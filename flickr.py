@@ -12,11 +12,14 @@ import util
 import webapp2
 
 from granary import flickr as gr_flickr
-from granary.source import SELF
 from oauth_dropins import flickr as oauth_flickr
 
 from google.appengine.ext import ndb
 
+# the extras that granary requests, plus the response counts
+API_EXTRAS = ('date_upload,date_taken,views,media,description,tags,'
+              'machine_tags,geo,path_alias,count_comments,count_faves')
+
 
 class Flickr(models.Source):
   """A flickr account.
@@ -29,6 +32,9 @@ class Flickr(models.Source):
 
   GR_CLASS = gr_flickr.Flickr
   SHORT_NAME = 'flickr'
+  RESPONSE_ID_FORMATS = {
+    'like': '%(post)s_favorited_by_%(user)s',
+  }
 
   # unique name optionally used in URLs instead of nsid (e.g.,
   # flickr.com/photos/username)
@@ -64,8 +70,50 @@ class Flickr(models.Source):
     photos."""
     if 'min_id' in kwargs:
       del kwargs['min_id']
-    return self.gr_source.get_activities_response(
-      *args, group_id=SELF, **kwargs)
+    return super(Flickr, self).get_activities_response(*args, **kwargs)
+
+  def get_activities_with_watermarks(self, cache, count=None,
+                                     fetch_replies=False, fetch_likes=False):
+    """Fetches recent photos along with their comment and favorite counts.
+
+    Uses a single flickr.people.getPhotos call with the count_comments and
+    count_faves extras, then only fetches comments and favorites for photos
+    whose counts have changed.
+    """
+    gr = self.gr_source
+    resp = gr.call_api_method('flickr.people.getPhotos', {
+      'user_id': 'me',
+      'extras': API_EXTRAS,
+      'per_page': count or 50,
+    })
+
+    photos = resp.get('photos', {}).get('photo', [])
+    # look up all of the photos' watermarks at once
+    cache.get_multi('AW ' + p['id'] for p in photos if p.get('id'))
+
+    activities = []
+    for photo in photos:
+      activity = gr.photo_to_activity(photo)
+      activities.append(activity)
+      id = photo.get('id')
+      watermark = [photo.get('count_comments'), photo.get('count_faves')]
+      if not id or not self.watermark_changed(cache, id, watermark):
+        continue
+
+      logging.debug('Counts changed for %s, fetching comments and faves', id)
+      obj = activity.setdefault('object', {})
+      if fetch_replies:
+        comments = gr.call_api_method('flickr.photos.comments.getList', {
+          'photo_id': id}).get('comments', {}).get('comment', [])
+        replies = [gr.comment_to_object(c, id) for c in comments]
+        obj['replies'] = {'items': replies, 'totalItems': len(replies)}
+      if fetch_likes:
+        faves = gr.call_api_method('flickr.photos.getFavorites', {
+          'photo_id': id}).get('photo', {}).get('person', [])
+        obj.setdefault('tags', []).extend(
+          gr.like_to_object(person, activity) for person in faves)
+
+    return util.trim_nulls({'items': activities})
 
   def canonicalize_syndication_url(self, url):
     if not url.endswith('/'):
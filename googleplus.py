@@ -35,6 +35,10 @@ class GooglePlusPage(models.Source):
   # API quotas are refilled daily. Use 30h to make sure we're over a day even
   # after the randomized task ETA.
   RATE_LIMITED_POLL = datetime.timedelta(hours=30)
+  RESPONSE_ID_FORMATS = {
+    'like': '%(post)s_plusoned_by_%(user)s',
+    'repost': '%(post)s_reshared_by_%(user)s',
+  }
 
   type = ndb.StringProperty(choices=('user', 'page'))
 
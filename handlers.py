@@ -19,10 +19,12 @@ URL paths are:
 """
 
 import copy
+import hashlib
 import json
 import logging
 import re
 import string
+import urllib
 
 import appengine_config
 
@@ -68,14 +70,173 @@ $body
 </html>
 """)
 
+CONTENT_TYPES = {
+  'html': 'text/html; charset=utf-8',
+  'json': 'application/json; charset=utf-8',
+}
+
+
+def add_original_post_urls(source, post, obj, prop):
+  """Extracts original post URLs and adds them to an object, in place.
+
+  If the post object has upstreamDuplicates, *only* they are considered
+  original post URLs and added as tags with objectType 'article', and the
+  post's own links and 'article' tags are added with objectType 'mention'.
+
+  Args:
+    source: models.Source subclass
+    post: ActivityStreams post object to get original post URLs from
+    obj: ActivityStreams post object to add original post URLs to
+    prop: string property name in obj to add the original post URLs to
+  """
+  original_post_discovery.discover(source, post, fetch_hfeed=False)
+  tags = [tag for tag in post['object'].get('tags', [])
+          if 'url' in tag and tag['objectType'] == 'article']
+  upstreams = post['object'].get('upstreamDuplicates', [])
+
+  if not isinstance(obj.setdefault(prop, []), list):
+    obj[prop] = [obj[prop]]
+  if upstreams:
+    obj[prop] += [{'url': url, 'objectType': 'article'} for url in upstreams]
+    obj.setdefault('tags', []).extend(
+      [{'url': tag.get('url'), 'objectType': 'mention'} for tag in tags])
+  else:
+    obj[prop] += tags
+
+  # check for redirects, and if there are any follow them and add final urls
+  # in addition to the initial urls.
+  seen = set()
+  to_resolve = []  # (url list, url object) tuples
+  tags = obj.get('tags', [])
+  for url_list in obj[prop], tags:
+    for url_obj in url_list:
+      url = util.clean_webmention_url(url_obj.get('url', ''))
+      if not url or url in seen:
+        continue
+      seen.add(url)
+      # when debugging locally, replace my (snarfed.org) URLs with localhost
+      url_obj['url'] = util.replace_test_domains_with_localhost(url)
+      to_resolve.append((url_list, url_obj))
+
+  # resolve them all at once so that latency doesn't grow with the number of
+  # links. URLs that don't resolve before the deadline are left as is.
+  targets = util.resolve_webmention_targets(
+    [url_obj['url'] for _, url_obj in to_resolve])
+  for url_list, url_obj in to_resolve:
+    url = url_obj['url']
+    if url not in targets:
+      continue
+    resolved, _, send = targets[url]
+    if send and resolved != url and resolved not in seen:
+      seen.add(resolved)
+      url_list.append({'url': resolved, 'objectType': url_obj.get('objectType')})
+
+  # if the http version of a link is in upstreams but the https one is just a
+  # mention, or vice versa, promote them both to upstream.
+  # https://github.com/snarfed/bridgy/issues/290
+  #
+  # TODO: for links that came from resolving redirects above, this doesn't
+  # also catch the initial pre-redirect link. ah well.
+  prop_schemeful = set(tag['url'] for tag in obj[prop] if tag.get('url'))
+  prop_schemeless = set(util.schemeless(url) for url in prop_schemeful)
+
+  for url_obj in copy.copy(tags):
+    url = url_obj.get('url', '')
+    schemeless = util.schemeless(url)
+    if schemeless in prop_schemeless and url not in prop_schemeful:
+      obj[prop].append(url_obj)
+      tags.remove(url_obj)
+      prop_schemeful.add(url)
+
+  logging.info('After original post discovery, urls are: %s', seen)
+
+
+def render(source, obj, format, handler):
+  """Renders an ActivityStreams object as an mf2 HTML or JSON page.
+
+  Args:
+    source: models.Source subclass
+    obj: ActivityStreams object dict. Modified in place.
+    format: string, 'html' or 'json'
+    handler: webapp2.RequestHandler, used for the request's URL scheme
+
+  Returns: string page body
+  """
+  # use https for profile pictures so we don't cause SSL mixed mode errors
+  # when serving over https.
+  author = obj.get('author', {})
+  image = author.get('image', {})
+  url = image.get('url')
+  if url:
+    image['url'] = util.update_scheme(url, handler)
+
+  mf2_json = microformats2.object_to_json(obj)
+
+  # try to include the author's silo profile url
+  author = first_props(mf2_json.get('properties', {})).get('author', {})
+  author_uid = first_props(author.get('properties', {})).get('uid', '')
+  if author_uid:
+    parsed = util.parse_tag_uri(author_uid)
+    if parsed:
+      silo_url = source.gr_source.user_url(parsed[1])
+      urls = author.get('properties', {}).setdefault('url', [])
+      if silo_url not in microformats2.get_string_urls(urls):
+        urls.append(silo_url)
+
+  if format == 'html':
+    return TEMPLATE.substitute({
+      'url': obj.get('url', ''),
+      'body': microformats2.json_to_html(mf2_json),
+      'title': obj.get('title', obj.get('content', 'Bridgy Response')),
+    })
+  elif format == 'json':
+    return json.dumps(mf2_json, indent=2)
+
+
+def prerender(source, response, activities):
+  """Renders a response's pages ahead of time and stores them in the response.
+
+  Called by tasks.Poll after it stores new and changed responses, so that
+  ItemHandler can serve them without calling the silo. Renders for https.
+
+  Args:
+    source: models.Source subclass
+    response: models.Response. response.rendered is populated in place.
+    activities: list of full ActivityStreams activity dicts that the response
+      is on
+  """
+  handler = webapp2.RequestHandler(
+    request=webapp2.Request.blank('/', base_url='https://brid-gy.appspot.com'))
+  prop = 'object' if response.type in ('like', 'repost') else 'inReplyTo'
+
+  rendered = {}
+  for activity in activities:
+    if not activity.get('object'):
+      continue
+    parsed = util.parse_tag_uri(activity.get('id', ''))
+    post_id = parsed[1] if parsed else activity.get('id')
+    obj = json.loads(response.response_json)
+    add_original_post_urls(source, copy.deepcopy(activity), obj, prop)
+    rendered[post_id] = {format: render(source, copy.deepcopy(obj), format, handler)
+                         for format in CONTENT_TYPES}
+
+  response.rendered = rendered
+
+
 class ItemHandler(webapp2.RequestHandler):
   """Fetches a post, repost, like, or comment and serves it as mf2 HTML or JSON.
   """
   handle_exception = handlers.handle_exception
   source = None
+  # the stored models.Response for the item, if any. set by get().
+  stored_response = None
 
   VALID_ID = re.compile(r'^[\w.+:@-]+$')
 
+  # seconds to cache rendered pages in memcache. response pages are invalidated
+  # when their Response changes.
+  CACHE_TIME = 60 * 60 * 24
+
   def head(self, *args):
     """Return an empty 200 with no caching directives."""
 
@@ -92,15 +253,22 @@ class ItemHandler(webapp2.RequestHandler):
     """
     raise NotImplementedError()
 
-  def get_post(self, post_id, source_fn=None):
+  def get_post(self, post_id, source_fn=None, response=None):
     """Utility method fetches the original post
     Args:
       post_id: string, site-specific post id
       source_fn: optional reference to a Source method,
         defaults to Source.get_post.
+      response: optional stored models.Response for the item. If it has the
+        post, we use that instead of fetching it from the silo.
 
     Returns: ActivityStreams object dict
     """
+    if response:
+      post = self.get_stored_post(post_id, response)
+      if post:
+        return post
+
     try:
       post = (source_fn or self.source.get_post)(post_id)
       if not post:
@@ -112,6 +280,42 @@ class ItemHandler(webapp2.RequestHandler):
         logging.warning(
           'Error fetching source post %s', post_id, exc_info=True)
 
+  def get_stored_post(self, post_id, response):
+    """Returns a post from a stored Response's activities_json, or None.
+
+    The stored activities are pruned, so we fill in the object's id, url, and
+    content from the activity. util.prune_activity() keeps the article tags
+    and upstreamDuplicates that original post discovery found when we polled,
+    which add_original_post_urls() uses like it does for silo posts.
+
+    Responses stored before we kept those don't have them, so if the response
+    has webmention targets but its activity has no original post URLs, returns
+    None so that the caller fetches the post from the silo instead.
+
+    Args:
+      post_id: string, site-specific post id
+      response: models.Response
+
+    Returns: ActivityStreams activity dict, or None
+    """
+    activities = [json.loads(a) for a in response.activities_json]
+    for activity in activities:
+      obj = activity.setdefault('object', {})
+      for field in 'id', 'url', 'content':
+        if obj.get(field) is None:
+          obj[field] = activity.get(field)
+
+      parsed = util.parse_tag_uri(obj.get('id') or '')
+      if len(activities) > 1 and (not parsed or parsed[1] != post_id):
+        continue
+
+      targets = (response.sent + response.unsent + response.error +
+                 response.failed + response.skipped)
+      if targets and not (obj.get('tags') or obj.get('upstreamDuplicates')):
+        logging.info('Stored post %s has no original post URLs', post_id)
+        return None
+      return activity
+
   def get(self, type, source_short_name, string_id, *ids):
     source_cls = models.sources.get(source_short_name)
     if not source_cls:
@@ -130,6 +334,29 @@ class ItemHandler(webapp2.RequestHandler):
       if not self.VALID_ID.match(id):
         self.abort(404, 'Invalid id %s' % id)
 
+    # serve from the rendered page cache if we can
+    path = urllib.unquote(self.request.path)
+    # rendered pages depend on scheme, since we update image URLs to match it
+    cache_field = '%s %s' % (format, self.request.scheme)
+    cached = util.item_page_cache.get(path) or {}
+    if cache_field in cached:
+      logging.info('Serving %s from cache', path)
+      self.write_response(*cached[cache_field])
+      return
+
+    if type != 'post':
+      self.stored_response = self.source.get_stored_response(type, *ids)
+
+    # use the page that tasks.Poll pre-rendered, if any. they're rendered for
+    # https, so only use them for https requests.
+    if self.stored_response and self.request.scheme == 'https':
+      prerendered = (self.stored_response.rendered or {}).get(ids[0], {})
+      if format in prerendered:
+        logging.info('Serving pre-rendered %s', path)
+        self.cache_and_write(path, cached, cache_field, format,
+                             prerendered[format])
+        return
+
     label = '%s:%s %s %s' % (source_short_name, string_id, type, ids)
     logging.info('Fetching %s', label)
     try:
@@ -148,104 +375,59 @@ class ItemHandler(webapp2.RequestHandler):
     if not obj:
       self.abort(404, label)
 
-    # use https for profile pictures so we don't cause SSL mixed mode errors
-    # when serving over https.
-    author = obj.get('author', {})
-    image = author.get('image', {})
-    url = image.get('url')
-    if url:
-      image['url'] = util.update_scheme(url, self)
-
-    mf2_json = microformats2.object_to_json(obj)
-
-    # try to include the author's silo profile url
-    author = first_props(mf2_json.get('properties', {})).get('author', {})
-    author_uid = first_props(author.get('properties', {})).get('uid', '')
-    if author_uid:
-      parsed = util.parse_tag_uri(author_uid)
-      if parsed:
-        silo_url = self.source.gr_source.user_url(parsed[1])
-        urls = author.get('properties', {}).setdefault('url', [])
-        if silo_url not in microformats2.get_string_urls(urls):
-          urls.append(silo_url)
-
-    # write the response!
-    self.response.headers['Access-Control-Allow-Origin'] = '*'
-    if format == 'html':
-      self.response.headers['Content-Type'] = 'text/html; charset=utf-8'
-      self.response.out.write(TEMPLATE.substitute({
-            'url': obj.get('url', ''),
-            'body': microformats2.json_to_html(mf2_json),
-            'title': obj.get('title', obj.get('content', 'Bridgy Response')),
-            }))
-    elif format == 'json':
-      self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
-      self.response.out.write(json.dumps(mf2_json, indent=2))
-
-  def add_original_post_urls(self, post, obj, prop):
-    """Extracts original post URLs and adds them to an object, in place.
-
-    If the post object has upstreamDuplicates, *only* they are considered
-    original post URLs and added as tags with objectType 'article', and the
-    post's own links and 'article' tags are added with objectType 'mention'.
+    self.cache_and_write(path, cached, cache_field, format,
+                         render(self.source, obj, format, self))
+
+  def cache_and_write(self, path, cached, cache_field, format, body):
+    """Stores a rendered page in the page cache and writes it to the response.
+
+    Args:
+      path: string, page cache key
+      cached: dict, existing page cache value for path
+      cache_field: string, format and scheme
+      format: string, 'html' or 'json'
+      body: string, rendered page
+    """
+    content_type = CONTENT_TYPES[format]
+    if isinstance(body, unicode):
+      body = body.encode('utf-8')
+    etag = hashlib.sha1(body).hexdigest()
+    last_modified = (self.stored_response.updated if self.stored_response
+                     else None)
+    rendered = (content_type, body, etag, last_modified)
+    cached[cache_field] = rendered
+    util.item_page_cache.set(path, cached, memcache_ttl=self.CACHE_TIME)
+    self.write_response(*rendered)
+
+  def write_response(self, content_type, body, etag=None, last_modified=None):
+    """Writes a rendered page to the response.
+
+    If the request's If-None-Match header matches etag, writes an empty 304
+    instead.
 
     Args:
-      post: ActivityStreams post object to get original post URLs from
-      obj: ActivityStreams post object to add original post URLs to
-      prop: string property name in obj to add the original post URLs to
+      content_type: string
+      body: string
+      etag: string, strong ETag for body, without quotes
+      last_modified: datetime, when the underlying Response was last updated
     """
-    original_post_discovery.discover(self.source, post, fetch_hfeed=False)
-    tags = [tag for tag in post['object'].get('tags', [])
-            if 'url' in tag and tag['objectType'] == 'article']
-    upstreams = post['object'].get('upstreamDuplicates', [])
-
-    if not isinstance(obj.setdefault(prop, []), list):
-      obj[prop] = [obj[prop]]
-    if upstreams:
-      obj[prop] += [{'url': url, 'objectType': 'article'} for url in upstreams]
-      obj.setdefault('tags', []).extend(
-        [{'url': tag.get('url'), 'objectType': 'mention'} for tag in tags])
-    else:
-      obj[prop] += tags
-
-    # check for redirects, and if there are any follow them and add final urls
-    # in addition to the initial urls.
-    seen = set()
-    tags = obj.get('tags', [])
-    for url_list in obj[prop], tags:
-      for url_obj in url_list:
-        url = util.clean_webmention_url(url_obj.get('url', ''))
-        if not url or url in seen:
-          continue
-        seen.add(url)
-        # when debugging locally, replace my (snarfed.org) URLs with localhost
-        url_obj['url'] = url = util.replace_test_domains_with_localhost(url)
-        resolved, _, send = util.get_webmention_target(url)
-        if send and resolved != url and resolved not in seen:
-          seen.add(resolved)
-          url_list.append({'url': resolved, 'objectType': url_obj.get('objectType')})
-
-    # if the http version of a link is in upstreams but the https one is just a
-    # mention, or vice versa, promote them both to upstream.
-    # https://github.com/snarfed/bridgy/issues/290
-    #
-    # TODO: for links that came from resolving redirects above, this doesn't
-    # also catch the initial pre-redirect link. ah well.
-    prop_schemeful = set(tag['url'] for tag in obj[prop] if tag.get('url'))
-    prop_schemeless = set(util.schemeless(url) for url in prop_schemeful)
-
-    for url_obj in copy.copy(tags):
-      url = url_obj.get('url', '')
-      schemeless = util.schemeless(url)
-      if schemeless in prop_schemeless and url not in prop_schemeful:
-        obj[prop].append(url_obj)
-        tags.remove(url_obj)
-        prop_schemeful.add(url)
-
-    logging.info('After original post discovery, urls are: %s', seen)
+    self.response.headers['Access-Control-Allow-Origin'] = '*'
+    if etag:
+      self.response.etag = etag
+    if last_modified:
+      self.response.last_modified = last_modified
 
+    if etag and etag in self.request.if_none_match:
+      self.response.status_int = 304
+      return
+
+    self.response.headers['Content-Type'] = content_type
+    self.response.out.write(body)
 
 class PostHandler(ItemHandler):
+  # nothing invalidates post pages, so only cache them briefly
+  CACHE_TIME = 60 * 10
+
   def get_item(self, id):
     activity = self.source.get_post(id)
     return activity['object'] if activity else None
@@ -257,9 +439,9 @@ class CommentHandler(ItemHandler):
                                   activity_author_id=self.source.key.id())
     if not cmt:
       return None
-    post = self.get_post(post_id)
+    post = self.get_post(post_id, response=self.stored_response)
     if post:
-      self.add_original_post_urls(post, cmt, 'inReplyTo')
+      add_original_post_urls(self.source, post, cmt, 'inReplyTo')
     return cmt
 
 
@@ -268,9 +450,9 @@ class LikeHandler(ItemHandler):
     like = self.source.get_like(self.source.key.string_id(), post_id, user_id)
     if not like:
       return None
-    post = self.get_post(post_id)
+    post = self.get_post(post_id, response=self.stored_response)
     if post:
-      self.add_original_post_urls(post, like, 'object')
+      add_original_post_urls(self.source, post, like, 'object')
     return like
 
 
@@ -279,9 +461,9 @@ class RepostHandler(ItemHandler):
     repost = self.source.get_share(self.source.key.string_id(), post_id, share_id)
     if not repost:
       return None
-    post = self.get_post(post_id)
+    post = self.get_post(post_id, response=self.stored_response)
     if post:
-      self.add_original_post_urls(post, repost, 'object')
+      add_original_post_urls(self.source, post, repost, 'object')
     return repost
 
 
@@ -290,9 +472,10 @@ class RsvpHandler(ItemHandler):
     rsvp = self.source.get_rsvp(self.source.key.string_id(), event_id, user_id)
     if not rsvp:
       return None
-    event = self.get_post(event_id, source_fn=self.source.get_event)
+    event = self.get_post(event_id, source_fn=self.source.get_event,
+                          response=self.stored_response)
     if event:
-      self.add_original_post_urls(event, rsvp, 'inReplyTo')
+      add_original_post_urls(self.source, event, rsvp, 'inReplyTo')
     return rsvp
 
 
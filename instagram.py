@@ -19,17 +19,22 @@ Example comment ID and links
 __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
 import json
+import logging
 
 import appengine_config
 
 from granary import instagram as gr_instagram
 from oauth_dropins import instagram as oauth_instagram
-from granary.source import SELF
 import models
 import util
 
 import webapp2
 
+API_RECENT_MEDIA_URL = \
+  'https://api.instagram.com/v1/users/self/media/recent?count=%d'
+API_MEDIA_COMMENTS_URL = 'https://api.instagram.com/v1/media/%s/comments'
+API_MEDIA_LIKES_URL = 'https://api.instagram.com/v1/media/%s/likes'
+
 
 class Instagram(models.Source):
   """A instagram account.
@@ -65,7 +70,36 @@ class Instagram(models.Source):
     """Discard min_id because we still want new comments/likes on old photos."""
     if 'min_id' in kwargs:
       del kwargs['min_id']
-    return self.gr_source.get_activities_response(*args, group_id=SELF, **kwargs)
+    return super(Instagram, self).get_activities_response(*args, **kwargs)
+
+  def get_activities_with_watermarks(self, cache, count=None,
+                                     fetch_replies=False, fetch_likes=False):
+    """Fetches recent media, which includes comment and like counts.
+
+    Only fetches the full comment and like lists for media whose counts have
+    changed.
+    """
+    gr = self.gr_source
+    medias = gr.urlopen(API_RECENT_MEDIA_URL % (count or 20)) or []
+    # look up all of the media's watermarks at once
+    cache.get_multi('AW ' + m['id'] for m in medias if m.get('id'))
+
+    activities = []
+    for media in medias:
+      id = media.get('id')
+      watermark = [media.get('comments', {}).get('count'),
+                   media.get('likes', {}).get('count')]
+      if id and self.watermark_changed(cache, id, watermark):
+        logging.debug('Counts changed for %s, fetching comments and likes', id)
+        if fetch_replies:
+          media.setdefault('comments', {})['data'] = gr.urlopen(
+            API_MEDIA_COMMENTS_URL % id)
+        if fetch_likes:
+          media.setdefault('likes', {})['data'] = gr.urlopen(
+            API_MEDIA_LIKES_URL % id)
+      activities.append(gr.media_to_activity(media))
+
+    return util.trim_nulls({'items': activities})
 
   def canonicalize_syndication_url(self, syndication_url):
     """Instagram-specific standardization of syndicated urls. Canonical form
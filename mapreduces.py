@@ -11,6 +11,7 @@ import gc
 import json
 
 from mapreduce import operation as op
+import models
 import util
 
 
@@ -24,3 +25,27 @@ def prune_activity_json(response):
   # helps avoid hitting the instance memory limit
   gc.collect()
   yield op.db.Put(response)
+
+
+def backfill_activity_urls(response):
+  """Populate the Response.activity_urls property.
+
+  Used by tasks.Poll.refetch_hfeed() to query for responses by syndication URL.
+  """
+  if not response.activity_urls:
+    source = response.source.get()
+    if source:
+      response.set_activity_urls(source)
+      # helps avoid hitting the instance memory limit
+      gc.collect()
+      yield op.db.Put(response)
+
+
+def backfill_response_summaries(response):
+  """Store a ResponseSummary for each Response, for the user page."""
+  yield op.db.Put(models.ResponseSummary.from_response(response))
+
+
+def backfill_source_listings(source):
+  """Store a SourceListing for each Source, for the /users page."""
+  yield op.db.Put(models.SourceListing.from_source(source))
@@ -2,9 +2,11 @@
 """
 
 import datetime
+import hashlib
 import json
 import logging
 import pprint
+import random
 import re
 
 import appengine_config
@@ -17,6 +19,7 @@ from webmentiontools import send
 import superfeedr
 import util
 
+from google.appengine.api.datastore_types import _MAX_KEYPART_BYTES, _MAX_STRING_LENGTH
 from google.appengine.ext import ndb
 
 VERB_TYPES = ('comment', 'like', 'repost', 'rsvp')
@@ -25,6 +28,13 @@ TYPES = VERB_TYPES + ('post', 'preview')
 # maps string short name to Source subclass. populated by SourceMeta.
 sources = {}
 
+# maps '[kind] [domain]' to list of urlsafe keys of sources of that kind with
+# that domain. populated by Source.get_by_domain(), invalidated by Source's put
+# hook. the in-process tier isn't invalidated on other instances, so keep it
+# short.
+domain_sources_cache = util.TieredCache('domain', local_ttl=10,
+                                        memcache_ttl=60 * 60 * 24)
+
 
 def get_type(obj):
   """Returns the Response or Publish type for an ActivityStreams object."""
@@ -80,6 +90,19 @@ class Source(StringIdModel):
   # refetch author url to look for updated syndication links
   REFETCH_PERIOD = datetime.timedelta(hours=2)
 
+  # Whether tasks.Poll should pre-render new and changed responses' handlers.py
+  # pages. Subclasses may override.
+  PRERENDER_RESPONSES = True
+
+  # Maps Response.type to a format string for the silo id of a stored response,
+  # given the post id and the id of the responding user (or share). Comments use
+  # the comment id as is. Subclasses may override.
+  RESPONSE_ID_FORMATS = {
+    'like': '%(post)s_liked_by_%(user)s',
+    'repost': '%(post)s_shared_by_%(user)s',
+    'rsvp': '%(post)s_rsvp_%(user)s',
+  }
+
   # Maps Publish.type (e.g. 'like') to source-specific human readable type label
   # (e.g. 'favorite'). Subclasses should override this.
   TYPE_LABELS = {}
@@ -123,6 +146,10 @@ class Source(StringIdModel):
   # limited. it can be used e.g. to modify the poll period.
   rate_limited = False
 
+  # in memory only. maps Response key id to Response (or None) for
+  # get_stored_response().
+  _stored_responses = None
+
   # gr_source is *not* set to None by default here, since it needs to be unset
   # for __getattr__ to run when it's accessed.
 
@@ -157,6 +184,30 @@ class Source(StringIdModel):
     """
     return ndb.Key(cls, id).get()
 
+  @classmethod
+  def get_by_domain(cls, domain):
+    """Returns the sources of this kind that have the given domain.
+
+    Usually served from domain_sources_cache instead of querying. The results
+    are rechecked against each source's current domains, since cached keys may
+    be stale for sources that have since removed the domain.
+
+    Args:
+      domain: string, lower case
+
+    Returns: list of Source
+    """
+    cache_key = '%s %s' % (cls._get_kind(), domain)
+    keys = domain_sources_cache.get(cache_key)
+    if keys is None:
+      keys = [key.urlsafe() for key in
+              cls.query(cls.domains == domain).fetch(100, keys_only=True)]
+      domain_sources_cache.set(cache_key, keys)
+
+    return [source for source in
+            ndb.get_multi([ndb.Key(urlsafe=key) for key in keys])
+            if source and domain in source.domains]
+
   def bridgy_path(self):
     """Returns the Bridgy page URL path for this source."""
     return '/%s/%s' % (self.SHORT_NAME, self.key.string_id())
@@ -219,8 +270,69 @@ class Source(StringIdModel):
 
     Passes through to granary by default. May be overridden
     by subclasses.
+
+    If a cache is provided and the subclass implements
+    get_activities_with_watermarks(), uses that instead for polls.
+    """
+    cache = kwargs.get('cache')
+    if (cache is not None and 'activity_id' not in kwargs and
+        (kwargs.get('fetch_replies') or kwargs.get('fetch_likes'))):
+      resp = self.get_activities_with_watermarks(
+        cache, count=kwargs.get('count'),
+        fetch_replies=kwargs.get('fetch_replies'),
+        fetch_likes=kwargs.get('fetch_likes'))
+      if resp is not None:
+        return resp
+
+    return self.gr_source.get_activities_response(group_id=gr_source.SELF,
+                                                  **kwargs)
+
+  def get_activities_with_watermarks(self, cache, count=None,
+                                     fetch_replies=False, fetch_likes=False):
+    """Returns recent activities, with responses only for changed activities.
+
+    Implementations should fetch the recent activities and their response
+    counts in a single API call, then use watermark_changed() to only fetch
+    replies and likes for activities whose counts have changed since the last
+    poll.
+
+    Activities that haven't changed are returned without their replies and
+    likes. That's safe because Poll only creates and updates Responses for the
+    responses it finds. It never deletes Responses that are missing.
+
+    Returns None by default, which falls back to granary. May be overridden by
+    subclasses.
+
+    Args:
+      cache: dict-like poll activity cache
+      count: integer, number of recent activities to fetch
+      fetch_replies, fetch_likes: boolean
+
+    Returns: dict, like granary's get_activities_response(), or None
     """
-    return self.gr_source.get_activities_response(group_id=gr_source.SELF, **kwargs)
+    return None
+
+  @staticmethod
+  def watermark_changed(cache, id, watermark):
+    """Checks and updates an activity's watermark in the poll activity cache.
+
+    The watermark is stored with key 'AW [ACTIVITY ID]'.
+
+    Args:
+      cache: dict-like poll activity cache
+      id: string, silo activity id
+      watermark: JSON-serializable, e.g. a list of comment and like counts.
+        None means unknown, which always counts as changed.
+
+    Returns: boolean, True if the watermark is different from the last poll's
+    """
+    key = 'AW ' + id
+    if watermark is None:
+      return True
+    elif cache.get(key) == watermark:
+      return False
+    cache[key] = watermark
+    return True
 
   def get_activities(self, *args, **kwargs):
     return self.get_activities_response(*args, **kwargs)['items']
@@ -246,11 +358,34 @@ class Source(StringIdModel):
     """
     return self.gr_source.get_event(id)
 
+  def get_stored_response(self, type, post_id, id):
+    """Returns a Response from the datastore for this source, if we have one.
+
+    Memoized, so repeated lookups for the same response are free.
+
+    Args:
+      type: string, Response.type
+      post_id: string, site-specific post or event id
+      id: string, site-specific comment id, or the id of the user who liked,
+        reposted, or RSVPed, or the share id
+
+    Returns: Response, or None
+    """
+    format = self.RESPONSE_ID_FORMATS.get(type)
+    silo_id = format % {'post': post_id, 'user': id} if format else id
+    key_id = self.gr_source.tag_uri(silo_id)
+
+    if self._stored_responses is None:
+      self._stored_responses = {}
+    if key_id not in self._stored_responses:
+      self._stored_responses[key_id] = Response.get_by_id(key_id)
+    return self._stored_responses[key_id]
+
   def get_comment(self, comment_id, activity_id=None, activity_author_id=None):
     """Returns a comment from this source.
 
-    Passes through to granary by default. May be overridden
-    by subclasses.
+    Uses the Response in the datastore if we have one, otherwise passes
+    through to granary. May be overridden by subclasses.
 
     Args:
       comment_id: string, site-specific comment id
@@ -259,46 +394,58 @@ class Source(StringIdModel):
 
     Returns: dict, decoded ActivityStreams comment object, or None
     """
+    resp = self.get_stored_response('comment', activity_id, comment_id)
+    if resp:
+      return json.loads(resp.response_json)
     return self.gr_source.get_comment(comment_id, activity_id=activity_id,
                                       activity_author_id=activity_author_id)
 
   def get_like(self, activity_user_id, activity_id, like_user_id):
     """Returns an ActivityStreams 'like' activity object.
 
-    Passes through to granary by default. May be overridden
-    by subclasses.
+    Uses the Response in the datastore if we have one, otherwise passes
+    through to granary. May be overridden by subclasses.
 
     Args:
       activity_user_id: string id of the user who posted the original activity
       activity_id: string activity id
       like_user_id: string id of the user who liked the activity
     """
+    resp = self.get_stored_response('like', activity_id, like_user_id)
+    if resp:
+      return json.loads(resp.response_json)
     return self.gr_source.get_like(activity_user_id, activity_id, like_user_id)
 
   def get_share(self, activity_user_id, activity_id, share_id):
     """Returns an ActivityStreams 'share' activity object.
 
-    Passes through to granary by default. May be overridden
-    by subclasses.
+    Uses the Response in the datastore if we have one, otherwise passes
+    through to granary. May be overridden by subclasses.
 
     Args:
       activity_user_id: string id of the user who posted the original activity
       activity_id: string activity id
       share_id: string id of the share object or the user who shared it
     """
+    resp = self.get_stored_response('repost', activity_id, share_id)
+    if resp:
+      return json.loads(resp.response_json)
     return self.gr_source.get_share(activity_user_id, activity_id, share_id)
 
   def get_rsvp(self, activity_user_id, event_id, user_id):
     """Returns an ActivityStreams 'rsvp-*' activity object.
 
-    Passes through to granary by default. May be overridden
-    by subclasses.
+    Uses the Response in the datastore if we have one, otherwise passes
+    through to granary. May be overridden by subclasses.
 
     Args:
       activity_user_id: string id of the user who posted the original activity
       event_id: string event id
       user_id: string id of the user object or the user who RSVPed
     """
+    resp = self.get_stored_response('rsvp', event_id, user_id)
+    if resp:
+      return json.loads(resp.response_json)
     return self.gr_source.get_rsvp(activity_user_id, event_id, user_id)
 
   def create_comment(self, post_url, author_name, author_url, content):
@@ -398,6 +545,8 @@ class Source(StringIdModel):
 
     # TODO: ugh, *all* of this should be transactional
     source.put()
+    if not existing:
+      StatCounter.increment('users')
 
     if 'listen' in source.features:
       util.add_poll_task(source, now=True)
@@ -534,6 +683,115 @@ class Source(StringIdModel):
     """
     pass
 
+  def _domain_state(self):
+    """Returns the fields that domain_sources_cache depends on."""
+    return (sorted(self.domains), sorted(self.features), self.status)
+
+  @classmethod
+  def _from_pb(cls, *args, **kwargs):
+    """Remembers the loaded domains, features, and status for _post_put_hook.
+
+    Unlike _post_get_hook, this also runs on query results.
+    """
+    source = super(Source, cls)._from_pb(*args, **kwargs)
+    source._loaded_domain_state = source._domain_state()
+    return source
+
+  def _post_put_hook(self, future):
+    """Keeps this source's SourceListing and domain_sources_cache up to date.
+
+    When the listing changes, invalidates the cached /users pages, since
+    they're paged by cursor, so every page after this source's may shift.
+    Only invalidates domain_sources_cache if the domains, features, or status
+    changed since they were loaded.
+    """
+    listing = SourceListing.from_source(self)
+    existing = listing.key.get()
+    if not existing or existing.to_dict() != listing.to_dict():
+      listing.put()
+      ndb.get_context().call_on_commit(
+        lambda: util.CachedPage.invalidate_prefix('/users'))
+
+    loaded = getattr(self, '_loaded_domain_state', None)
+    state = self._domain_state()
+    if state != loaded:
+      domains = set(self.domains) | set(loaded[0] if loaded else [])
+      cache_keys = ['%s %s' % (self._get_kind(), domain) for domain in domains]
+      ndb.get_context().call_on_commit(
+        lambda: domain_sources_cache.delete_multi(cache_keys))
+      self._loaded_domain_state = state
+
+
+class SourceListing(ndb.Model):
+  """A source's entry in the /users page.
+
+  Child of its source, with id 1. Sources of all kinds share this kind, so
+  app.UsersHandler can page through all of them in name order with a single
+  query. Written by Source's put hook.
+  """
+  # whether the source should be shown, ie has any features enabled
+  listed = ndb.BooleanProperty()
+  # lower cased name, so that sorting is case insensitive
+  name_lower = ndb.StringProperty()
+
+  @classmethod
+  def from_source(cls, source):
+    """Returns a new, unsaved SourceListing for a Source.
+
+    Args:
+      source: Source
+    """
+    return SourceListing(id=1, parent=source.key,
+                         listed=bool(source.features),
+                         name_lower=(source.name or source.key.string_id()).lower())
+
+
+class CachedPostId(StringIdModel):
+  """Maps a blog post's URL, slug or path to the blog silo's id for it.
+
+  Child of the blog's source. The key name is whatever that source's
+  create_comment() looks posts up by, e.g. a post URL or slug, or its SHA1 hex
+  digest if it's too long for a key name. Lets it skip the lookup API call for
+  posts that we've already sent comments to.
+  """
+  post_id = ndb.StringProperty(required=True)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+  @staticmethod
+  def _key_name(name):
+    encoded = name.encode('utf-8') if isinstance(name, unicode) else name
+    if len(encoded) > _MAX_KEYPART_BYTES:
+      return 'sha1 ' + hashlib.sha1(encoded).hexdigest()
+    return name
+
+  @classmethod
+  def get_or_fetch(cls, source, name, fetch_fn):
+    """Returns the cached post id for name, or fetches and stores it.
+
+    Args:
+      source: Source
+      name: string, the URL, slug or path
+      fetch_fn: callable that takes no args and returns the post id, usually
+        with an API call. Its result is only stored if it's not None.
+
+    Returns: string post id, or None
+    """
+    cached = cls.get_by_id(cls._key_name(name), parent=source.key)
+    if cached:
+      logging.debug('Using cached post id %s for %s', cached.post_id, name)
+      return cached.post_id
+
+    post_id = fetch_fn()
+    if post_id is not None:
+      post_id = unicode(post_id)
+      cls(id=cls._key_name(name), parent=source.key, post_id=post_id).put()
+    return post_id
+
+  @classmethod
+  def invalidate(cls, source, name):
+    """Deletes the cached post id for name, e.g. when the post is gone."""
+    ndb.Key(cls, cls._key_name(name), parent=source.key).delete()
+
 
 class Webmentions(StringIdModel):
   """A bundle of links to send webmentions for.
@@ -541,6 +799,9 @@ class Webmentions(StringIdModel):
   Use the Response and BlogPost concrete subclasses below.
   """
   STATUSES = ('new', 'processing', 'complete', 'error')
+  LINK_STATES = ('sent', 'unsent', 'error', 'failed', 'skipped')
+  # name of the StatCounter for this kind. subclasses should override.
+  COUNTER = None
 
   # Turn off NDB instance and memcache caching. Main reason is to improve memcache
   # hit rate since app engine only gives me 1MB right now. :/ Background:
@@ -578,6 +839,10 @@ class Webmentions(StringIdModel):
     """
     raise NotImplementedError()
 
+  def link_counts(self):
+    """Returns a dict mapping each of LINK_STATES to its number of links."""
+    return {state: len(getattr(self, state)) for state in self.LINK_STATES}
+
   @ndb.transactional(xg=True)
   def get_or_save(self):
     existing = self.key.get()
@@ -604,6 +869,8 @@ class Webmentions(StringIdModel):
       self.status = 'complete'
 
     self.put()
+    StatCounter.increment(self.COUNTER)
+    StatCounter.increment_links({}, self.link_counts())
     return self
 
 
@@ -612,6 +879,8 @@ class Response(Webmentions):
 
   The key name is the comment object id as a tag URI.
   """
+  COUNTER = 'responses'
+
   # ActivityStreams JSON activity and comment, like, or repost
   type = ndb.StringProperty(choices=VERB_TYPES, default='comment')
   # These are TextProperty, and not JsonProperty, so that their plain text is
@@ -625,6 +894,12 @@ class Response(Webmentions):
   # JSON dict mapping original post url to activity index in activities_json.
   # only set when there's more than one activity.
   urls_to_activity = ndb.TextProperty()
+  # pages pre-rendered by tasks.Poll for handlers.py. dict mapping post id to
+  # dict mapping format ('html' or 'json') to page body.
+  rendered = ndb.JsonProperty(compressed=True)
+  # canonicalized URLs of the activities in activities_json. lets
+  # tasks.Poll.refetch_hfeed() query for responses by syndication URL.
+  activity_urls = ndb.StringProperty(repeated=True)
 
   # DEPRECATED, DO NOT USE! see https://github.com/snarfed/bridgy/issues/217
   activity_json = ndb.TextProperty()
@@ -641,6 +916,47 @@ class Response(Webmentions):
     type = get_type(obj)
     return type if type in VERB_TYPES else 'comment'
 
+  def item_path(self, source, activity):
+    """Returns the handlers.py path for this response, e.g.
+    /comment/twitter/snarfed_org/10100823411094363/999999 .
+
+    Args:
+      source: Source
+      activity: ActivityStreams activity dict that this response is on
+    """
+    # parse the response id. (we know Response key ids are always tag URIs)
+    _, response_id = util.parse_tag_uri(self.key.string_id())
+    if self.type in ('like', 'repost', 'rsvp'):
+      response_id = response_id.split('_')[-1]
+
+    id = activity['id']
+    parsed = util.parse_tag_uri(id)
+    post_id = parsed[1] if parsed else id
+    return '/%s/%s/%s/%s/%s' % (self.type, source.SHORT_NAME,
+                                source.key.string_id(), post_id, response_id)
+
+  def invalidate_item_cache(self, source):
+    """Deletes this response's rendered handlers.py pages from the cache."""
+    paths = [self.item_path(source, json.loads(a))
+             for a in self.activities_json + filter(None, [self.activity_json])]
+    util.item_page_cache.delete_multi(paths)
+
+  def set_activity_urls(self, source):
+    """Populates activity_urls from activities_json.
+
+    Args:
+      source: Source, used to canonicalize the URLs
+    """
+    urls = []
+    for activity_json in self.activities_json + filter(None, [self.activity_json]):
+      activity = json.loads(activity_json)
+      url = activity.get('url') or activity.get('object', {}).get('url')
+      if url:
+        url = source.canonicalize_syndication_url(url)
+        if len(url) <= _MAX_STRING_LENGTH and url not in urls:
+          urls.append(url)
+    self.activity_urls = urls
+
   @ndb.transactional(xg=True)
   def get_or_save(self, source):
     resp = super(Response, self).get_or_save()
@@ -649,12 +965,21 @@ class Response(Webmentions):
                                          json.loads(self.response_json),
                                          log=True):
       logging.info('Response changed! Re-propagating. Original: %s' % resp)
+      link_counts = resp.link_counts()
       resp.status = 'new'
       resp.unsent += resp.sent + resp.error + resp.failed + resp.skipped
       resp.sent = resp.error = resp.failed = resp.skipped = []
       resp.old_response_jsons = resp.old_response_jsons[:10] + [resp.response_json]
       resp.response_json = self.response_json
+      if not resp.activity_urls:
+        resp.activity_urls = self.activity_urls
+      resp.rendered = None  # stale now. tasks.Poll re-renders it.
       resp.put()
+      StatCounter.increment_links(link_counts, resp.link_counts())
+      # only drop the cached pages once the change is committed. otherwise a
+      # concurrent request could re-cache the old page in between.
+      ndb.get_context().call_on_commit(
+        lambda: resp.invalidate_item_cache(source))
       self.add_task(transactional=True)
 
     return resp
@@ -673,12 +998,102 @@ class Response(Webmentions):
     """Don't allow storing new entities with activity_json."""
     assert self.activity_json is None
 
+  def _post_put_hook(self, future):
+    """Keeps this response's ResponseSummary up to date."""
+    ResponseSummary.from_response(self).put()
+
+
+class ResponseSummary(ndb.Model):
+  """The parts of a Response that the user page shows.
+
+  Child of its Response, with id 1, so that it can be written in the same
+  transaction. Written by Response's put hook.
+  """
+  # content snippets are truncated to this many characters
+  MAX_CONTENT = 200
+
+  # used as content for responses without any
+  PHRASES = {
+    'like': 'liked this',
+    'repost': 'reposted this',
+    'rsvp-yes': 'is attending',
+    'rsvp-no': 'is not attending',
+    'rsvp-maybe': 'might attend',
+    'invite': 'is invited',
+  }
+
+  _use_cache = False
+  _use_memcache = False
+
+  source = ndb.KeyProperty()
+  updated = ndb.DateTimeProperty()
+  public = ndb.BooleanProperty()
+  type = ndb.StringProperty(indexed=False)
+  status = ndb.StringProperty(indexed=False)
+  # ActivityStreams actor with just displayName, url, and image.url
+  actor = ndb.JsonProperty()
+  # dict with url and content
+  response = ndb.JsonProperty()
+  # list of dicts with url and content, one per activity
+  activities = ndb.JsonProperty()
+
+  # Original post links, ie webmention targets. Copied from the Response.
+  sent = ndb.StringProperty(repeated=True, indexed=False)
+  unsent = ndb.StringProperty(repeated=True, indexed=False)
+  error = ndb.StringProperty(repeated=True, indexed=False)
+  failed = ndb.StringProperty(repeated=True, indexed=False)
+  skipped = ndb.StringProperty(repeated=True, indexed=False)
+
+  @property
+  def response_key(self):
+    return self.key.parent()
+
+  @classmethod
+  def from_response(cls, resp):
+    """Returns a new, unsaved ResponseSummary for a Response.
+
+    Args:
+      resp: Response
+    """
+    obj = json.loads(resp.response_json)
+    activities = [json.loads(a) for a in
+                  resp.activities_json + filter(None, [resp.activity_json])]
+
+    actor = obj.get('author') or obj.get('actor') or {}
+    content = obj.get('content')
+    if not content:
+      content = '%s %s.' % (actor.get('displayName') or '',
+                            cls.PHRASES.get(resp.type) or
+                            cls.PHRASES.get(obj.get('verb')))
+
+    snippet = lambda x: re.sub(r'<[^>]*>', '', x or '')[:cls.MAX_CONTENT]
+    return ResponseSummary(
+      id=1, parent=resp.key,
+      source=resp.source,
+      updated=resp.updated,
+      public=(gr_source.Source.is_public(obj) and
+              all(gr_source.Source.is_public(a) for a in activities)),
+      type=resp.type,
+      status=resp.status,
+      actor={'displayName': actor.get('displayName'),
+             'url': actor.get('url'),
+             'image': {'url': actor.get('image', {}).get('url')}},
+      response={'url': obj.get('url'), 'content': snippet(content)},
+      activities=[{
+        'url': a.get('url') or a.get('object', {}).get('url'),
+        'content': snippet(a.get('content') or a.get('object', {}).get('content')),
+      } for a in activities],
+      sent=resp.sent, unsent=resp.unsent, error=resp.error, failed=resp.failed,
+      skipped=resp.skipped)
+
 
 class BlogPost(Webmentions):
   """A blog post to be processed for links to send webmentions to.
 
   The key name is the URL.
   """
+  COUNTER = 'blogposts'
+
   feed_item = ndb.JsonProperty(compressed=True)  # from Superfeedr
 
   def label(self):
@@ -691,6 +1106,16 @@ class BlogPost(Webmentions):
     util.add_propagate_blogpost_task(self, **kwargs)
 
 
+class SuperfeedrNotification(ndb.Model):
+  """A raw Superfeedr push notification, waiting to be processed.
+
+  Child of the blog source it's for. Stored by superfeedr.NotifyHandler and
+  processed and deleted by tasks.HandleSuperfeedrNotification.
+  """
+  feed = ndb.TextProperty(required=True)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+
+
 class PublishedPage(StringIdModel):
   """Minimal root entity for Publish children entities with the same source URL.
 
@@ -716,6 +1141,7 @@ class Publish(ndb.Model):
   source = ndb.KeyProperty()
   html = ndb.TextProperty()  # raw HTML fetched from source
   published = ndb.JsonProperty(compressed=True)
+  error = ndb.TextProperty()  # error message from an asynchronous publish
   created = ndb.DateTimeProperty(auto_now_add=True)
   updated = ndb.DateTimeProperty(auto_now=True)
 
@@ -836,3 +1262,243 @@ class SyndicatedPost(ndb.Model):
 
   def _pre_put_hook(self):
     self.key.parent().get().on_new_syndicated_post(self)
+
+
+class ActivityCacheEntry(StringIdModel):
+  """A single entry in a source's poll activity cache.
+
+  Child of the source. The key name is the cache key that granary or the
+  source's get_activities_response() uses, e.g. 'AR 123'. Entries with a
+  different version than VERSION are ignored when loading.
+  """
+  VERSION = 1
+
+  # Turn off instance and memcache caching. See Response for details.
+  _use_cache = False
+  _use_memcache = False
+
+  value = ndb.JsonProperty()
+  version = ndb.IntegerProperty(default=VERSION)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class ActivityCache(util.CacheDict):
+  """A source's poll activity cache, stored as ActivityCacheEntry children.
+
+  Passed to get_activities_response() as its cache. Entries are fetched
+  lazily, in one get_multi per lookup batch, so a poll only reads the entries
+  it uses. Use get_multi() or prefetch() to look up many keys at once. Note that
+  dict methods like keys() and len() only see entries that have been looked up
+  or set.
+
+  Tracks the keys that change, so save() only writes those entries. Entries
+  that are read are also rewritten, at most once per TOUCH_AGE, so that
+  updated tracks when they were last used. A fraction of saves evict entries
+  that haven't been used in MAX_AGE, and the least recently used entries
+  beyond MAX_ENTRIES.
+  """
+  MAX_AGE = datetime.timedelta(days=30)
+  MAX_ENTRIES = 2000
+  TOUCH_AGE = datetime.timedelta(days=1)
+  EVICT_PROBABILITY = .05
+
+  def __init__(self, source):
+    super(ActivityCache, self).__init__()
+    self.source = source
+    self.looked_up = set()
+    self.dirty = set()
+    self.deleted = set()
+    self.touch = set()
+
+  @classmethod
+  def load(cls, source):
+    """Returns a source's cache. Doesn't fetch any entries yet.
+
+    Also migrates the legacy Source.last_activities_cache_json blob, if any.
+    Its entries are marked dirty, so save() writes them as entities.
+
+    Args:
+      source: Source
+
+    Returns: ActivityCache
+    """
+    cache = cls(source)
+    if source.last_activities_cache_json:
+      cache.update(json.loads(source.last_activities_cache_json))
+    return cache
+
+  def prefetch(self, keys):
+    """Fetches the entries for any keys that haven't been looked up yet.
+
+    Args:
+      keys: sequence of string keys
+    """
+    keys = [k for k in set(keys) if k not in self.looked_up]
+    if not keys:
+      return
+
+    self.looked_up.update(keys)
+    entries = ndb.get_multi([ndb.Key(ActivityCacheEntry, k, parent=self.source.key)
+                             for k in keys])
+    touch_before = datetime.datetime.now() - self.TOUCH_AGE
+    for key, entry in zip(keys, entries):
+      if entry and entry.version == ActivityCacheEntry.VERSION:
+        dict.__setitem__(self, key, entry.value)
+        if entry.updated < touch_before:
+          self.touch.add(key)
+
+  def __contains__(self, key):
+    self.prefetch([key])
+    return super(ActivityCache, self).__contains__(key)
+
+  def __getitem__(self, key):
+    self.prefetch([key])
+    return super(ActivityCache, self).__getitem__(key)
+
+  def get(self, key, default=None):
+    self.prefetch([key])
+    return super(ActivityCache, self).get(key, default)
+
+  def get_multi(self, keys):
+    keys = list(keys)
+    self.prefetch(keys)
+    return {k: dict.__getitem__(self, k) for k in keys if dict.__contains__(self, k)}
+
+  def __setitem__(self, key, val):
+    # don't look the key up just to see whether the value changed
+    if not (dict.__contains__(self, key) and dict.__getitem__(self, key) == val):
+      self.dirty.add(key)
+    self.looked_up.add(key)
+    self.deleted.discard(key)
+    super(ActivityCache, self).__setitem__(key, val)
+
+  def __delitem__(self, key):
+    super(ActivityCache, self).__delitem__(key)
+    self.dirty.discard(key)
+    self.touch.discard(key)
+    self.deleted.add(key)
+
+  def update(self, *args, **kwargs):
+    for key, val in dict(*args, **kwargs).items():
+      self[key] = val
+
+  def set_multi(self, updates, **kwargs):
+    self.update(updates)
+
+  def save(self):
+    """Writes changed and used entries, deletes removed ones, maybe evicts."""
+    puts = [ActivityCacheEntry(id=key, parent=self.source.key,
+                               value=dict.__getitem__(self, key))
+            for key in self.dirty | self.touch]
+    deletes = [ndb.Key(ActivityCacheEntry, key, parent=self.source.key)
+               for key in self.deleted]
+    logging.debug('Writing %d activity cache entries, deleting %d',
+                  len(puts), len(deletes))
+    ndb.put_multi(puts)
+    ndb.delete_multi(deletes)
+    self.dirty = set()
+    self.touch = set()
+    self.deleted = set()
+
+    if random.random() < self.EVICT_PROBABILITY:
+      self.evict()
+
+  def evict(self):
+    """Deletes entries that haven't been used in MAX_AGE or are beyond
+    MAX_ENTRIES. Uses keys only queries, so it doesn't read entry values."""
+    query = ActivityCacheEntry.query(ancestor=self.source.key)
+    old = query.filter(ActivityCacheEntry.updated <
+                       datetime.datetime.now() - self.MAX_AGE
+                       ).fetch(keys_only=True)
+    extra = query.order(-ActivityCacheEntry.updated).fetch(
+      keys_only=True, offset=self.MAX_ENTRIES)
+    evict = set(old) | set(extra)
+    logging.debug('Evicting %d activity cache entries', len(evict))
+    ndb.delete_multi(evict)
+
+
+class StatCounter(StringIdModel):
+  """One shard of a front page counter, e.g. number of users or links sent.
+
+  The key name is '[name] [shard]'. Shard 0 is the baseline, ie the count from
+  before the counters were deployed. It's seeded once by tasks.SeedStatCounters.
+  increment() writes to a random shard from 1 to NUM_SHARDS so that concurrent
+  writers rarely contend on the same entity.
+  """
+  NAMES = (('users', 'responses', 'blogposts', 'publishes',
+            'webmentions_received') +
+           tuple('links_' + state for state in Webmentions.LINK_STATES))
+  NUM_SHARDS = 20
+
+  count = ndb.IntegerProperty(default=0, indexed=False)
+
+  @classmethod
+  def increment(cls, name, delta=1):
+    """Adds delta to a counter.
+
+    If we're in a transaction, waits until it commits, so that counters only
+    include writes that actually happened and we don't add counter shards to
+    the transaction's entity groups.
+
+    Args:
+      name: string, one of NAMES
+      delta: integer
+    """
+    assert name in cls.NAMES, name
+    if delta:
+      ndb.get_context().call_on_commit(lambda: cls._increment(name, delta))
+
+  @classmethod
+  def increment_links(cls, before, after):
+    """Updates the links_* counters for a change in a Webmentions entity.
+
+    Args:
+      before, after: dicts returned by Webmentions.link_counts(). before may be
+        empty for new entities.
+    """
+    for state in Webmentions.LINK_STATES:
+      cls.increment('links_' + state, after.get(state, 0) - before.get(state, 0))
+
+  @classmethod
+  def _increment(cls, name, delta):
+    id = '%s %d' % (name, random.randint(1, cls.NUM_SHARDS))
+    try:
+      ndb.transaction(lambda: cls._increment_shard(id, delta))
+    except Exception:
+      # counters are best effort. don't fail the write that we're counting.
+      logging.warning('Incrementing counter %s failed', id, exc_info=True)
+
+  @classmethod
+  def _increment_shard(cls, id, delta):
+    counter = cls.get_by_id(id) or cls(id=id)
+    counter.count += delta
+    counter.put()
+
+  @classmethod
+  def set_baselines(cls, counts):
+    """Overwrites the baseline shards.
+
+    Args:
+      counts: dict mapping string name in NAMES to integer count
+    """
+    ndb.put_multi(cls(id='%s 0' % name, count=counts.get(name, 0))
+                  for name in cls.NAMES)
+
+  @classmethod
+  def totals(cls):
+    """Returns the current value of every counter in NAMES.
+
+    Fetches all shards, including the baselines, with a single get_multi.
+
+    Returns: dict mapping string name to integer total
+    """
+    ids = ['%s %d' % (name, shard) for name in cls.NAMES
+           for shard in range(cls.NUM_SHARDS + 1)]
+    counters = ndb.get_multi([ndb.Key(cls, id) for id in ids])
+
+    totals = {name: 0 for name in cls.NAMES}
+    for id, counter in zip(ids, counters):
+      if counter:
+        totals[id.rsplit(' ', 1)[0]] += counter.count
+
+    return totals
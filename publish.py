@@ -31,6 +31,7 @@ import logging
 import json
 import mf2py
 import pprint
+import time
 import urlparse
 
 import appengine_config
@@ -53,9 +54,15 @@ import util
 import webapp2
 import webmention
 
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from google.appengine.ext.webapp import template
 
+EXPAND_DEADLINE = 10  # seconds, for expand_target_urls()
+SYNDICATION_CACHE_PREFIX = 'S '
+SYNDICATION_CACHE_TIME = 60 * 30  # seconds, for expand_target_urls()
+
 SOURCE_NAMES = {
   cls.SHORT_NAME: cls for cls in
   (FacebookPage, Twitter, Instagram, GooglePlusPage)}
@@ -99,12 +106,12 @@ class Handler(webmention.WebmentionHandler):
       return self.request.get(param).lower() in ('', 'true')
     return None
 
-  def _run(self):
-    """Returns CreationResult on success, None otherwise."""
-    logging.info('Params: %s', self.request.params.items())
-    assert self.PREVIEW in (True, False)
+  def check_target(self):
+    """Parses and validates the target URL.
 
-    # parse and validate target URL
+    Returns: the Source subclass for the target's silo on success, None
+    otherwise. Calls self.error() on failure.
+    """
     try:
       parsed = urlparse.urlparse(self.target_url())
     except BaseException:
@@ -120,8 +127,20 @@ class Handler(webmention.WebmentionHandler):
       return self.error('Sorry, %s is not yet supported.' %
                         source_cls.GR_CLASS.NAME)
 
-    # resolve source URL
-    url, domain, ok = util.get_webmention_target(self.source_url())
+    return source_cls
+
+  def find_source(self, source_cls, url, domain, ok):
+    """Looks up the publish-enabled source for the source URL's domain.
+
+    Sets self.source on success. Calls self.error() on failure.
+
+    Args:
+      source_cls: Source subclass
+      url, domain, ok: return values of util.get_webmention_target() for the
+        source URL
+
+    Returns: True on success, None otherwise
+    """
     # show nice error message if they're trying to publish a silo post
     if domain in SOURCE_DOMAINS:
       return self.error(
@@ -138,7 +157,7 @@ class Handler(webmention.WebmentionHandler):
 
     # look up source by domain
     domain = domain.lower()
-    sources = source_cls.query().filter(source_cls.domains == domain).fetch(100)
+    sources = source_cls.get_by_domain(domain)
     if not sources:
       return self.error("Could not find <b>%(type)s</b> account for <b>%(domain)s</b>. Check that your %(type)s profile has %(domain)s in its <em>web site</em> or <em>link</em> field, then try signing up again." %
         {'type': source_cls.GR_CLASS.NAME, 'domain': domain})
@@ -148,12 +167,17 @@ class Handler(webmention.WebmentionHandler):
                    (source.bridgy_url(self), source.features, source.status))
       if source.status != 'disabled' and 'publish' in source.features:
         self.source = source
-        break
-    else:
-      return self.error(
-        'Publish is not enabled for your account(s). Please visit %s and sign up!' %
-        ' or '.join(s.bridgy_url(self) for s in sources))
+        return True
+
+    return self.error(
+      'Publish is not enabled for your account(s). Please visit %s and sign up!' %
+      ' or '.join(s.bridgy_url(self) for s in sources))
+
+  def check_not_home_page(self):
+    """Returns True unless the source URL is self.source's home page.
 
+    Calls self.error() on failure.
+    """
     # show nice error message if they're trying to publish their home page
     for domain_url in self.source.domain_urls:
       domain_url_parts = urlparse.urlparse(domain_url)
@@ -164,16 +188,47 @@ class Handler(webmention.WebmentionHandler):
         return self.error(
           "Looks like that's your home page. Try one of your posts instead!")
 
-    # done with the sanity checks, ready to fetch the source url. create the
-    # Publish entity so we can store the result.
+    return True
+
+  def publish_entity(self, url):
+    """Returns the Publish entity to store this publish's results in.
+
+    Calls self.error() and returns None if url has already been published.
+
+    Args:
+      url: string, resolved source URL
+    """
     entity = self.get_or_add_publish_entity(url)
     if (entity.status == 'complete' and entity.type != 'preview' and
         not self.PREVIEW and not appengine_config.DEBUG):
       return self.error("Sorry, you've already published that page, and Bridgy Publish doesn't yet support updating or deleting existing posts. Ping Ryan if you want that feature!")
-    self.entity = entity
+    return entity
+
+  def _run(self):
+    """Returns CreationResult on success, None otherwise."""
+    logging.info('Params: %s', self.request.params.items())
+    assert self.PREVIEW in (True, False)
+
+    source_cls = self.check_target()
+    if not source_cls:
+      return
 
-    # fetch source page
-    resp = self.fetch_mf2(url)
+    # resolve source URL
+    url, domain, ok = util.get_webmention_target(self.source_url())
+    if (not self.find_source(source_cls, url, domain, ok) or
+        not self.check_not_home_page()):
+      return
+
+    # done with the sanity checks, ready to fetch the source url. create the
+    # Publish entity so we can store the result. (async publishes already did.)
+    if not self.entity:
+      self.entity = self.publish_entity(url)
+      if not self.entity:
+        return
+
+    # fetch source page. use the fetch cache so that publishing right after a
+    # preview doesn't fetch and parse it again.
+    resp = self.fetch_mf2(url, cache=True)
     if not resp:
       return
     self.fetched, data = resp
@@ -226,6 +281,8 @@ class Handler(webmention.WebmentionHandler):
     # write results to datastore
     self.entity.status = 'complete'
     self.entity.put()
+    if self.entity.type != 'preview':
+      models.StatCounter.increment('publishes')
     return result
 
   def attempt_single_item(self, item):
@@ -350,72 +407,104 @@ class Handler(webmention.WebmentionHandler):
         line.rstrip() for line in h.handle(content).splitlines())
       logging.info('Rendered content to:\n%s', activity['content'])
 
-  def expand_target_urls(self, activity):
+  def expand_target_urls(self, activity, deadline=EXPAND_DEADLINE):
     """Expand the inReplyTo or object fields of an ActivityStreams object
     by fetching the original and looking for rel=syndication URLs.
 
     This method modifies the dict in place.
 
+    The originals are resolved, then fetched and parsed concurrently, waiting
+    up to deadline seconds total. Their syndication URLs are cached in memcache
+    by resolved URL, so later publishes of replies to the same post don't fetch
+    it again.
+
     Args:
       activity: an ActivityStreams dict of the activity being published
+      deadline: float, seconds to wait for fetches
     """
+    fields = {}
     for field in ('inReplyTo', 'object'):
       # microformats2.json_to_object de-dupes, no need to do it here
       objs = activity.get(field)
-      if not objs:
-        continue
-
-      if isinstance(objs, dict):
-        objs = [objs]
-
+      if objs:
+        fields[field] = [objs] if isinstance(objs, dict) else objs
+
+    end = time.time() + deadline
+    urls = {obj.get('url') for objs in fields.values() for obj in objs
+            if obj.get('url')}
+
+    # get_webmention_target weeds out silos and non-HTML targets that we
+    # wouldn't want to download and parse
+    resolved = {url: target[0] for url, target in
+                util.resolve_webmention_targets(urls, deadline=deadline).items()
+                if target[2]}
+
+    synd_urls = memcache.get_multi(set(resolved.values()),
+                                   key_prefix=SYNDICATION_CACHE_PREFIX)
+    for url, found in synd_urls.items():
+      logging.debug('expand_target_urls using cached rel=syndication for url=%s: %r',
+                    url, found)
+
+    to_fetch = set(resolved.values()) - set(synd_urls)
+    fetched = {url: found for url, found in util.run_concurrently(
+                 self.fetch_syndication_urls, to_fetch,
+                 max(end - time.time(), 0)).items()
+               if found is not None}
+    if fetched:
+      memcache.set_multi(fetched, key_prefix=SYNDICATION_CACHE_PREFIX,
+                         time=SYNDICATION_CACHE_TIME)
+      synd_urls.update(fetched)
+
+    for field, objs in fields.items():
       augmented = list(objs)
       for obj in objs:
-        url = obj.get('url')
-        if not url:
-          continue
-
-        # get_webmention_target weeds out silos and non-HTML targets
-        # that we wouldn't want to download and parse
-        url, _, ok = util.get_webmention_target(url)
-        if not ok:
-          continue
-
-        # fetch_mf2 raises a fuss if it can't fetch a mf2 document;
-        # easier to just grab this ourselves than add a bunch of
-        # special-cases to that method
-        logging.debug('expand_target_urls fetching field=%s, url=%s', field, url)
-        try:
-          resp = util.requests_get(url)
-          resp.raise_for_status()
-          data = mf2py.Parser(url=url, doc=resp.text).to_dict()
-        except AssertionError:
-          raise  # for unit tests
-        except BaseException:
-          # it's not a big deal if we can't fetch an in-reply-to url
-          logging.warning('expand_target_urls could not fetch field=%s, url=%s',
-                          field, url, exc_info=True)
-          continue
-
-        synd_urls = data.get('rels', {}).get('syndication', [])
-
-        # look for syndication urls in the first h-entry
-        queue = collections.deque(data.get('items', []))
-        while queue:
-          item = queue.popleft()
-          item_types = set(item.get('type', []))
-          if 'h-feed' in item_types and 'h-entry' not in item_types:
-            queue.extend(item.get('children', []))
-            continue
-
-          # these can be urls or h-cites
-          synd_urls += microformats2.get_string_urls(
-            item.get('properties', {}).get('syndication', []))
-
-        logging.debug('expand_target_urls found rel=syndication for url=%s: %r', url, synd_urls)
-        augmented += [{'url': u} for u in synd_urls]
-
+        augmented += [{'url': u} for u in
+                      synd_urls.get(resolved.get(obj.get('url')), [])]
       activity[field] = augmented
 
+  def fetch_syndication_urls(self, url):
+    """Fetches an original post and returns its rel=syndication URLs.
+
+    Args:
+      url: string, the inReplyTo or object URL, resolved by
+        util.get_webmention_target()
+
+    Returns: list of string URLs, or None if the fetch failed
+    """
+    # fetch_mf2 raises a fuss if it can't fetch a mf2 document;
+    # easier to just grab this ourselves than add a bunch of
+    # special-cases to that method
+    logging.debug('expand_target_urls fetching url=%s', url)
+    try:
+      resp = util.requests_get(url)
+      resp.raise_for_status()
+      data = mf2py.Parser(url=url, doc=resp.text).to_dict()
+    except AssertionError:
+      raise  # for unit tests
+    except BaseException:
+      # it's not a big deal if we can't fetch an in-reply-to url
+      logging.warning('expand_target_urls could not fetch url=%s', url,
+                      exc_info=True)
+      return None
+
+    synd_urls = data.get('rels', {}).get('syndication', [])
+
+    # look for syndication urls in the first h-entry
+    queue = collections.deque(data.get('items', []))
+    while queue:
+      item = queue.popleft()
+      item_types = set(item.get('type', []))
+      if 'h-feed' in item_types and 'h-entry' not in item_types:
+        queue.extend(item.get('children', []))
+        continue
+
+      # these can be urls or h-cites
+      synd_urls += microformats2.get_string_urls(
+        item.get('properties', {}).get('syndication', []))
+
+    logging.debug('expand_target_urls found rel=syndication for url=%s: %r', url, synd_urls)
+    return synd_urls
+
   @ndb.transactional
   def get_or_add_publish_entity(self, source_url):
     """Creates and stores Publish and (if necessary) PublishedPage entities.
@@ -537,17 +626,64 @@ class InstagramSendHandler(SendHandler):
 
 class WebmentionHandler(Handler):
   """Accepts webmentions and translates them to publish requests.
+
+  If the request has a Prefer: respond-async header (RFC 7240), only resolves
+  the source URL and runs the checks that don't fetch it, then returns 202 with
+  a Location header that points to StatusHandler and publishes in a
+  WebmentionTaskHandler task.
   """
   PREVIEW = False
 
   def post(self):
+    if 'respond-async' in self.request.headers.get('Prefer', ''):
+      return self.enqueue()
+
     result = self._run()
     if result:
       self.response.write(result.content)
 
+  def enqueue(self):
+    """Validates the webmention, adds a publish task, and returns 202."""
+    logging.info('Params: %s', self.request.params.items())
+    source_cls = self.check_target()
+    if not source_cls:
+      return
+
+    # resolve the source URL the same way _run() does, so that we find the same
+    # source and Publish entity for redirected and shortened URLs.
+    url, domain, ok = util.get_webmention_target(self.source_url())
+    if (not self.find_source(source_cls, url, domain, ok) or
+        not self.check_not_home_page()):
+      return
+
+    self.entity = self.publish_entity(url)
+    if not self.entity:
+      return
+
+    params = dict(self.request.params.items())
+    params.update({
+      'publish_key': self.entity.key.urlsafe(),
+      'host_url': self.request.host_url,
+    })
+    task = taskqueue.add(queue_name='publish', params=params,
+                         target=taskqueue.DEFAULT_APP_VERSION)
+    logging.info('Added publish task %s', task.name)
+
+    status_url = '%s/publish/status/%s' % (self.request.host_url,
+                                           self.entity.key.urlsafe())
+    self.response.set_status(202)
+    self.response.headers['Location'] = status_url
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps({'status': self.entity.status,
+                                    'location': status_url}, indent=2))
+
+  def host_url(self):
+    """Returns the host URL that the webmention was sent to."""
+    return self.request.host_url
+
   def authorize(self):
     """Check for a backlink to brid.gy/publish/SILO."""
-    expected = '%s/publish/%s' % (self.request.host_url, self.source.SHORT_NAME)
+    expected = '%s/publish/%s' % (self.host_url(), self.source.SHORT_NAME)
 
     if self.entity.html and expected in self.entity.html:
       return True
@@ -556,9 +692,77 @@ class WebmentionHandler(Handler):
     return False
 
 
+class WebmentionTaskHandler(WebmentionHandler):
+  """Task handler that runs a publish accepted by WebmentionHandler.enqueue().
+
+  Stores errors in the Publish entity for StatusHandler and marks it 'failed'.
+  Never retried, not even after silo server errors or timeouts, since the
+  create may have succeeded anyway, and retrying could post it twice. The
+  publish queue's task_retry_limit is 0 for the same reason.
+
+  Request parameters: the webmention's parameters, plus:
+    publish_key: string key of the Publish entity
+    host_url: string, host URL that the webmention was sent to
+  """
+
+  def post(self):
+    key = ndb.Key(urlsafe=util.get_required_param(self, 'publish_key'))
+    self.entity = key.get()
+    if not self.entity:
+      logging.error('Publish entity %s not found! Dropping task.', key)
+      return
+    elif self.entity.status != 'new':
+      # task queues can occasionally run a task more than once
+      logging.warning('Publish %s is already %s. Dropping task.', key,
+                      self.entity.status)
+      return
+
+    self._run()
+
+  def host_url(self):
+    return util.get_required_param(self, 'host_url')
+
+  def error(self, error, html=None, status=400, **kwargs):
+    if self.entity:
+      self.entity.error = error
+    super(WebmentionTaskHandler, self).error(error, html=html, status=status,
+                                             **kwargs)
+    if int(status) >= 500:
+      logging.warning('Not retrying server error %s, the create may have '
+                      'succeeded', status)
+    self.response.set_status(200)
+
+
+class StatusHandler(webapp2.RequestHandler):
+  """Returns the status of an asynchronous publish as JSON.
+
+  Backed by its Publish entity, so it's just a single datastore get.
+  """
+
+  def get(self, key):
+    try:
+      key = ndb.Key(urlsafe=key)
+    except BaseException:
+      self.abort(404)
+
+    entity = key.get() if key.kind() == 'Publish' else None
+    if not entity:
+      self.abort(404)
+
+    resp = {'status': entity.status}
+    if entity.status == 'complete':
+      resp.update(entity.published or {})
+    elif entity.status == 'failed':
+      resp['error'] = entity.error
+
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(resp, indent=2))
+
+
 application = webapp2.WSGIApplication([
     ('/publish/preview', PreviewHandler),
     ('/publish/webmention', WebmentionHandler),
+    ('/publish/status/([^/]+)', StatusHandler),
     ('/publish/(facebook|twitter|instagram)', webmention.WebmentionGetHandler),
     ('/publish/facebook/finish', FacebookSendHandler),
     ('/publish/instagram/finish', InstagramSendHandler),
@@ -8,6 +8,7 @@ If/when I add support for arbitrary RSS/Atom feeds, I should use
 http://feediscovery.appspot.com/ for feed discovery based on front page URL.
 """
 
+import collections
 import json
 import logging
 
@@ -20,6 +21,11 @@ from requests.auth import HTTPBasicAuth
 import util
 import webapp2
 
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
+
 PUSH_API_URL = 'https://push.superfeedr.com'
 
 
@@ -63,6 +69,12 @@ def handle_feed(feed, source):
   """Handles a Superfeedr JSON feed.
 
   Creates BlogPost entities and adds propagate-blogpost tasks for new items.
+  Works in batches: one get_multi for all items, one put_multi for the new
+  ones, and batched task adds, so that big feeds, e.g. the past posts that
+  subscribe() retrieves, don't time out.
+
+  Existing BlogPosts that are still new with links to send also get tasks, in
+  case an earlier attempt stored them but failed before adding their tasks.
 
   http://documentation.superfeedr.com/schema.html#json
   http://documentation.superfeedr.com/subscribers.html#pubsubhubbubnotifications
@@ -81,11 +93,14 @@ def handle_feed(feed, source):
     logging.warning("Dropping because source doesn't have webmention feature")
     return
 
+  posts = collections.OrderedDict()
   for item in json.loads(feed).get('items', []):
     url = item.get('permalinkUrl') or item.get('id')
     if not url:
       logging.error('Dropping feed item without permalinkUrl or id!')
       continue
+    elif url in posts:
+      continue
 
     source.preprocess_superfeedr_item(item)
     # extract links from content, discarding self links.
@@ -101,16 +116,62 @@ def handle_feed(feed, source):
              if util.domain_from_link(l) not in source.domains]
 
     logging.info('Found links: %s', links)
-    models.BlogPost(id=url,
-                    source=source.key,
-                    feed_item=item,
-                    unsent=links,
-                    ).get_or_save()
+    posts[url] = models.BlogPost(id=url,
+                                 source=source.key,
+                                 feed_item=item,
+                                 unsent=links,
+                                 )
+
+  existing = ndb.get_multi([post.key for post in posts.values()])
+  new = []
+  to_propagate = []
+  for post, got in zip(posts.values(), existing):
+    if not got:
+      new.append(post)
+      if post.unsent or post.error:
+        to_propagate.append(post)
+      else:
+        post.status = 'complete'
+    elif got.status == 'new' and (got.unsent or got.error):
+      # propagate tasks lease the BlogPost, so a duplicate task is harmless
+      to_propagate.append(got)
+
+  if not new and not to_propagate:
+    return
+
+  logging.info('Storing %d new BlogPosts, propagating %d', len(new),
+               len(to_propagate))
+  ndb.put_multi(new)
+  util.add_propagate_blogpost_tasks(to_propagate)
+
+  models.StatCounter.increment('blogposts', len(new))
+  models.StatCounter.increment_links({}, {
+    state: sum(len(getattr(post, state)) for post in new)
+    for state in models.Webmentions.LINK_STATES})
+
+
+@ndb.transactional
+def add_handle_feed_task(source, feed):
+  """Stores a raw feed and adds a superfeedr task to handle it.
+
+  Args:
+    source: Blogger, Tumblr, or WordPress
+    feed: string, Superfeedr JSON feed
+  """
+  key = models.SuperfeedrNotification(parent=source.key, feed=feed).put()
+  taskqueue.add(queue_name='superfeedr', params={'key': key.urlsafe()},
+                transactional=True)
+  logging.info('Stored %d byte feed as %s and added superfeedr task',
+               len(feed), key)
 
 
 class NotifyHandler(webapp2.RequestHandler):
   """Handles a Superfeedr notification.
 
+  Stores the raw feed and adds a superfeedr task to process it with
+  handle_feed(), so that we respond to Superfeedr quickly. Feeds too big to
+  store are processed inline instead.
+
   Abstract; subclasses must set the SOURCE_CLS attr.
 
   http://documentation.superfeedr.com/subscribers.html#pubsubhubbubnotifications
@@ -119,5 +180,15 @@ class NotifyHandler(webapp2.RequestHandler):
 
   def post(self, id):
     source = self.SOURCE_CLS.get_by_id(id)
-    if source:
+    if not source:
+      return
+
+    try:
+      add_handle_feed_task(source, self.request.body)
+    except (datastore_errors.BadRequestError,
+            apiproxy_errors.RequestTooLargeError):
+      # probably over the 1MB entity size limit. if we return an error,
+      # Superfeedr will retry it forever.
+      logging.warning("Couldn't store %d byte feed, handling it inline",
+                      len(self.request.body), exc_info=True)
       handle_feed(self.request.body, source)
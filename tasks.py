@@ -5,6 +5,7 @@ __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
 import bz2
 import calendar
+import collections
 import datetime
 import gc
 import json
@@ -13,22 +14,27 @@ import random
 
 from google.appengine.api import memcache
 from google.appengine.api.datastore_types import _MAX_STRING_LENGTH
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import webapp2
 from webmentiontools import send
 
+import app
 import appengine_config
 
-from oauth_dropins import handlers
 from granary.source import Source
 # need to import model class definitions since poll creates and saves entities.
+import blog_webmention
 import blogger
 import facebook
 import googleplus
+import handlers
 import instagram
 import models
 from models import Response
 import original_post_discovery
+import publish
+import superfeedr
 import tumblr
 import twitter
 import util
@@ -137,6 +143,19 @@ class Poll(webapp2.RequestHandler):
     source.put()
     return source
 
+  @ndb.transactional
+  def store_rendered(self, key, rendered):
+    """Stores pre-rendered pages in a response without clobbering other changes.
+
+    Args:
+      key: ndb.Key of the Response
+      rendered: dict, pages rendered by handlers.prerender()
+    """
+    resp = key.get()
+    if resp:
+      resp.rendered = rendered
+      resp.put()
+
   def poll(self, source):
     """Actually runs the poll.
 
@@ -150,9 +169,7 @@ class Poll(webapp2.RequestHandler):
     #
     # Step 1: fetch activities
     #
-    cache = util.CacheDict()
-    if source.last_activities_cache_json:
-      cache.update(json.loads(source.last_activities_cache_json))
+    cache = models.ActivityCache.load(source)
 
     try:
       response = source.get_activities_response(
@@ -176,7 +193,6 @@ class Poll(webapp2.RequestHandler):
     logging.info('Found %d activities', len(activities))
 
     # extract silo activity ids, update last_activity_id
-    silo_activity_ids = set()
     last_activity_id = source.last_activity_id
     for activity in activities:
       # extract activity id and maybe replace stored last activity id
@@ -185,7 +201,6 @@ class Poll(webapp2.RequestHandler):
         parsed = util.parse_tag_uri(id)
         if parsed:
           id = parsed[1]
-        silo_activity_ids.add(id)
         try:
           # try numeric comparison first
           greater = int(id) > int(last_activity_id)
@@ -198,11 +213,6 @@ class Poll(webapp2.RequestHandler):
       source_updates['last_activity_id'] = last_activity_id
       logging.debug('Storing new last activity id: %s', last_activity_id)
 
-    # trim cache to just the returned activity ids, so that it doesn't grow
-    # without bound. (WARNING: depends on get_activities_response()'s cache key
-    # format, e.g. 'PREFIX ACTIVITY_ID'!
-    source_updates['last_activities_cache_json'] = json.dumps(
-      {k: v for k, v in cache.items() if k.split()[-1] in silo_activity_ids})
 
     #
     # Step 2: extract responses, store their activities in response['activities']
@@ -288,9 +298,24 @@ class Poll(webapp2.RequestHandler):
         failed=list(too_long))
       if urls_to_activity and len(activities) > 1:
         resp.urls_to_activity=json.dumps(urls_to_activity)
-      resp.get_or_save(source)
+      resp.set_activity_urls(source)
+      saved = resp.get_or_save(source)
+
+      # only render responses that are new or changed, ie that get_or_save()
+      # stored with our response_json. it has already enqueued the propagate
+      # task, so store the pages transactionally.
+      if (source.PRERENDER_RESPONSES and not saved.rendered and
+          saved.response_json == resp.response_json):
+        try:
+          handlers.prerender(source, saved, activities)
+          self.store_rendered(saved.key, saved.rendered)
+        except Exception:
+          logging.warning('Pre-rendering %s failed', id, exc_info=True)
 
-    # update cache
+    # update caches. the activity cache only writes the entries that changed.
+    cache.save()
+    if source.last_activities_cache_json:
+      source_updates['last_activities_cache_json'] = None
     if responses:
       source_updates['seen_responses_cache_json'] = json.dumps(
         responses.values() + unchanged_responses)
@@ -336,51 +361,115 @@ class Poll(webapp2.RequestHandler):
     logging.debug('refetch h-feed found %d new rel=syndication relationships',
                   len(relationships))
 
-    # grab the Responses and see if any of them have a a syndication
-    # url matching one of the newly discovered relationships. We'll
-    # check each response until we've seen all of them or until
-    # the 60s timer runs out.
-    # TODO maybe add a (canonicalized) url field to Response so we can
-    # query by it instead of iterating over all of them
-    for response in (Response.query(Response.source == source.key)
-                     .order(-Response.created)):
-      if response.activity_json:  # handle old entities
-        response.activities_json.append(response.activity_json)
-        response.activity_json = None
-
-      new_orig_urls = set()
-      for activity_json in response.activities_json:
-        activity = json.loads(activity_json)
-        activity_url = activity.get('url') or activity.get('object', {}).get('url')
-        if not activity_url:
-          logging.warning('activity has no url %s', activity_json)
-          continue
+    # grab the Responses that have a syndication url matching one of the newly
+    # discovered relationships. the datastore limits IN queries to 30 values.
+    urls = list(relationships.keys())
+    seen = set()
+    for i in range(0, len(urls), 30):
+      for response in (Response.query(Response.source == source.key,
+                                      Response.activity_urls.IN(urls[i:i + 30]))
+                       .order(-Response.created)):
+        if response.key not in seen:
+          seen.add(response.key)
+          self.repropagate_for_relationships(source, response, relationships)
+
+  def repropagate_for_relationships(self, source, response, relationships):
+    """Adds new original post URLs to a response and repropagates it.
 
-        activity_url = source.canonicalize_syndication_url(activity_url)
-        # look for activity url in the newly discovered list of relationships
-        for relationship in relationships.get(activity_url, []):
-          # won't re-propagate if the discovered link is already among
-          # these well-known upstream duplicates
-          if relationship.original in response.sent:
-            logging.info(
-              '%s found a new rel=syndication link %s -> %s, but the '
-              'relationship had already been discovered by another method',
-              response.label(), relationship.original,
-              relationship.syndication)
-          else:
-            logging.info(
-              '%s found a new rel=syndication link %s -> %s, and '
-              'will be repropagated with a new target!',
-              response.label(), relationship.original,
-              relationship.syndication)
-            new_orig_urls.add(relationship.original)
+    Args:
+      source: Source
+      response: Response
+      relationships: dict mapping canonical syndication URL to list of
+        SyndicatedPost
+    """
+    if response.activity_json:  # handle old entities
+      response.activities_json.append(response.activity_json)
+      response.activity_json = None
+
+    new_orig_urls = set()
+    for activity_json in response.activities_json:
+      activity = json.loads(activity_json)
+      activity_url = activity.get('url') or activity.get('object', {}).get('url')
+      if not activity_url:
+        logging.warning('activity has no url %s', activity_json)
+        continue
+
+      activity_url = source.canonicalize_syndication_url(activity_url)
+      # look for activity url in the newly discovered list of relationships
+      for relationship in relationships.get(activity_url, []):
+        # won't re-propagate if the discovered link is already among
+        # these well-known upstream duplicates
+        if relationship.original in response.sent:
+          logging.info(
+            '%s found a new rel=syndication link %s -> %s, but the '
+            'relationship had already been discovered by another method',
+            response.label(), relationship.original,
+            relationship.syndication)
+        else:
+          logging.info(
+            '%s found a new rel=syndication link %s -> %s, and '
+            'will be repropagated with a new target!',
+            response.label(), relationship.original,
+            relationship.syndication)
+          new_orig_urls.add(relationship.original)
+
+    if new_orig_urls:
+      # re-open a previously 'complete' propagate task
+      response.status = 'new'
+      response.unsent.extend(list(new_orig_urls))
+      response.rendered = None  # stale now
+      response.put()
+      models.StatCounter.increment('links_unsent', len(new_orig_urls))
+      response.invalidate_item_cache(source)
+      response.add_task()
+
+
+class Verify(webapp2.RequestHandler):
+  """Task handler that verifies a source, e.g. discovers its webmention endpoint.
+
+  Request parameters:
+    source_key: string key of source entity
+  """
+
+  def post(self):
+    logging.debug('Params: %s', self.request.params)
+    source = ndb.Key(urlsafe=self.request.params['source_key']).get()
+    if not source:
+      logging.error('Source not found. Dropping task.')
+      return
+    source.verify()
+
+
+class HandleSuperfeedrNotification(webapp2.RequestHandler):
+  """Task handler that processes a stored Superfeedr notification.
+
+  Deletes the notification when it's done, or when the last retry fails, so
+  that it isn't orphaned.
+
+  Request parameters:
+    key: string key of SuperfeedrNotification entity
+  """
+  # must match task_retry_limit for the superfeedr queue in queue.yaml
+  TASK_RETRY_LIMIT = 10
 
-      if new_orig_urls:
-        # re-open a previously 'complete' propagate task
-        response.status = 'new'
-        response.unsent.extend(list(new_orig_urls))
-        response.put()
-        response.add_task()
+  def post(self):
+    logging.debug('Params: %s', self.request.params)
+    key = ndb.Key(urlsafe=self.request.params['key'])
+    notification, source = ndb.get_multi([key, key.parent()])
+    if not notification:
+      logging.warning('Notification not found. Dropping task.')
+      return
+    elif source:
+      try:
+        superfeedr.handle_feed(notification.feed, source)
+      except BaseException:
+        retries = int(self.request.headers.get('X-AppEngine-TaskRetryCount', 0))
+        if retries < self.TASK_RETRY_LIMIT:
+          raise
+        logging.error('Last retry failed. Giving up on %s.', key, exc_info=True)
+    else:
+      logging.error('Source not found. Dropping task.')
+    key.delete()
 
 
 class SendWebmentions(webapp2.RequestHandler):
@@ -388,6 +477,7 @@ class SendWebmentions(webapp2.RequestHandler):
 
   Attributes:
     entity: Webmentions subclass instance (set in lease_entity)
+    link_counts: entity.link_counts() when it was leased (set in lease)
     source: Source entity (set in send_webmentions)
   """
 
@@ -538,6 +628,7 @@ class SendWebmentions(webapp2.RequestHandler):
       self.entity.status = 'processing'
       self.entity.leased_until = now_fn() + self.LEASE_LENGTH
       self.entity.put()
+      self.link_counts = self.entity.link_counts()
       return True
 
   @ndb.transactional
@@ -560,6 +651,8 @@ class SendWebmentions(webapp2.RequestHandler):
     assert self.entity.status == 'processing'
     self.entity.status = 'complete'
     self.entity.put()
+    models.StatCounter.increment_links(self.link_counts,
+                                       self.entity.link_counts())
     return True
 
   @ndb.transactional
@@ -574,6 +667,9 @@ class SendWebmentions(webapp2.RequestHandler):
       self.entity.status = new_status
       self.entity.leased_until = None
       self.entity.put()
+      models.StatCounter.increment_links(self.link_counts,
+                                         self.entity.link_counts())
+      self.link_counts = self.entity.link_counts()
 
   def fail(self, message, level=logging.WARNING):
     """Fills in an error response status code and message.
@@ -640,11 +736,6 @@ class PropagateResponse(SendWebmentions):
     self.send_webmentions()
 
   def source_url(self, target_url):
-    # parse the response id. (we know Response key ids are always tag URIs)
-    _, response_id = util.parse_tag_uri(self.entity.key.string_id())
-    if self.entity.type in ('like', 'repost', 'rsvp'):
-      response_id = response_id.split('_')[-1]
-
     # determine which activity to use
     activity = self.activities[0]
     if self.entity.urls_to_activity:
@@ -660,9 +751,6 @@ activities: %s""", target_url, urls_to_activity, self.activities)
           self.abort(self.ERROR_HTTP_RETURN_CODE)
 
     # generate source URL
-    id = activity['id']
-    parsed = util.parse_tag_uri(id)
-    post_id = parsed[1] if parsed else id
     # prefer brid-gy.appspot.com to brid.gy because non-browsers (ie OpenSSL)
     # currently have problems with brid.gy's SSL cert. details:
     # https://github.com/snarfed/bridgy/issues/20
@@ -672,9 +760,7 @@ activities: %s""", target_url, urls_to_activity, self.activities)
     else:
       host_url = self.request.host_url
 
-    return '%s/%s/%s/%s/%s/%s' % (
-      host_url, self.entity.type, self.entity.source.get().SHORT_NAME,
-      self.entity.source.string_id(), post_id, response_id)
+    return host_url + self.entity.item_path(self.entity.source.get(), activity)
 
 
 class PropagateBlogPost(SendWebmentions):
@@ -703,8 +789,107 @@ class PropagateBlogPost(SendWebmentions):
     return self.entity.key.id()
 
 
+class RefreshCachedPage(webapp2.RequestHandler):
+  """Task handler that re-renders a stale CachedPage.
+
+  Request parameters:
+    path: string, path and query of the page
+  """
+
+  def post(self):
+    path = self.request.params['path']
+    resp = app.application.get_response(
+      path, base_url='https://www.brid.gy',
+      headers={app.CachedPageHandler.REFRESH_HEADER: 'refresh-page'})
+    if resp.status_int != 200:
+      # the page isn't cacheable any more. the lock will expire on its own.
+      logging.warning('Re-rendering %s returned %s', path, resp.status)
+
+
+class SeedStatCounters(webapp2.RequestHandler):
+  """Task handler that seeds the StatCounter baselines by counting entities.
+
+  Run once, right after deploying the counters, via /cron/seed_stat_counters.
+  Each task counts one batch of entities created before the cutoff and passes
+  the running counts to the next task. The last task stores them as the
+  baselines. Links are counted per URL, like StatCounter.increment_links().
+
+  Request parameters:
+    cutoff: integer, POSIX timestamp. Only entities created before it count.
+    batch: integer, this task's sequence number, used to name the next task
+    kind: integer, index into kinds() of the model class to count
+    cursor: string, urlsafe query cursor, optional
+    counts: JSON dict mapping StatCounter name to count so far, optional
+  """
+  BATCH_SIZE = 200
+
+  @staticmethod
+  def kinds():
+    return ([models.sources[name] for name in sorted(models.sources)] +
+            [models.Response, models.BlogPost, models.Publish,
+             models.BlogWebmention])
+
+  def post(self):
+    cutoff = util.get_required_param(self, 'cutoff')
+    batch = int(util.get_required_param(self, 'batch'))
+    kind = int(self.request.get('kind', 0))
+    cursor = self.request.get('cursor')
+    counts = collections.Counter(json.loads(self.request.get('counts', '{}')))
+
+    kinds = self.kinds()
+    cls = kinds[kind]
+    entities, cursor, more = cls.query(
+      cls.created < datetime.datetime.utcfromtimestamp(int(cutoff))
+      ).fetch_page(self.BATCH_SIZE,
+                   start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    for entity in entities:
+      self.count(entity, counts)
+    logging.info('Counted %d %s entities', len(entities), cls.__name__)
+
+    if not more:
+      kind += 1
+      cursor = None
+    if kind < len(kinds):
+      util.add_seed_stat_counters_task({
+        'cutoff': cutoff,
+        'batch': batch + 1,
+        'kind': kind,
+        'cursor': cursor.urlsafe() if cursor else '',
+        'counts': json.dumps(counts),
+        })
+    else:
+      logging.info('Seeding StatCounter baselines: %s', counts)
+      models.StatCounter.set_baselines(counts)
+
+  @staticmethod
+  def count(entity, counts):
+    """Adds an entity to the counts, the same way the StatCounter writers do.
+
+    Args:
+      entity: Source, Webmentions, or Publish
+      counts: collections.Counter, updated in place
+    """
+    if isinstance(entity, models.Source):
+      counts['users'] += 1
+    elif isinstance(entity, models.Webmentions):
+      counts[entity.COUNTER] += 1
+      for state, num in entity.link_counts().items():
+        counts['links_' + state] += num
+    elif entity.status == 'complete':
+      if isinstance(entity, models.BlogWebmention):
+        counts['webmentions_received'] += 1
+      elif entity.type != 'preview':
+        counts['publishes'] += 1
+
+
 application = webapp2.WSGIApplication([
     ('/_ah/queue/poll(-now)?', Poll),
     ('/_ah/queue/propagate', PropagateResponse),
     ('/_ah/queue/propagate-blogpost', PropagateBlogPost),
+    ('/_ah/queue/verify', Verify),
+    ('/_ah/queue/superfeedr', HandleSuperfeedrNotification),
+    ('/_ah/queue/refresh-page', RefreshCachedPage),
+    ('/_ah/queue/seed-stat-counters', SeedStatCounters),
+    ('/_ah/queue/publish', publish.WebmentionTaskHandler),
+    ('/_ah/queue/blog-webmention', blog_webmention.BlogWebmentionTaskHandler),
     ], debug=appengine_config.DEBUG)
@@ -1,5 +1,7 @@
 """Unit tests for app.py.
 """
+import datetime
+import re
 import urllib
 
 from google.appengine.ext import ndb
@@ -8,8 +10,11 @@ import mf2py
 import webapp2
 
 import app
+import appengine_config
+import models
 import testutil
 from testutil import FakeAuthEntity
+import util
 
 
 # this class stands in for a oauth_dropins module
@@ -19,6 +24,50 @@ class FakeOAuthHandlerModule:
 
 class AppTest(testutil.ModelsTest):
 
+  def test_front_page(self):
+    models.StatCounter.increment('users', 1234)
+    models.StatCounter.increment('links_sent', 3)
+    models.StatCounter.increment('links_failed', 2)
+
+    resp = app.application.get_response('/')
+    self.assertEqual(200, resp.status_int)
+    self.assertIn('1,234 users', resp.body)
+    self.assertIn('5 links analyzed', resp.body)
+
+  def test_front_page_serves_stale_and_refreshes(self):
+    self.mox.stubs.Set(appengine_config, 'DEBUG', False)
+    util.CachedPage.store('/', 'old page', expires=datetime.timedelta(days=-1))
+
+    for _ in range(2):
+      resp = app.application.get_response('/', base_url='https://www.brid.gy')
+      self.assertEqual(200, resp.status_int)
+      self.assertEqual('old page', resp.body)
+
+    self.assertEqual(1, len(self.taskqueue_stub.GetTasks('refresh-page')))
+
+  def test_users_page(self):
+    self.sources[0].name = 'zed'
+    self.sources[0].put()
+    self.sources[1].name = 'Amy'
+    self.sources[1].put()
+    self.mox.stubs.Set(app.UsersHandler, 'PAGE_SIZE', 1)
+
+    resp = app.application.get_response('/users')
+    self.assertEqual(200, resp.status_int)
+    self.assertIn('Amy', resp.body)
+    self.assertNotIn('zed', resp.body)
+    cursor = re.search(r'\?cursor=([^"]+)"', resp.body).group(1)
+
+    resp = app.application.get_response('/users?cursor=' + cursor)
+    self.assertEqual(200, resp.status_int)
+    self.assertIn('zed', resp.body)
+    self.assertNotIn('Amy', resp.body)
+    self.assertNotIn('?cursor=', resp.body)
+
+  def test_users_page_bad_cursor(self):
+    resp = app.application.get_response('/users?cursor=foo')
+    self.assertEqual(400, resp.status_int)
+
   def test_poll_now(self):
     self.assertEqual([], self.taskqueue_stub.GetTasks('poll'))
 
@@ -129,6 +178,32 @@ class AppTest(testutil.ModelsTest):
     resp = app.application.get_response(self.sources[0].bridgy_path())
     self.assertEquals(200, resp.status_int)
 
+  def test_user_page_responses(self):
+    self.responses[0].put()
+    self.responses[1].status = 'error'
+    self.responses[1].put()
+
+    resp = app.application.get_response(self.sources[0].bridgy_path())
+    self.assertEquals(200, resp.status_int)
+    self.assertIn('http://source/comment/url', resp.body)
+    self.assertIn('liked this', resp.body)
+    self.assertIn(self.responses[1].key.urlsafe(), resp.body)
+
+  def test_user_page_adds_verify_task(self):
+    self.sources[0].domain_urls = ['http://primary/']
+    self.sources[0].domains = ['primary']
+    self.sources[0].put()
+
+    # the page shouldn't fetch the user's site itself
+    for _ in range(2):
+      resp = app.application.get_response(self.sources[0].bridgy_path())
+      self.assertEquals(200, resp.status_int)
+
+    tasks = self.taskqueue_stub.GetTasks('verify')
+    self.assertEqual(1, len(tasks))
+    self.assertEqual(self.sources[0].key.urlsafe(),
+                     testutil.get_task_params(tasks[0])['source_key'])
+
   def test_user_page_with_no_features_404s(self):
     self.sources[0].features = []
     self.sources[0].put()
@@ -10,6 +10,7 @@ import urllib
 import appengine_config
 
 import mox
+import webapp2
 from webob import exc
 
 import blog_webmention
@@ -347,3 +348,63 @@ i hereby mention
     self.assertIsNotNone(models.sources['blogger'])
     self.assertIsNotNone(models.sources['tumblr'])
     self.assertIsNotNone(models.sources['wordpress'])
+
+  def post_async(self, target='http://foo.com/post/1'):
+    return blog_webmention.application.get_response(
+      '/webmention/fake', method='POST', headers={'Prefer': 'respond-async'},
+      body='source=http://bar.com/reply&target=' + target)
+
+  def run_task(self):
+    tasks = self.taskqueue_stub.GetTasks('blog-webmention')
+    self.assertEqual(1, len(tasks))
+    app = webapp2.WSGIApplication([('.*', blog_webmention.BlogWebmentionTaskHandler)])
+    return app.get_response('/_ah/queue/blog-webmention', method='POST',
+                            body=urllib.urlencode(testutil.get_task_params(tasks[0])))
+
+  def test_async(self):
+    self.expect_mention().AndReturn({'id': 'fake id'})
+    self.mox.ReplayAll()
+
+    resp = self.post_async()
+    self.assertEquals(202, resp.status_int, resp.body)
+    bw = BlogWebmention.get_by_id('http://bar.com/reply http://foo.com/post/1')
+    self.assertEquals('new', bw.status)
+    self.assertEquals(self.source.key, bw.source)
+
+    resp = self.run_task()
+    self.assertEquals(200, resp.status_int, resp.body)
+    bw = bw.key.get()
+    self.assertEquals('complete', bw.status)
+    self.assertEquals({'id': 'fake id'}, bw.published)
+
+  def test_async_target_redirects(self):
+    self.expect_requests_head('http://foo.com/post/1',
+                              redirected_url='http://foo.com/post/final')
+    self.expect_requests_get('http://bar.com/reply', """\
+<article class="h-entry"><p class="e-content">http://foo.com/post/1</p></article>""")
+    testutil.FakeSource.create_comment(
+      'http://foo.com/post/final', 'foo.com', 'http://foo.com/', mox.IgnoreArg())
+    self.mox.ReplayAll()
+
+    self.assertEquals(202, self.post_async().status_int)
+    self.assertEquals(200, self.run_task().status_int)
+    self.assertIsNone(
+      BlogWebmention.get_by_id('http://bar.com/reply http://foo.com/post/1'))
+    bw = BlogWebmention.get_by_id('http://bar.com/reply http://foo.com/post/final')
+    self.assertEquals('complete', bw.status)
+
+  def test_async_permanent_error_not_retried(self):
+    self.expect_requests_get('http://bar.com/reply', 'no mention here')
+    self.mox.ReplayAll()
+
+    self.assertEquals(202, self.post_async().status_int)
+    self.assertEquals(200, self.run_task().status_int)
+    bw = BlogWebmention.get_by_id('http://bar.com/reply http://foo.com/post/1')
+    self.assertEquals('failed', bw.status)
+
+  def test_async_unknown_domain_processes_inline(self):
+    resp = self.post_async(target='http://unknown/post')
+    self.assertEquals(400, resp.status_int)
+    self.assertIn('Could not find FakeSource account for unknown',
+                  json.loads(resp.body)['error'])
+    self.assertEquals([], self.taskqueue_stub.GetTasks('blog-webmention'))
@@ -16,6 +16,7 @@ from gdata.client import RequestError
 from oauth_dropins.blogger_v2 import BloggerV2Auth
 
 import blogger
+from models import CachedPostId
 from blogger import Blogger
 import util
 import testutil
@@ -138,6 +139,32 @@ class BloggerTest(testutil.HandlerTest):
     # the key point is that create_comment doesn't raise an exception
     self.assert_equals({'error': '500, Internal error: bX-2i87au'}, resp)
 
+  def test_create_comment_caches_post_id(self):
+    self.expect_get_posts()
+    self.client.add_comment('111', '222', mox.IgnoreArg()
+                            ).MultipleTimes().AndReturn(self.comment)
+    self.mox.ReplayAll()
+
+    b = Blogger.new(self.handler, auth_entity=self.auth_entity)
+    for i in range(2):
+      b.create_comment('http://blawg/path/to/post', 'who', 'http://who',
+                       'foo bar', client=self.client)
+    self.assertEquals('222', CachedPostId.get_by_id(
+      '/path/to/post', parent=b.key).post_id)
+
+  def test_create_comment_post_gone_invalidates_cache(self):
+    b = Blogger.new(self.handler, auth_entity=self.auth_entity)
+    CachedPostId(id='/path/to/post', parent=b.key, post_id='222').put()
+
+    err = RequestError('404, Not Found')
+    err.status = 404
+    self.client.add_comment('111', '222', mox.IgnoreArg()).AndRaise(err)
+    self.mox.ReplayAll()
+
+    self.assertRaises(RequestError, b.create_comment, 'http://blawg/path/to/post',
+                      'who', 'http://who', 'foo bar', client=self.client)
+    self.assertIsNone(CachedPostId.get_by_id('/path/to/post', parent=b.key))
+
   def test_feed_url(self):
     self.assertEquals(
       'http://my.blawg/feeds/posts/default',
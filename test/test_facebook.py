@@ -19,11 +19,14 @@ import oauth_dropins
 from oauth_dropins import facebook as oauth_facebook
 import webapp2
 
+from google.appengine.api import memcache
+
 import facebook
 from facebook import FacebookPage
 import models
 import tasks
 import testutil
+import util
 
 
 class FacebookPageTest(testutil.ModelsTest):
@@ -108,6 +111,94 @@ class FacebookPageTest(testutil.ModelsTest):
     self.assert_equals([self.post_activity, gr_test_facebook.ACTIVITY, event_activity],
                        self.fb.get_activities())
 
+  def test_get_activities_skips_rsvps_for_unchanged_events(self):
+    event = copy.deepcopy(gr_test_facebook.EVENT)
+    event.update({'id': '888', 'updated_time': '2015-06-01T12:34:56+0000',
+                  'attending_count': 1})
+    event['owner']['id'] = '212038'
+
+    for poll in range(2):
+      self.expect_urlopen(
+        'https://graph.facebook.com/v2.2/me/feed?offset=0&access_token=my_token',
+        json.dumps({'data': []}))
+      self.expect_urlopen(
+        'https://graph.facebook.com/v2.2/me/photos/uploaded?access_token=my_token',
+        json.dumps({'data': []}))
+      self.expect_urlopen(
+        'https://graph.facebook.com/v2.2/me/events?access_token=my_token',
+        json.dumps({'data': [event]}))
+      self.expect_urlopen(re.compile('^https://graph.facebook.com/v2.2/888\?.+'),
+                          json.dumps(event))
+      if poll == 0:
+        # RSVPs are paginated. we should follow the after cursor.
+        self.expect_urlopen(
+          'https://graph.facebook.com/v2.2/888/invited?access_token=my_token',
+          json.dumps({'data': gr_test_facebook.RSVPS[:1],
+                      'paging': {'cursors': {'after': 'xyz'}, 'next': 'http://x'}}))
+        self.expect_urlopen(
+          'https://graph.facebook.com/v2.2/888/invited?after=xyz&access_token=my_token',
+          json.dumps({'data': gr_test_facebook.RSVPS[1:]}))
+    self.mox.ReplayAll()
+
+    with_rsvps = self.fb.gr_source.event_to_activity(event)
+    for k in 'attending', 'notAttending', 'maybeAttending', 'invited':
+      with_rsvps['object'][k] = gr_test_facebook.EVENT_OBJ_WITH_ATTENDEES[k]
+
+    cache = util.CacheDict()
+    self.assert_equals([with_rsvps], self.fb.get_activities(cache=cache))
+    self.assert_equals([self.fb.gr_source.event_to_activity(event)],
+                       self.fb.get_activities(cache=cache))
+
+  def test_get_activities_uses_etags_for_extra_calls(self):
+    cache = util.CacheDict({'FETAG me/photos/uploaded': '"photos etag"',
+                            'FETAG me/events': '"events etag"'})
+    memcache.set('FEDATA 212038 me/photos/uploaded',
+                 {'etag': '"photos etag"', 'data': {'data': [gr_test_facebook.POST]}})
+    memcache.set('FEDATA 212038 me/events',
+                 {'etag': '"events etag"', 'data': {}})
+
+    self.expect_urlopen(
+      'https://graph.facebook.com/v2.2/me/feed?offset=0&access_token=my_token',
+      json.dumps({'data': []}))
+    self.expect_urlopen(
+      'https://graph.facebook.com/v2.2/me/photos/uploaded?access_token=my_token',
+      '', status=304, headers={'If-None-Match': '"photos etag"'})
+    self.expect_urlopen(
+      'https://graph.facebook.com/v2.2/me/events?access_token=my_token',
+      '', status=304, headers={'If-None-Match': '"events etag"'})
+    self.mox.ReplayAll()
+
+    self.assert_equals([gr_test_facebook.ACTIVITY],
+                       self.fb.get_activities(cache=cache))
+    self.assertEquals('"photos etag"', cache['FETAG me/photos/uploaded'])
+
+  def test_event_to_activity_uses_etags_for_rsvps(self):
+    event = copy.deepcopy(gr_test_facebook.EVENT)
+    event['id'] = '888'
+    cache = util.CacheDict({'FETAG 888/invited': '"rsvps etag"'})
+    memcache.set('FEDATA 212038 888/invited',
+                 {'etag': '"rsvps etag"', 'data': {'data': gr_test_facebook.RSVPS}})
+
+    self.expect_urlopen(
+      'https://graph.facebook.com/v2.2/888/invited?access_token=my_token',
+      '', status=304, headers={'If-None-Match': '"rsvps etag"'})
+    self.mox.ReplayAll()
+
+    expected = self.fb.gr_source.event_to_activity(event)
+    for k in 'attending', 'notAttending', 'maybeAttending', 'invited':
+      expected['object'][k] = gr_test_facebook.EVENT_OBJ_WITH_ATTENDEES[k]
+    self.assert_equals(expected, self.fb.event_to_activity(event, cache=cache))
+
+  def test_urlopen_drops_etag_without_cached_response(self):
+    cache = util.CacheDict({'FETAG me/events': '"events etag"'})
+    self.expect_urlopen('https://graph.facebook.com/v2.2/me/events?access_token=my_token',
+                        json.dumps({'data': []}))
+    self.mox.ReplayAll()
+
+    self.assertEquals({'data': []}, self.fb.urlopen(facebook.API_USER_RSVPS,
+                                                    cache=cache))
+    self.assertNotIn('FETAG me/events', cache)
+
   def test_get_activities_post_and_photo_duplicates(self):
     self.assertEqual(gr_test_facebook.POST['object_id'],
                      gr_test_facebook.PHOTO['id'])
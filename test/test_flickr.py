@@ -6,6 +6,9 @@ __author__ = ['Kyle Mahan <kyle@kylewm.com>']
 import json
 import urllib
 
+import mox
+from google.appengine.ext import ndb
+
 import appengine_config
 import flickr
 import granary
@@ -14,6 +17,7 @@ import models
 import oauth_dropins
 import tasks
 import testutil
+import util
 
 
 class FlickrTest(testutil.ModelsTest):
@@ -48,7 +52,7 @@ class FlickrTest(testutil.ModelsTest):
     disable it as a source.
     """
     self.expect_call_api_method('flickr.people.getPhotos', {
-      'extras': granary.flickr.Flickr.API_EXTRAS,
+      'extras': flickr.API_EXTRAS,
       'per_page': 50,
       'user_id': 'me',
     }, json.dumps({
@@ -61,3 +65,55 @@ class FlickrTest(testutil.ModelsTest):
     with self.assertRaises(models.DisableSource):
       poll_task = tasks.Poll()
       poll_task.poll(self.flickr)
+
+  def test_get_activities_response_watermarks(self):
+    """Photos and counts come from one call. Only photos whose comment or fave
+    counts changed get their comments and faves fetched."""
+    gr = self.flickr.gr_source
+    self.mox.StubOutWithMock(gr, 'call_api_method')
+    self.mox.StubOutWithMock(gr, 'comment_to_object')
+    self.mox.StubOutWithMock(gr, 'like_to_object')
+
+    photos = [{'id': '1', 'count_comments': '1', 'count_faves': '1'},
+              {'id': '2', 'count_comments': '0', 'count_faves': '3'}]
+    gr.call_api_method('flickr.people.getPhotos', {
+      'user_id': 'me',
+      'extras': flickr.API_EXTRAS,
+      'per_page': 50,
+    }).AndReturn({'photos': {'photo': photos}})
+
+    comment = {'id': 'c'}
+    gr.call_api_method('flickr.photos.comments.getList', {'photo_id': '1'}
+                       ).AndReturn({'comments': {'comment': [comment]}})
+    gr.comment_to_object(comment, '1').AndReturn({'id': 'reply'})
+    person = {'nsid': 'p'}
+    gr.call_api_method('flickr.photos.getFavorites', {'photo_id': '1'}
+                       ).AndReturn({'photo': {'person': [person]}})
+    gr.like_to_object(person, mox.IgnoreArg()).AndReturn({'id': 'like'})
+    self.mox.ReplayAll()
+
+    models.ActivityCacheEntry(id='AW 2', parent=self.flickr.key,
+                              value=['0', '3']).put()
+    cache = models.ActivityCache(self.flickr)
+
+    # all of the watermarks should be looked up at once
+    get_multi = ndb.get_multi
+    calls = []
+    def count_get_multi(keys, **kwargs):
+      calls.append(keys)
+      return get_multi(keys, **kwargs)
+    self.mox.stubs.Set(ndb, 'get_multi', count_get_multi)
+
+    resp = self.flickr.get_activities_response(
+      fetch_replies=True, fetch_likes=True, fetch_shares=True, count=50,
+      min_id='1', cache=cache)
+
+    # photo 2's counts haven't changed, so it has no comments or faves
+    self.assertEqual(util.trim_nulls(gr.photo_to_activity(photos[1])),
+                     resp['items'][1])
+    obj = resp['items'][0]['object']
+    self.assertEqual({'items': [{'id': 'reply'}], 'totalItems': 1},
+                     obj['replies'])
+    self.assertIn({'id': 'like'}, obj['tags'])
+    self.assertEqual(['1', '1'], cache['AW 1'])
+    self.assertEqual(1, len(calls))
@@ -2,13 +2,16 @@
 """
 
 import json
+import mox
 import StringIO
 import urllib2
 
+import requests
 
 import handlers
 import models
 import testutil
+import util
 
 
 class HandlersTest(testutil.HandlerTest):
@@ -165,6 +168,172 @@ class HandlersTest(testutil.HandlerTest):
 </article>
 """)
 
+  def test_comment_from_datastore(self):
+    """A stored Response should be used instead of fetching from the silo."""
+    models.Response(
+      id='tag:fa.ke,2013:a1-b2.c3',
+      source=self.source.key,
+      response_json=json.dumps({
+        'id': 'tag:fa.ke,2013:a1-b2.c3',
+        'content': 'qwert',
+        'inReplyTo': [{'url': 'http://fa.ke/000'}],
+        'author': {'image': {'url': 'http://example.com/ryan/image'}},
+      }),
+      activities_json=[json.dumps({
+        'id': 'tag:fa.ke,2013:000',
+        'url': 'http://fa.ke/000',
+        'content': 'asdf http://other/link qwert',
+        'object': {
+          'tags': [{'objectType': 'article', 'url': 'http://other/link'}],
+          'upstreamDuplicates': ['http://or.ig/post'],
+        },
+      })],
+      sent=['http://or.ig/post', 'http://other/link'],
+    ).put()
+    # the silo shouldn't be called
+    self.source.set_activities([])
+
+    self.check_response('/comment/fake/%s/000/a1-b2.c3', """\
+<article class="h-entry">
+<span class="u-uid">tag:fa.ke,2013:a1-b2.c3</span>
+
+  <div class="h-card p-author">
+
+    <img class="u-photo" src="https://example.com/ryan/image" alt="" />
+  </div>
+
+  <div class="e-content p-name">
+
+  qwert
+  <a class="u-mention" href="http://other/link"></a>
+  </div>
+
+<a class="u-in-reply-to" href="http://fa.ke/000"></a>
+<a class="u-in-reply-to" href="http://or.ig/post"></a>
+
+</article>
+""")
+
+
+  def test_comment_from_datastore_without_original_post_urls(self):
+    """Stored activities without original post URLs fall back to the silo."""
+    models.Response(
+      id='tag:fa.ke,2013:a1-b2.c3',
+      source=self.source.key,
+      response_json=json.dumps({
+        'id': 'tag:fa.ke,2013:a1-b2.c3',
+        'inReplyTo': [{'url': 'http://fa.ke/000'}],
+      }),
+      activities_json=[json.dumps({
+        'id': 'tag:fa.ke,2013:000',
+        'url': 'http://fa.ke/000',
+        'content': 'asdf http://other/link qwert',
+      })],
+      sent=['http://or.ig/post', 'http://other/link'],
+    ).put()
+
+    resp = handlers.application.get_response(
+      '/comment/fake/%s/000/a1-b2.c3' % self.source.key.string_id())
+    self.assertEqual(200, resp.status_int, resp.body)
+    self.assertIn('<a class="u-in-reply-to" href="http://or.ig/post"></a>',
+                  resp.body)
+
+  def test_cache(self):
+    comment = {
+      'id': 'tag:fa.ke,2013:a1',
+      'content': 'qwert',
+      'inReplyTo': [{'url': 'http://fa.ke/000'}],
+    }
+    self.source.set_comment(comment)
+    path = '/comment/fake/%s/000/a1' % self.source.key.string_id()
+    first = handlers.application.get_response(path)
+    self.assertEqual(200, first.status_int)
+    self.assertIn('qwert', first.body)
+
+    # should serve from cache
+    comment['content'] = 'changed'
+    self.source.set_comment(comment)
+    resp = handlers.application.get_response(path)
+    self.assertEqual(first.body, resp.body)
+
+    # each format is cached separately
+    resp = handlers.application.get_response(path + '?format=json')
+    self.assertIn('changed', resp.body)
+
+    util.item_page_cache.delete_multi([path])
+    resp = handlers.application.get_response(path)
+    self.assertIn('changed', resp.body)
+
+  def test_post_cache_time(self):
+    self.mox.StubOutWithMock(util.item_page_cache, 'set')
+    util.item_page_cache.set(
+      '/post/fake/%s/000' % self.source.key.string_id(), mox.IgnoreArg(),
+      memcache_ttl=handlers.PostHandler.CACHE_TIME)
+    self.mox.ReplayAll()
+
+    resp = handlers.application.get_response(
+      '/post/fake/%s/000' % self.source.key.string_id())
+    self.assertEqual(200, resp.status_int)
+
+  def test_etag_and_not_modified(self):
+    self.source.set_comment({
+      'id': 'tag:fa.ke,2013:a1',
+      'content': 'qwert',
+      'inReplyTo': [{'url': 'http://fa.ke/000'}],
+    })
+    path = '/comment/fake/%s/000/a1' % self.source.key.string_id()
+    first = handlers.application.get_response(path)
+    self.assertEqual(200, first.status_int)
+    etag = first.headers['ETag']
+    self.assertTrue(etag)
+
+    # the silo shouldn't be called
+    self.source.set_comment(None)
+    resp = handlers.application.get_response(
+      path, headers={'If-None-Match': etag})
+    self.assertEqual(304, resp.status_int)
+    self.assertEqual('', resp.body)
+    self.assertEqual(etag, resp.headers['ETag'])
+
+    resp = handlers.application.get_response(
+      path, headers={'If-None-Match': '"other"'})
+    self.assertEqual(200, resp.status_int)
+    self.assertEqual(first.body, resp.body)
+
+  def test_last_modified_from_stored_response(self):
+    resp = models.Response(
+      id='tag:fa.ke,2013:a1',
+      source=self.source.key,
+      response_json=json.dumps({'id': 'tag:fa.ke,2013:a1', 'content': 'qwert'}),
+      activities_json=[json.dumps({'id': 'tag:fa.ke,2013:000',
+                                   'url': 'http://fa.ke/000'})])
+    resp.put()
+
+    got = handlers.application.get_response(
+      '/comment/fake/%s/000/a1' % self.source.key.string_id())
+    self.assertEqual(200, got.status_int)
+    self.assertEqual(resp.updated.replace(microsecond=0, tzinfo=None),
+                     got.last_modified.replace(tzinfo=None))
+
+  def test_prerendered(self):
+    models.Response(
+      id='tag:fa.ke,2013:a1',
+      source=self.source.key,
+      response_json=json.dumps({'id': 'tag:fa.ke,2013:a1', 'content': 'qwert'}),
+      activities_json=[json.dumps({'id': 'tag:fa.ke,2013:000'})],
+      rendered={'000': {'html': 'pre-rendered html'}},
+    ).put()
+    path = '/comment/fake/%s/000/a1' % self.source.key.string_id()
+
+    resp = handlers.application.get_response(path, scheme='https')
+    self.assertEqual(200, resp.status_int)
+    self.assertEqual('pre-rendered html', resp.body)
+
+    # only rendered for https
+    resp = handlers.application.get_response(path, scheme='http')
+    self.assertEqual(200, resp.status_int)
+    self.assertIn('qwert', resp.body)
+
   def test_like(self):
     self.source.gr_source.set_like({
         'objectType': 'activity',
@@ -323,11 +492,16 @@ class HandlersTest(testutil.HandlerTest):
         'verb': 'share',
         })
 
-    self.expect_requests_head('http://or.ig/post',
-                              redirected_url='http://or.ig/post/redirect')
-    self.expect_requests_head('http://other/link',
-                              redirected_url='http://other/link/redirect')
-    self.mox.ReplayAll()
+    # the URLs are resolved concurrently, so don't depend on request order
+    redirects = {'http://or.ig/post': 'http://or.ig/post/redirect',
+                 'http://other/link': 'http://other/link/redirect'}
+    def fake_head(url, **kwargs):
+      resp = requests.Response()
+      resp.url = redirects.get(url, url)
+      resp.headers['content-type'] = 'text/html; charset=UTF-8'
+      resp.status_code = 200
+      return resp
+    self.mox.stubs.Set(requests, 'head', fake_head)
 
     self.check_response('/repost/fake/%s/000/111', """\
 <article class="h-entry h-as-repost">
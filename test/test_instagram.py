@@ -10,6 +10,7 @@ from oauth_dropins import instagram as oauth_instagram
 
 from instagram import Instagram
 import testutil
+import util
 
 
 class InstagramTest(testutil.ModelsTest):
@@ -45,6 +46,36 @@ class InstagramTest(testutil.ModelsTest):
     self.mox.ReplayAll()
     assert inst.get_activities_response(min_id='123')
 
+  def test_get_activities_response_watermarks(self):
+    """Only media whose comment or like counts changed get their comments and
+    likes fetched."""
+    inst = Instagram.new(self.handler, auth_entity=self.auth_entity)
+    media = [
+      {'id': '1', 'link': 'http://instagram.com/p/1/',
+       'comments': {'count': 1, 'data': []}, 'likes': {'count': 0, 'data': []}},
+      {'id': '2', 'link': 'http://instagram.com/p/2/',
+       'comments': {'count': 0, 'data': []}, 'likes': {'count': 3, 'data': []}},
+    ]
+    self.expect_urlopen(
+      'https://api.instagram.com/v1/users/self/media/recent?count=20&access_token=my_token',
+      json.dumps({'data': media}))
+    self.expect_urlopen(
+      'https://api.instagram.com/v1/media/1/comments?access_token=my_token',
+      json.dumps({'data': [{'id': '9', 'text': 'foo', 'from': {'id': '5'}}]}))
+    self.expect_urlopen(
+      'https://api.instagram.com/v1/media/1/likes?access_token=my_token',
+      json.dumps({'data': []}))
+    self.mox.ReplayAll()
+
+    cache = util.CacheDict({'AW 2': [0, 3]})
+    resp = inst.get_activities_response(fetch_replies=True, fetch_likes=True,
+                                        count=20, cache=cache)
+    self.assertEqual(['1', '2'], [a['object']['id'].split(':')[-1]
+                                  for a in resp['items']])
+    self.assertEqual(1, len(resp['items'][0]['object']['replies']['items']))
+    self.assertEqual([1, 0], cache['AW 1'])
+    self.assertEqual([0, 3], cache['AW 2'])
+
   def test_canonicalize_syndication_url(self):
     inst = Instagram.new(self.handler, auth_entity=self.auth_entity)
 
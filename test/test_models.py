@@ -10,6 +10,7 @@ import json
 
 from granary import source as gr_source
 import mox
+from google.appengine.ext import ndb
 
 import blogger
 import facebook
@@ -21,6 +22,7 @@ import superfeedr
 import testutil
 import tumblr
 import twitter
+import util
 import wordpress_rest
 from testutil import FakeSource
 
@@ -117,6 +119,40 @@ class ResponseTest(testutil.ModelsTest):
     self.assertEqual('complete', saved.status)
     self.assert_no_propagate_task()
 
+  def test_set_activity_urls(self):
+    resp = Response(activities_json=[
+      json.dumps({'url': 'http://www.source/post/url'}),
+      json.dumps({'object': {'url': 'http://source/post/url'}}),
+      json.dumps({'object': {'url': 'https://source/other'}}),
+      json.dumps({'id': 'no url'}),
+    ])
+    resp.set_activity_urls(self.sources[0])
+    self.assertEqual(['https://source/post/url', 'https://source/other'],
+                     resp.activity_urls)
+
+  def test_summary(self):
+    resp = self.responses[1]  # like
+    resp.error = ['http://target1/post/url']
+    resp.put()
+
+    summary = models.ResponseSummary.query(ancestor=resp.key).get()
+    self.assertEqual(resp.key, summary.response_key)
+    self.assertEqual(resp.source, summary.source)
+    self.assertEqual(resp.updated, summary.updated)
+    self.assertEqual('like', summary.type)
+    self.assertTrue(summary.public)
+    self.assertEqual(' liked this.', summary.response['content'])
+    self.assertEqual([{'url': 'http://source/post/url',
+                       'content': 'foo http://target1/post/url bar'}],
+                     summary.activities)
+    self.assertEqual(['http://target1/post/url'], summary.error)
+
+    # non-public
+    resp.response_json = json.dumps({'to': [{'objectType': 'group',
+                                             'alias': '@private'}]})
+    resp.put()
+    self.assertFalse(models.ResponseSummary.query(ancestor=resp.key).get().public)
+
   def test_get_type(self):
     self.assertEqual('repost', Response.get_type(
         {'objectType': 'activity', 'verb': 'share'}))
@@ -362,6 +398,78 @@ class SourceTest(testutil.HandlerTest):
     self.assert_equals(comment_obj, source.get_comment('123'))
 
 
+class GetByDomainTest(testutil.ModelsTest):
+
+  def test_get_by_domain(self):
+    self.sources[0].domains = ['foo.com']
+    self.sources[0].put()
+    self.assert_entities_equal([self.sources[0]],
+                               FakeSource.get_by_domain('foo.com'))
+    self.assertEqual([], FakeSource.get_by_domain('bar.com'))
+
+    # now cached, no more queries
+    self.mox.StubOutWithMock(FakeSource, 'query')
+    self.mox.ReplayAll()
+    self.assert_entities_equal([self.sources[0]],
+                               FakeSource.get_by_domain('foo.com'))
+    self.assertEqual([], FakeSource.get_by_domain('bar.com'))
+
+  def test_put_invalidates(self):
+    self.assertEqual([], FakeSource.get_by_domain('foo.com'))
+    self.sources[1].domains = ['foo.com']
+    self.sources[1].put()
+    self.assert_entities_equal([self.sources[1]],
+                               FakeSource.get_by_domain('foo.com'))
+
+    # removed domains are filtered out even though they're still cached
+    self.sources[1].domains = []
+    self.sources[1].put()
+    self.assertEqual([], FakeSource.get_by_domain('foo.com'))
+
+  def test_put_only_invalidates_when_domains_features_or_status_change(self):
+    self.sources[0].domains = ['foo.com']
+    self.sources[0].put()
+    source = self.sources[0].key.get()
+
+    self.mox.StubOutWithMock(models.domain_sources_cache, 'delete_multi')
+    models.domain_sources_cache.delete_multi(['FakeSource foo.com'])
+    self.mox.ReplayAll()
+
+    source.name = 'changed'
+    source.put()
+    source.status = 'disabled'
+    source.put()
+
+
+class SourceListingTest(testutil.ModelsTest):
+
+  def test_put_hook(self):
+    self.sources[0].name = 'Foo Bar'
+    self.sources[0].put()
+    listing = models.SourceListing.from_source(self.sources[0]).key.get()
+    self.assertTrue(listing.listed)
+    self.assertEqual('foo bar', listing.name_lower)
+
+    self.sources[0].features = []
+    self.sources[0].put()
+    self.assertFalse(listing.key.get().listed)
+
+  def test_put_hook_invalidates_users_pages(self):
+    for path in '/', '/users', '/users?cursor=abc':
+      util.CachedPage.store(path, 'x')
+
+    self.sources[0].name = 'changed'
+    self.sources[0].put()
+    self.assertIsNotNone(util.CachedPage.load('/'))
+    self.assertIsNone(util.CachedPage.load('/users'))
+    self.assertIsNone(util.CachedPage.load('/users?cursor=abc'))
+
+    # unchanged listing doesn't invalidate
+    util.CachedPage.store('/users', 'x')
+    self.sources[0].put()
+    self.assertIsNotNone(util.CachedPage.load('/users'))
+
+
 class BlogPostTest(testutil.ModelsTest):
 
   def test_label(self):
@@ -375,6 +483,20 @@ class BlogPostTest(testutil.ModelsTest):
     self.assertEquals('BlogPost x http://perma/link', bp.label())
 
 
+class CachedPostIdTest(testutil.ModelsTest):
+
+  def test_long_name(self):
+    source = self.sources[0]
+    name = u'http://foo.com/' + u'\u2603' * 200  # 600+ bytes of UTF-8
+    self.assertEquals('123', models.CachedPostId.get_or_fetch(
+      source, name, lambda: 123))
+    self.assertEquals('123', models.CachedPostId.get_or_fetch(
+      source, name, lambda: self.fail('should be cached')))
+
+    models.CachedPostId.invalidate(source, name)
+    self.assertEquals([], models.CachedPostId.query().fetch())
+
+
 class SyndicatedPostTest(testutil.ModelsTest):
 
   def setUp(self):
@@ -505,3 +627,118 @@ class SyndicatedPostTest(testutil.ModelsTest):
     ).fetch()
 
     self.assertEqual(1, len(rs))
+
+
+class ActivityCacheTest(testutil.ModelsTest):
+
+  def setUp(self):
+    super(ActivityCacheTest, self).setUp()
+    self.source = self.sources[0]
+    for key, val in ('AR 1', 2), ('AL 1', 3), ('AR 2', 0):
+      models.ActivityCacheEntry(id=key, parent=self.source.key, value=val).put()
+
+  def entries(self):
+    return {e.key.string_id(): e.value for e in
+            models.ActivityCacheEntry.query(ancestor=self.source.key)}
+
+  def test_load_and_save_only_changed(self):
+    cache = models.ActivityCache.load(self.source)
+    self.assertEqual({'AR 1': 2, 'AL 1': 3}, cache.get_multi(['AR 1', 'AL 1', 'X']))
+
+    cache['AR 1'] = 2
+    cache.set_multi({'AL 1': 4, 'AS 3': 5})
+    self.assertEqual(set(['AL 1', 'AS 3']), cache.dirty)
+
+    cache.save()
+    self.assertEqual({'AR 1': 2, 'AL 1': 4, 'AR 2': 0, 'AS 3': 5},
+                     self.entries())
+    self.assertEqual(set(), cache.dirty)
+
+  def test_only_fetches_keys_used(self):
+    cache = models.ActivityCache.load(self.source)
+    self.assertEqual({}, dict(cache))
+    self.assertEqual(2, cache.get('AR 1'))
+    self.assertIn('AL 1', cache)
+    self.assertEqual({'AR 1': 2, 'AL 1': 3}, dict(cache))
+
+  def test_delete(self):
+    cache = models.ActivityCache.load(self.source)
+    del cache['AR 1']
+    cache.save()
+    self.assertNotIn('AR 1', self.entries())
+
+  def test_migrates_legacy_json(self):
+    self.source.last_activities_cache_json = json.dumps({'AL 5': 6})
+    cache = models.ActivityCache.load(self.source)
+    self.assertEqual(6, cache['AL 5'])
+    self.assertEqual(set(['AL 5']), cache.dirty)
+
+  def test_touches_old_entries_that_are_read(self):
+    old = datetime.datetime.now() - datetime.timedelta(days=2)
+    self.mox.stubs.Set(models.ActivityCacheEntry.updated, '_now', lambda: old)
+    models.ActivityCacheEntry(id='AW 1', parent=self.source.key, value=1).put()
+    self.mox.stubs.UnsetAll()
+
+    cache = models.ActivityCache.load(self.source)
+    self.assertEqual(1, cache['AW 1'])
+    self.assertEqual(set(['AW 1']), cache.touch)
+    cache.save()
+    entry = models.ActivityCacheEntry.get_by_id('AW 1', parent=self.source.key)
+    self.assertGreater(entry.updated, old)
+
+  def test_evicts_by_count(self):
+    cache = models.ActivityCache.load(self.source)
+    cache.MAX_ENTRIES = 2
+    cache['AS 3'] = 5
+    cache.save()
+    cache.evict()
+    entries = self.entries()
+    self.assertEqual(2, len(entries))
+    self.assertEqual(5, entries['AS 3'])
+
+  def test_evicts_by_age(self):
+    cache = models.ActivityCache.load(self.source)
+    cache.MAX_AGE = datetime.timedelta(0)
+    cache.evict()
+    self.assertEqual({}, self.entries())
+
+  def test_ignores_other_versions(self):
+    models.ActivityCacheEntry(id='AR 4', parent=self.source.key, value=1,
+                              version=0).put()
+    cache = models.ActivityCache.load(self.source)
+    self.assertNotIn('AR 4', cache)
+
+
+class StatCounterTest(testutil.ModelsTest):
+
+  def test_increment_and_totals(self):
+    models.StatCounter.increment('users')
+    models.StatCounter.increment('users', 2)
+    models.StatCounter.increment_links({'unsent': 3}, {'unsent': 1, 'sent': 2})
+
+    totals = models.StatCounter.totals()
+    self.assertEqual(3, totals['users'])
+    self.assertEqual(2, totals['links_sent'])
+    self.assertEqual(-2, totals['links_unsent'])
+    self.assertEqual(0, totals['publishes'])
+
+    models.StatCounter.set_baselines({'users': 10, 'links_sent': 5})
+    totals = models.StatCounter.totals()
+    self.assertEqual(13, totals['users'])
+    self.assertEqual(7, totals['links_sent'])
+    self.assertEqual(0, totals['publishes'])
+
+  def test_increment_waits_for_transaction(self):
+    @ndb.transactional
+    def increment():
+      models.StatCounter.increment('responses')
+      self.assertEqual([], models.StatCounter.query().fetch())
+
+    increment()
+    self.assertEqual(1, models.StatCounter.totals()['responses'])
+
+  def test_new_response_increments_counters(self):
+    self.responses[0].get_or_save(self.sources[0])
+    totals = models.StatCounter.totals()
+    self.assertEqual(1, totals['responses'])
+    self.assertEqual(1, totals['links_unsent'])
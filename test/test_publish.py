@@ -11,6 +11,7 @@ import appengine_config
 
 from granary import source as gr_source
 from google.appengine.api import mail
+from google.appengine.api import memcache
 import mox
 import requests
 import webapp2
@@ -504,6 +505,28 @@ this is my article
     self.assertEquals('preview', publish.type)
     self.assertEquals(html + self.backlink, publish.html)
 
+  def test_preview_then_publish_reuses_fetch(self):
+    html = """
+    <article class="h-entry">
+      <p class="e-content">foo</p>
+      <a class="u-in-reply-to" href="http://orig.domain/baz"></a>
+    </article>"""
+    self.expect_requests_get('http://foo.com/bar', html,
+                             response_headers={'ETag': '"v1"'})
+    self.expect_requests_get('http://orig.domain/baz', """
+    <link rel="syndication" href="https://fa.ke/a/b">""")
+    # the publish makes a conditional request, and doesn't fetch orig.domain
+    # again
+    super(PublishTest, self).expect_requests_get(
+      'http://foo.com/bar', '', status_code=304,
+      headers={'If-None-Match': '"v1"'})
+    self.mox.ReplayAll()
+
+    self.assert_success('preview of foo', preview=True)
+    self.assert_success('foo - http://foo.com/bar')
+    published = Publish.query(Publish.type != 'preview').get()
+    self.assertEquals(html + self.backlink, published.html)
+
   def test_bridgy_omit_link_query_param(self):
     self.expect_requests_get('http://foo.com/bar', self.post_html % 'foo')
     self.mox.ReplayAll()
@@ -783,6 +806,68 @@ foo<br /> <blockquote>bar</blockquote>
     self.mox.ReplayAll()
     self.assert_success('')
 
+  def test_expand_target_urls_cached(self):
+    """Syndication URLs from an earlier fetch of an original are reused."""
+    memcache.set('S http://orig.domain/baz', ['https://fa.ke/a/b'])
+    self.mox.StubOutWithMock(self.source.gr_source, 'create',
+                             use_mock_anything=True)
+
+    self.expect_requests_get('http://foo.com/bar', """
+    <article class="h-entry">
+      <a class="u-url" href="http://foo.com/bar"></a>
+      <a class="u-in-reply-to" href="http://orig.domain/baz">In reply to</a>
+      <a class="u-in-reply-to" href="http://orig.domain/biff">In reply to</a>
+    </article>
+    """)
+
+    # only the uncached original is fetched
+    self.expect_requests_get('http://orig.domain/biff', """
+    <link rel="syndication" href="https://fa.ke/c/d">""")
+
+    self.source.gr_source.create(mox.Func(lambda obj: obj['inReplyTo'] == [
+      {'url': 'http://orig.domain/baz'},
+      {'url': 'http://orig.domain/biff'},
+      {'url': 'https://fa.ke/a/b'},
+      {'url': 'https://fa.ke/c/d'},
+    ]), include_link=True).AndReturn(gr_source.creation_result({
+      'url': 'http://fake/url',
+      'id': 'http://fake/url',
+      'content': 'This is a reply',
+    }))
+
+    self.mox.ReplayAll()
+    self.assert_success('')
+    self.assertEquals(['https://fa.ke/c/d'],
+                      memcache.get('S http://orig.domain/biff'))
+
+  def test_expand_target_urls_cached_by_resolved_url(self):
+    """The syndication URL cache is keyed by the original's resolved URL."""
+    memcache.set('S http://orig.domain/baz', ['https://fa.ke/a/b'])
+    self.mox.StubOutWithMock(self.source.gr_source, 'create',
+                             use_mock_anything=True)
+
+    self.expect_requests_get('http://foo.com/bar', """
+    <article class="h-entry">
+      <a class="u-url" href="http://foo.com/bar"></a>
+      <a class="u-in-reply-to" href="http://sho.rt/baz">In reply to</a>
+    </article>
+    """)
+    self.expect_requests_head('http://foo.com/bar')
+    self.expect_requests_head('http://sho.rt/baz',
+                              redirected_url='http://orig.domain/baz')
+
+    self.source.gr_source.create(mox.Func(lambda obj: obj['inReplyTo'] == [
+      {'url': 'http://sho.rt/baz'},
+      {'url': 'https://fa.ke/a/b'},
+    ]), include_link=True).AndReturn(gr_source.creation_result({
+      'url': 'http://fake/url',
+      'id': 'http://fake/url',
+      'content': 'This is a reply',
+    }))
+
+    self.mox.ReplayAll()
+    self.assert_success('')
+
   def test_expand_target_urls_blacklisted_target(self):
     """RSVP to a domain in the webmention blacklist should not trigger a fetch.
     """
@@ -919,6 +1004,105 @@ Join us!"""
     self.mox.ReplayAll()
     self.assert_error("Couldn't find link to http://localhost/publish/fake")
 
+  def post_async(self, source='http://foo.com/bar'):
+    resp = publish.application.get_response(
+      '/publish/webmention', method='POST', headers={'Prefer': 'respond-async'},
+      body=urllib.urlencode({'source': source,
+                             'target': 'http://brid.gy/publish/fake'}))
+    return resp
+
+  def run_publish_task(self):
+    tasks = self.taskqueue_stub.GetTasks('publish')
+    self.assertEqual(1, len(tasks))
+    app = webapp2.WSGIApplication([('.*', publish.WebmentionTaskHandler)])
+    return app.get_response('/_ah/queue/publish', method='POST',
+                            body=urllib.urlencode(testutil.get_task_params(tasks[0])))
+
+  def get_status(self, location):
+    resp = publish.application.get_response(location)
+    self.assertEquals(200, resp.status_int)
+    return json.loads(resp.body)
+
+  def test_webmention_async(self):
+    self.expect_requests_get('http://foo.com/bar', self.post_html % 'foo')
+    self.mox.ReplayAll()
+
+    resp = self.post_async()
+    self.assertEquals(202, resp.status_int)
+    location = resp.headers['Location']
+    self.assertEquals(location, json.loads(resp.body)['location'])
+    self.assertEquals({'status': 'new'}, self.get_status(location))
+
+    resp = self.run_publish_task()
+    self.assertEquals(200, resp.status_int)
+    self._check_entity()
+    status = self.get_status(location)
+    self.assertEquals('complete', status['status'])
+    self.assertEquals('foo - http://foo.com/bar', status['content'])
+
+  def test_webmention_async_validation_error(self):
+    resp = self.post_async(source='http://not.registered/post')
+    self.assertEquals(400, resp.status_int)
+    self.assertIn('Could not find <b>FakeSource</b> account',
+                  json.loads(resp.body)['error'])
+    self.assertEquals(0, len(self.taskqueue_stub.GetTasks('publish')))
+
+  def test_webmention_async_task_error(self):
+    # use super to avoid this class's override that adds backlink
+    super(PublishTest, self).expect_requests_get('http://foo.com/bar',
+                                                 self.post_html % 'foo')
+    self.mox.ReplayAll()
+
+    location = self.post_async().headers['Location']
+    # permanent errors aren't retried
+    self.assertEquals(200, self.run_publish_task().status_int)
+    self.assertEquals({
+      'status': 'failed',
+      'error': "Couldn't find link to http://localhost/publish/fake",
+    }, self.get_status(location))
+
+  def test_webmention_async_source_url_redirects(self):
+    self.expect_requests_head('http://will/redirect',
+                              redirected_url='http://foo.com/bar')
+    self.expect_requests_get('http://foo.com/bar', self.post_html % 'foo')
+    self.mox.ReplayAll()
+
+    resp = self.post_async(source='http://will/redirect')
+    self.assertEquals(202, resp.status_int)
+    self.assertEquals(200, self.run_publish_task().status_int)
+
+    # the Publish entity should be keyed by the resolved URL, like sync publishes
+    publishes = Publish.query().fetch()
+    self.assertEquals(1, len(publishes))
+    self.assertEquals('http://foo.com/bar', publishes[0].key.parent().id())
+    self.assertEquals('complete', publishes[0].status)
+
+  def test_webmention_async_home_page(self):
+    resp = self.post_async(source='http://foo.com/')
+    self.assertEquals(400, resp.status_int)
+    self.assertIn('your home page', json.loads(resp.body)['error'])
+    self.assertEquals(0, len(self.taskqueue_stub.GetTasks('publish')))
+
+  def test_webmention_async_server_error_not_retried(self):
+    self.expect_requests_get('http://foo.com/bar', self.post_html % 'foo')
+    self.mox.StubOutWithMock(self.source.gr_source, 'create',
+                             use_mock_anything=True)
+    self.source.gr_source.create(mox.IgnoreArg(), include_link=True
+                                 ).AndRaise(Exception('boom'))
+    self.mox.StubOutWithMock(mail, 'send_mail')
+    mail.send_mail(subject=mox.IgnoreArg(), body=mox.IgnoreArg(),
+                   sender=mox.IgnoreArg(), to=mox.IgnoreArg())
+    self.mox.ReplayAll()
+
+    location = self.post_async().headers['Location']
+    # the create may have succeeded, so don't retry it
+    self.assertEquals(200, self.run_publish_task().status_int)
+    self.assertEquals('failed', self.get_status(location)['status'])
+
+  def test_status_not_found(self):
+    resp = publish.application.get_response('/publish/status/foo')
+    self.assertEquals(404, resp.status_int)
+
   def test_facebook_comment_and_like_disabled(self):
     self.source = facebook.FacebookPage(id='789', features=['publish'],
                                         domains=['mr.x'])
@@ -5,9 +5,10 @@ __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
 import json
 
+from google.appengine.runtime import apiproxy_errors
 import mox
 
-from models import BlogPost
+from models import BlogPost, SuperfeedrNotification
 import superfeedr
 import testutil
 import webapp2
@@ -75,6 +76,47 @@ class SuperfeedrTest(testutil.HandlerTest):
     self.assert_equals(posts[0].key.urlsafe(),
                        testutil.get_task_params(tasks[0])['key'])
 
+  def test_handle_feed_skips_existing_and_duplicate_items(self):
+    existing = BlogPost(id='A', source=self.source.key, sent=['http://x'],
+                        status='complete')
+    existing.put()
+    items = [{'permalinkUrl': 'A', 'content': 'a http://a.com'},
+             {'permalinkUrl': 'B', 'content': 'b http://b.com'},
+             {'permalinkUrl': 'B', 'content': 'c http://c.com'},
+             {'permalinkUrl': 'C', 'content': 'no links'}]
+    superfeedr.handle_feed(json.dumps({'items': items}), self.source)
+
+    self.assertEquals(['http://x'], BlogPost.get_by_id('A').sent)
+    self.assertEquals(['http://b.com'], BlogPost.get_by_id('B').unsent)
+    self.assertEquals('complete', BlogPost.get_by_id('C').status)
+
+    # only B has new links to propagate
+    tasks = self.taskqueue_stub.GetTasks('propagate-blogpost')
+    self.assert_equals([{'key': BlogPost.get_by_id('B').key.urlsafe()}],
+                       [testutil.get_task_params(t) for t in tasks])
+
+  def test_handle_feed_many_items(self):
+    items = [{'permalinkUrl': str(i), 'content': 'http://a.com/%d' % i}
+             for i in range(150)]
+    superfeedr.handle_feed(json.dumps({'items': items}), self.source)
+    self.assert_blogposts(150)
+
+    # every post gets its task, across multiple batched adds
+    tasks = self.taskqueue_stub.GetTasks('propagate-blogpost')
+    self.assertEquals(
+      set(BlogPost.get_by_id(str(i)).key.urlsafe() for i in range(150)),
+      set(testutil.get_task_params(t)['key'] for t in tasks))
+
+  def test_handle_feed_adds_missing_task_for_stored_new_post(self):
+    """An earlier attempt stored the post but failed before adding its task."""
+    BlogPost(id='A', source=self.source.key, unsent=['http://a.com']).put()
+    items = [{'permalinkUrl': 'A', 'content': 'a http://a.com'}]
+    superfeedr.handle_feed(json.dumps({'items': items}), self.source)
+
+    tasks = self.taskqueue_stub.GetTasks('propagate-blogpost')
+    self.assert_equals([{'key': BlogPost.get_by_id('A').key.urlsafe()}],
+                       [testutil.get_task_params(t) for t in tasks])
+
   def test_handle_feed_no_items(self):
     superfeedr.handle_feed('{}', self.source)
     self.assert_blogposts(0)
@@ -117,5 +159,42 @@ class SuperfeedrTest(testutil.HandlerTest):
     self.feed = json.dumps({'items': [{'id': 'X', 'content': 'a http://x/y z'}]})
     resp = app.get_response('/notify/foo.com', method='POST', body=self.feed)
 
+    self.assertEquals(200, resp.status_int)
+    # processing is deferred to a task
+    self.assert_blogposts(0)
+    notification = SuperfeedrNotification.query().get()
+    self.assertEquals(self.source.key, notification.key.parent())
+    self.assertEquals(self.feed, notification.feed)
+
+    tasks = self.taskqueue_stub.GetTasks('superfeedr')
+    self.assertEquals(1, len(tasks))
+    self.assertEquals(notification.key.urlsafe(),
+                      testutil.get_task_params(tasks[0])['key'])
+
+  def test_notify_handler_feed_too_big(self):
+    class Handler(superfeedr.NotifyHandler):
+      SOURCE_CLS = testutil.FakeSource
+
+    self.mox.StubOutWithMock(superfeedr, 'add_handle_feed_task')
+    superfeedr.add_handle_feed_task(mox.IgnoreArg(), mox.IgnoreArg()).AndRaise(
+      apiproxy_errors.RequestTooLargeError('too big'))
+    self.mox.ReplayAll()
+
+    app = webapp2.WSGIApplication([('/notify/(.+)', Handler)], debug=True)
+    self.feed = json.dumps({'items': [{'id': 'X', 'content': 'a http://x/y z'}]})
+    resp = app.get_response('/notify/foo.com', method='POST', body=self.feed)
+
+    # handled inline instead
     self.assertEquals(200, resp.status_int)
     self.assert_blogposts(1)
+
+  def test_notify_handler_source_not_found(self):
+    class Handler(superfeedr.NotifyHandler):
+      SOURCE_CLS = testutil.FakeSource
+
+    app = webapp2.WSGIApplication([('/notify/(.+)', Handler)], debug=True)
+    resp = app.get_response('/notify/bar.com', method='POST', body=self.feed)
+
+    self.assertEquals(200, resp.status_int)
+    self.assertIsNone(SuperfeedrNotification.query().get())
+    self.assertEquals(0, len(self.taskqueue_stub.GetTasks('superfeedr')))
@@ -5,6 +5,7 @@
 __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
 import bz2
+import calendar
 import copy
 import datetime
 import json
@@ -24,6 +25,8 @@ from oauth2client.client import AccessTokenRefreshError
 import requests
 from webmentiontools import send
 
+import appengine_config
+import handlers
 import models
 import tasks
 from tasks import PropagateResponse
@@ -88,7 +91,8 @@ class PollTest(TaskQueueTest):
       resp.activities_json = [json.dumps(json.loads(a), sort_keys=True)
                               for a in resp.activities_json]
       resp.response_json = json.dumps(json.loads(resp.response_json), sort_keys=True)
-    self.assert_entities_equal(self.responses, stored, ignore=('created', 'updated'))
+    self.assert_entities_equal(self.responses, stored,
+                               ignore=('created', 'updated', 'rendered'))
 
   def assert_task_eta(self, countdown):
     """Checks the current poll task's eta. Handles the random range.
@@ -568,14 +572,41 @@ class PollTest(TaskQueueTest):
     source = self.sources[0].key.get()
     self.assertEqual('c', source.last_activity_id)
 
-  def test_cache_trims_to_returned_activity_ids(self):
-    """We should trim last_activities_cache_json to just the returned activity ids."""
+  def test_prerender_responses(self):
+    self.post_task()
+    resp = self.responses[0].key.get()
+    post_id = util.parse_tag_uri(self.activities[0]['id'])[1]
+    pages = resp.rendered[post_id]
+    self.assertEqual(['html', 'json'], sorted(pages.keys()))
+    self.assertIn('http://target1/post/url', pages['html'])
+    self.assertIn('http://target1/post/url', pages['json'])
+
+  def test_prerender_skips_existing_responses(self):
+    for resp in self.responses:
+      resp.rendered = {'x': {'html': 'foo'}}
+      resp.put()
+
+    self.mox.StubOutWithMock(handlers, 'prerender')
+    self.mox.ReplayAll()
+    self.post_task()
+    self.assertEqual({'x': {'html': 'foo'}}, self.responses[0].key.get().rendered)
+
+  def test_prerender_responses_disabled(self):
+    self.mox.stubs.Set(FakeSource, 'PRERENDER_RESPONSES', False)
+    self.post_task()
+    self.assertIsNone(self.responses[0].key.get().rendered)
+
+  def test_activity_cache_migrates_legacy_json(self):
+    """last_activities_cache_json should be moved to ActivityCacheEntry children."""
     self.sources[0].last_activities_cache_json = json.dumps(
-      {1: 2, 'x': 'y', 'prefix x': 1, 'prefix b': 0})
+      {'x': 'y', 'prefix b': 0})
+    self.sources[0].put()
     self.post_task()
 
     source = self.sources[0].key.get()
-    self.assert_equals({'prefix b': 0}, json.loads(source.last_activities_cache_json))
+    self.assertIsNone(source.last_activities_cache_json)
+    self.assert_equals({'x': 'y', 'prefix b': 0},
+                       models.ActivityCache.load(source).get_multi(['x', 'prefix b']))
 
   def test_slow_poll_never_sent_webmention(self):
     self.sources[0].created = NOW - (FakeSource.FAST_POLL_GRACE_PERIOD +
@@ -946,6 +977,137 @@ class PollTest(TaskQueueTest):
     self.assert_equals([reply], json.loads(source.seen_responses_cache_json))
 
 
+class VerifyTest(TaskQueueTest):
+
+  post_url = '/_ah/queue/verify'
+
+  def test_verify(self):
+    self.expect_requests_get('http://primary/', """
+<html><link rel="webmention" href="http://web.ment/ion"></html>""",
+                             verify=False)
+    self.mox.ReplayAll()
+
+    source = self.sources[0]
+    source.features = ['webmention']
+    source.domain_urls = ['http://primary/']
+    source.domains = ['primary']
+    source.put()
+
+    self.post_task(params={'source_key': source.key.urlsafe()})
+    self.assertEquals('http://web.ment/ion', source.key.get().webmention_endpoint)
+
+  def test_source_not_found(self):
+    self.sources[0].key.delete()
+    self.post_task(params={'source_key': self.sources[0].key.urlsafe()})
+
+
+class HandleSuperfeedrNotificationTest(TaskQueueTest):
+
+  post_url = '/_ah/queue/superfeedr'
+
+  def setUp(self):
+    super(HandleSuperfeedrNotificationTest, self).setUp()
+    self.sources[0].features = ['webmention']
+    self.sources[0].put()
+
+  def test_handle(self):
+    item = {'id': 'X', 'content': 'a http://x/y z'}
+    key = models.SuperfeedrNotification(
+      parent=self.sources[0].key, feed=json.dumps({'items': [item]})).put()
+
+    self.post_task(params={'key': key.urlsafe()})
+    self.assertEquals(['http://x/y'], models.BlogPost.get_by_id('X').unsent)
+    self.assertIsNone(key.get())
+
+  def test_source_not_found(self):
+    key = models.SuperfeedrNotification(parent=self.sources[0].key,
+                                        feed='{}').put()
+    self.sources[0].key.delete()
+    self.post_task(params={'key': key.urlsafe()})
+    self.assertIsNone(key.get())
+
+  def test_last_retry_deletes_notification(self):
+    key = models.SuperfeedrNotification(parent=self.sources[0].key,
+                                        feed='not json').put()
+
+    # earlier attempts fail and leave the notification for the retry
+    self.post_task(expected_status=500, params={'key': key.urlsafe()})
+    self.assertIsNotNone(key.get())
+
+    retries = str(tasks.HandleSuperfeedrNotification.TASK_RETRY_LIMIT)
+    self.post_task(params={'key': key.urlsafe()},
+                   headers={'X-AppEngine-TaskRetryCount': retries})
+    self.assertIsNone(key.get())
+
+  def test_notification_not_found(self):
+    key = ndb.Key(models.SuperfeedrNotification, 123,
+                  parent=self.sources[0].key)
+    self.post_task(params={'key': key.urlsafe()})
+
+
+class SeedStatCountersTest(TaskQueueTest):
+
+  post_url = '/_ah/queue/seed-stat-counters'
+
+  def test_seed(self):
+    self.mox.stubs.Set(tasks.SeedStatCounters, 'BATCH_SIZE', 1)
+
+    self.responses[0].unsent = ['http://a', 'http://b']
+    self.responses[1].sent = ['http://c']
+    self.responses[1].unsent = []
+    for resp in self.responses[:2]:
+      resp.put()
+    models.BlogPost(id='http://post', source=self.sources[0].key,
+                    failed=['http://d']).put()
+    page = models.PublishedPage(id='http://page')
+    for type in 'post', 'preview':
+      models.Publish(parent=page.key, source=self.sources[0].key, type=type,
+                     status='complete').put()
+    models.Publish(parent=page.key, source=self.sources[0].key,
+                   status='new').put()
+    models.BlogWebmention(id='http://src http://dst', source=self.sources[0].key,
+                          status='complete').put()
+
+    # these were already counted by the StatCounter writers
+    models.StatCounter.increment('users', 5)
+
+    cutoff = calendar.timegm(
+      (datetime.datetime.utcnow() + datetime.timedelta(minutes=1)).utctimetuple())
+    self.post_task(params={'cutoff': cutoff, 'batch': 0})
+    while True:
+      queued = self.taskqueue_stub.GetTasks('seed-stat-counters')
+      if not queued:
+        break
+      self.taskqueue_stub.FlushQueue('seed-stat-counters')
+      for task in queued:
+        self.post_task(params=testutil.get_task_params(task))
+
+    totals = models.StatCounter.totals()
+    self.assertEqual(7, totals['users'])
+    self.assertEqual(2, totals['responses'])
+    self.assertEqual(1, totals['blogposts'])
+    self.assertEqual(1, totals['links_sent'])
+    self.assertEqual(2, totals['links_unsent'])
+    self.assertEqual(1, totals['links_failed'])
+    self.assertEqual(1, totals['publishes'])
+    self.assertEqual(1, totals['webmentions_received'])
+
+
+class RefreshCachedPageTest(TaskQueueTest):
+
+  post_url = '/_ah/queue/refresh-page'
+
+  def test_refresh(self):
+    self.mox.stubs.Set(appengine_config, 'DEBUG', False)
+    util.CachedPage.store('/', 'old page', expires=datetime.timedelta(days=-1))
+
+    self.post_task(params={'path': '/'})
+    cached = util.CachedPage.load('/')
+    self.assertNotEqual('old page', cached.html)
+    self.assertIn('users', cached.html)
+    self.assertFalse(cached.stale())
+
+
 class PropagateTest(TaskQueueTest):
 
   post_url = '/_ah/queue/propagate'
@@ -1019,6 +1181,15 @@ class PropagateTest(TaskQueueTest):
       self.assert_equals(NOW, self.sources[0].key.get().last_webmention_sent)
       memcache.flush_all()
 
+  def test_propagate_updates_link_counters(self):
+    self.expect_webmention().AndReturn(True)
+    self.mox.ReplayAll()
+    self.post_task()
+
+    totals = models.StatCounter.totals()
+    self.assertEqual(1, totals['links_sent'])
+    self.assertEqual(-1, totals['links_unsent'])
+
   def test_propagate_from_error(self):
     """A normal propagate task, with a response starting as 'error'."""
     self.responses[0].status = 'error'
@@ -7,9 +7,11 @@ __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 import json
 
 import mox
+import requests
 from webob import exc
 
 import appengine_config
+from models import CachedPostId
 from oauth_dropins.tumblr import TumblrAuth
 import tumblr
 from tumblr import Tumblr
@@ -155,6 +157,45 @@ class TumblrTest(testutil.HandlerTest):
                          #"See http://localhost/tumblr/name for details."),
       self.tumblr.create_comment, 'http://primary/post/123999', '', '', '')
 
+  def test_create_comment_caches_missing_disqus_shortname(self):
+    self.tumblr.disqus_shortname = None
+
+    self.expect_requests_get('http://primary/post/123999', 'no shortname here')
+    self.mox.ReplayAll()
+
+    # only the first attempt fetches the post
+    for i in range(2):
+      self.assertRaises(exc.HTTPBadRequest, self.tumblr.create_comment,
+                        'http://primary/post/123999', '', '', '')
+    self.assertIsNotNone(self.tumblr.key.get().disqus_shortname_missing)
+
+  def test_create_comment_caches_thread_id(self):
+    self.expect_thread_details()
+    for i in range(2):
+      self.expect_requests_post(
+        tumblr.DISQUS_API_CREATE_POST_URL, json.dumps({}),
+        params=self.disqus_params({'thread': '87654', 'message': mox.IgnoreArg()}))
+    self.mox.ReplayAll()
+
+    for i in range(2):
+      self.tumblr.create_comment('http://primary/post/123999/xyz_abc',
+                                 'who', 'http://who', 'foo bar')
+    self.assertEquals('87654', CachedPostId.get_by_id(
+      'http://primary/post/123999', parent=self.tumblr.key).post_id)
+
+  def test_create_comment_thread_gone_invalidates_cache(self):
+    CachedPostId(id='http://primary/post/123999', parent=self.tumblr.key,
+                 post_id='87654').put()
+    self.expect_requests_post(
+      tumblr.DISQUS_API_CREATE_POST_URL, json.dumps({}), status_code=400,
+      params=self.disqus_params({'thread': '87654', 'message': mox.IgnoreArg()}))
+    self.mox.ReplayAll()
+
+    self.assertRaises(requests.HTTPError, self.tumblr.create_comment,
+                      'http://primary/post/123999', 'who', 'http://who', 'foo')
+    self.assertIsNone(CachedPostId.get_by_id('http://primary/post/123999',
+                                             parent=self.tumblr.key))
+
   # not implemented yet. see https://github.com/snarfed/bridgy/issues/177.
   # currently handled in webmention.error().
   # def test_create_comment_thread_lookup_fails(self):
@@ -1,12 +1,16 @@
 # coding=utf-8
 """Unit tests for util.py."""
+import datetime
 import json
+import time
 import urllib
 import urlparse
 
 from appengine_config import HTTP_TIMEOUT
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+import requests
 import webapp2
 from webmentiontools import send
 
@@ -82,6 +86,12 @@ class UtilTest(testutil.ModelsTest):
       ({'object': {'to': [{'objectType': 'group', 'alias': '@private'}]}},) * 2,
       ({'id': 1, 'object': {'id': 1}}, {'id': 1}),
       ({'id': 1, 'object': {'id': 2}},) * 2,
+      ({'object': {'upstreamDuplicates': ['http://or.ig'],
+                   'tags': [{'objectType': 'article', 'url': 'http://x',
+                             'displayName': 'X'},
+                            {'objectType': 'person', 'url': 'http://y'}]}},
+       {'object': {'upstreamDuplicates': ['http://or.ig'],
+                   'tags': [{'objectType': 'article', 'url': 'http://x'}]}}),
       ):
       self.assert_equals(expected, util.prune_activity(orig))
 
@@ -130,6 +140,62 @@ class UtilTest(testutil.ModelsTest):
     self.assert_equals(('http://final', 'final', True),
                        util.get_webmention_target('http://foo/bar'))
 
+  def test_cached_page(self):
+    self.assertIsNone(util.CachedPage.load('/foo'))
+    util.CachedPage.store('/foo', 'bar', expires=datetime.timedelta(days=1))
+
+    # served from the in-process and memcache tiers
+    ndb.Key(util.CachedPage, '/foo').delete()
+    cached = util.CachedPage.load('/foo')
+    self.assertEqual('bar', cached.html)
+    self.assertFalse(cached.stale())
+
+    # and from the datastore when those are empty
+    util.CachedPage.store('/foo', 'baz', expires=datetime.timedelta(days=-1))
+    util.page_cache.delete_multi(['/foo'])
+    cached = util.CachedPage.load('/foo')
+    self.assertEqual('baz', cached.html)
+    self.assertTrue(cached.stale())
+
+    util.CachedPage.invalidate('/foo')
+    self.assertIsNone(util.CachedPage.load('/foo'))
+
+  def test_cached_page_refresh_task_lock(self):
+    util.CachedPage.add_refresh_task('/foo')
+    util.CachedPage.add_refresh_task('/foo')
+    tasks = self.taskqueue_stub.GetTasks('refresh-page')
+    self.assertEqual(1, len(tasks))
+    self.assertEqual('/foo', testutil.get_task_params(tasks[0])['path'])
+
+    # storing the page doesn't release the lock
+    util.CachedPage.store('/foo', 'bar')
+    util.CachedPage.add_refresh_task('/foo')
+    self.assertEqual(1, len(self.taskqueue_stub.GetTasks('refresh-page')))
+
+    # the lock expires
+    memcache.delete(util.CachedPage.refresh_lock_key('/foo'))
+    util.CachedPage.add_refresh_task('/foo')
+    self.assertEqual(2, len(self.taskqueue_stub.GetTasks('refresh-page')))
+
+  def test_resolve_webmention_targets(self):
+    def fake_head(url, **kwargs):
+      if url == 'http://slow/':
+        time.sleep(1)
+      resp = requests.Response()
+      resp.url = url.replace('/redirect', '/final')
+      resp.headers['content-type'] = 'text/html'
+      resp.status_code = 200
+      return resp
+    self.mox.stubs.Set(requests, 'head', fake_head)
+
+    self.assert_equals({
+      'http://a/redirect': ('http://a/final', 'a', True),
+      'http://b/': ('http://b/', 'b', True),
+      'http://facebook.com/x': ('http://facebook.com/x', 'facebook.com', False),
+    }, util.resolve_webmention_targets(
+      ['http://a/redirect', 'http://b/', 'http://facebook.com/x', 'http://slow/'],
+      deadline=.2))
+
   def test_registration_callback(self):
     """Run through an authorization back and forth and make sure that
     the external callback makes it all the way through.
@@ -9,6 +9,7 @@ import urllib
 import urllib2
 
 import appengine_config
+from models import CachedPostId
 from oauth_dropins.wordpress_rest import WordPressAuth
 
 import testutil
@@ -124,6 +125,36 @@ class WordPressTest(testutil.HandlerTest):
     # ID field gets converted to lower case id
     self.assertEquals({'id': 789, 'ok': 'sgtm'}, resp)
 
+  def test_create_comment_caches_slug_lookup(self):
+    self.expect_urlopen(
+      'https://public-api.wordpress.com/rest/v1/sites/123/posts/'
+        'slug:the-slug?pretty=true',
+      json.dumps({'ID': 456}))
+    self.expect_new_reply()
+
+    self.wp.create_comment('http://primary/post/the-slug', 'name',
+                           'http://who', 'foo bar')
+    self.assertEquals('456', CachedPostId.get_by_id(
+      'the-slug', parent=self.wp.key).post_id)
+
+  def test_create_comment_uses_cached_slug_lookup(self):
+    CachedPostId(id='the-slug', parent=self.wp.key, post_id='456').put()
+    self.expect_new_reply()
+
+    resp = self.wp.create_comment('http://primary/post/the-slug', 'name',
+                                  'http://who', 'foo bar')
+    self.assertEquals({'id': None}, resp)
+
+  def test_create_comment_unknown_post_invalidates_slug_lookup(self):
+    CachedPostId(id='the-slug', parent=self.wp.key, post_id='456').put()
+    self.expect_new_reply(status=404, response=json.dumps({
+      'error': 'unknown_post', 'message': 'Unknown post'}))
+
+    self.assertRaises(urllib2.HTTPError, self.wp.create_comment,
+                      'http://primary/post/the-slug', 'name', 'http://who',
+                      'foo bar')
+    self.assertIsNone(CachedPostId.get_by_id('the-slug', parent=self.wp.key))
+
   def test_create_comment_with_unicode_chars(self):
     self.expect_new_reply(content='<a href="http://who">Degenève</a>: foo Degenève bar')
 
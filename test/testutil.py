@@ -14,6 +14,7 @@ from granary import source as gr_source
 from granary import testutil as gr_testutil
 from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import ndb
+import models
 from models import Response, Source
 from oauth_dropins.models import BaseAuth
 # mirror some methods from webutil.testutil
@@ -201,6 +202,11 @@ class HandlerTest(gr_testutil.TestCase):
     # add FakeSource everywhere necessary
     util.BLACKLIST.add('fa.ke')
 
+    # the in-process tier outlives the memcache stub, so clear it
+    util.item_page_cache.local.clear()
+    util.page_cache.local.clear()
+    models.domain_sources_cache.local.clear()
+
     self.stub_requests_head()
 
   def stub_requests_head(self):
@@ -328,6 +334,7 @@ class ModelsTest(HandlerTest):
           type='comment',
           source=self.sources[0].key,
           unsent=['http://target1/post/url'],
+          activity_urls=['https://source/post/url'],
           created=created))
 
       created += datetime.timedelta(hours=1)
@@ -340,6 +347,7 @@ class ModelsTest(HandlerTest):
           type='like',
           source=self.sources[0].key,
           unsent=['http://target1/post/url'],
+          activity_urls=['https://source/post/url'],
           created=created))
 
       created += datetime.timedelta(hours=1)
@@ -352,6 +360,7 @@ class ModelsTest(HandlerTest):
           type='repost',
           source=self.sources[0].key,
           unsent=['http://target1/post/url'],
+          activity_urls=['https://source/post/url'],
           created=created))
 
       created += datetime.timedelta(hours=1)
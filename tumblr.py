@@ -28,6 +28,7 @@ curl localhost:8080/webmention/tumblr \
 __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
 import collections
+import datetime
 import json
 import logging
 import re
@@ -50,6 +51,9 @@ import webapp2
 TUMBLR_AVATAR_URL = 'http://api.tumblr.com/v2/blog/%s/avatar/512'
 DISQUS_API_CREATE_POST_URL = 'https://disqus.com/api/3.0/posts/create.json'
 DISQUS_API_THREAD_DETAILS_URL = 'http://disqus.com/api/3.0/threads/details.json'
+# how long create_comment() waits before looking for a blog's Disqus shortname
+# again after it didn't find one
+DISQUS_SHORTNAME_RECHECK = datetime.timedelta(hours=1)
 
 # Tumblr has no single standard markup or JS for integrating Disqus. It does
 # have a default way, but themes often do it themselves, differently. Sigh.
@@ -72,6 +76,8 @@ class Tumblr(models.Source):
   SHORT_NAME = 'tumblr'
 
   disqus_shortname = ndb.StringProperty()
+  # when create_comment() last looked for disqus_shortname and didn't find it
+  disqus_shortname_missing = ndb.DateTimeProperty()
 
   def feed_url(self):
     # http://www.tumblr.com/help  (search for feed)
@@ -150,6 +156,7 @@ class Tumblr(models.Source):
       match = regex.search(html)
       if match:
         self.disqus_shortname = match.group(1)
+        self.disqus_shortname_missing = None
         logging.info("Found Disqus shortname %s", self.disqus_shortname)
         self.put()
 
@@ -167,9 +174,15 @@ class Tumblr(models.Source):
     Returns: JSON response dict with 'id' and other fields
     """
     if not self.disqus_shortname:
-      resp = util.requests_get(post_url)
-      resp.raise_for_status()
-      self.discover_disqus_shortname(resp.text)
+      now = datetime.datetime.now()
+      if not (self.disqus_shortname_missing and
+              now - self.disqus_shortname_missing < DISQUS_SHORTNAME_RECHECK):
+        resp = util.requests_get(post_url)
+        resp.raise_for_status()
+        self.discover_disqus_shortname(resp.text)
+        if not self.disqus_shortname:
+          self.disqus_shortname_missing = now
+          self.put()
       if not self.disqus_shortname:
         raise exc.HTTPBadRequest("Your Bridgy account isn't fully set up yet: "
                                  "we haven't found your Disqus account.")
@@ -186,21 +199,28 @@ class Tumblr(models.Source):
     # get the disqus thread id. details on thread queries:
     # http://stackoverflow.com/questions/4549282/disqus-api-adding-comment
     # https://disqus.com/api/docs/threads/details/
-    resp = self.disqus_call(requests.get, DISQUS_API_THREAD_DETAILS_URL,
-                            {'forum': self.disqus_shortname,
-                             # ident:[tumblr_post_id] should work, but doesn't :/
-                             'thread': 'link:%s' % post_url,
-                             })
-    thread_id = resp['id']
+    thread_id = models.CachedPostId.get_or_fetch(
+      self, post_url, lambda: self.disqus_call(
+        requests.get, DISQUS_API_THREAD_DETAILS_URL,
+        {'forum': self.disqus_shortname,
+         # ident:[tumblr_post_id] should work, but doesn't :/
+         'thread': 'link:%s' % post_url,
+         })['id'])
 
     # create the comment
     message = u'<a href="%s">%s</a>: %s' % (author_url, author_name, content)
-    resp = self.disqus_call(requests.post, DISQUS_API_CREATE_POST_URL,
-                            {'thread': thread_id,
-                             'message': message.encode('utf-8'),
-                             # only allowed when authed as moderator/owner
-                             # 'state': 'approved',
-                             })
+    try:
+      resp = self.disqus_call(requests.post, DISQUS_API_CREATE_POST_URL,
+                              {'thread': thread_id,
+                               'message': message.encode('utf-8'),
+                               # only allowed when authed as moderator/owner
+                               # 'state': 'approved',
+                               })
+    except requests.HTTPError as e:
+      if e.response is not None and e.response.status_code == 400:
+        # maybe the thread is gone. look it up again next time.
+        models.CachedPostId.invalidate(self, post_url)
+      raise
     return resp
 
   @staticmethod
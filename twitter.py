@@ -29,6 +29,13 @@ class Twitter(models.Source):
                  'repost': 'retweet',
                  'like': 'favorite',
                  }
+  # We get Twitter favorites by scraping HTML, and we only get the first page,
+  # which only has 25, so it's especially important to find them in the
+  # datastore. Retweets are looked up by the retweet's own id.
+  RESPONSE_ID_FORMATS = {
+    'like': '%(post)s_favorited_by_%(user)s',
+    'repost': '%(user)s',
+  }
 
   # Twitter's rate limiting window is currently 15m. A normal poll with nothing
   # new hits /statuses/user_timeline and /search/tweets once each. Both
@@ -59,26 +66,6 @@ class Twitter(models.Source):
     """Returns the Twitter account URL, e.g. https://twitter.com/foo."""
     return self.gr_source.user_url(self.key.id())
 
-  def get_like(self, activity_user_id, activity_id, like_user_id):
-    """Returns an ActivityStreams 'like' activity object for a favorite.
-
-    We get Twitter favorites by scraping HTML, and we only get the first page,
-    which only has 25. So, use a Response in the datastore first, if we have
-    one, and only re-scrape HTML as a fallback.
-
-    Args:
-      activity_user_id: string id of the user who posted the original activity
-      activity_id: string activity id
-      like_user_id: string id of the user who liked the activity
-    """
-    id = self.gr_source.tag_uri('%s_favorited_by_%s' % (activity_id, like_user_id))
-    resp = models.Response.get_by_id(id)
-    if resp:
-      return json.loads(resp.response_json)
-    else:
-      return super(Twitter, self).get_like(activity_user_id, activity_id,
-                                           like_user_id)
-
 
 class AddTwitter(oauth_twitter.CallbackHandler, util.Handler):
   def finish(self, auth_entity, state=None):
@@ -7,6 +7,8 @@ import datetime
 import json
 import mimetypes
 import re
+import threading
+import time
 import urllib
 import urlparse
 
@@ -29,6 +31,8 @@ LOCALHOST_TEST_DOMAINS = frozenset(('kylewm.com', 'snarfed.org'))
 EPOCH = datetime.datetime.utcfromtimestamp(0)
 POLL_TASK_DATETIME_FORMAT = '%Y-%m-%d-%H-%M-%S'
 FAILED_RESOLVE_URL_CACHE_TIME = 60 * 60 * 24  # a day
+RESOLVE_DEADLINE = 5  # seconds, for resolve_webmention_targets()
+VERIFY_INTERVAL = 60 * 15  # seconds, for add_verify_task()
 
 # rate limiting errors. twitter returns 429, instagram 503, google+ 403.
 # TODO: facebook. it returns 200 and reports the error in the response.
@@ -92,6 +96,54 @@ def add_propagate_blogpost_task(entity, **kwargs):
   logging.info('Added propagate-blogpost task: %s', task.name)
 
 
+def add_propagate_blogpost_tasks(entities):
+  """Adds propagate-blogpost tasks for many entities, in batches.
+
+  Args:
+    entities: sequence of BlogPost
+  """
+  tasks = [taskqueue.Task(params={'key': entity.key.urlsafe()},
+                          target=taskqueue.DEFAULT_APP_VERSION)
+           for entity in entities]
+  queue = taskqueue.Queue('propagate-blogpost')
+  for i in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+    queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+  logging.info('Added %d propagate-blogpost tasks', len(tasks))
+
+
+def add_verify_task(source):
+  """Adds a verify task for the given source entity, at most once per interval.
+
+  Uses a memcache entry that expires after VERIFY_INTERVAL as the gate, so
+  repeated page views don't pile up tasks.
+  """
+  if not memcache.add('V ' + source.key.urlsafe(), True, time=VERIFY_INTERVAL):
+    logging.debug('Verify task for %s added recently, skipping', source.label())
+    return
+
+  task = taskqueue.add(queue_name='verify',
+                       params={'source_key': source.key.urlsafe()},
+                       target=taskqueue.DEFAULT_APP_VERSION)
+  logging.info('Added verify task: %s', task.name)
+
+
+def add_seed_stat_counters_task(params):
+  """Adds a seed-stat-counters task for one batch of tasks.SeedStatCounters.
+
+  The task is named by its cutoff and batch number, so a retried task doesn't
+  fork the chain.
+
+  Args:
+    params: dict of task parameters. must include cutoff and batch.
+  """
+  name = 'seed-stat-counters-%s-%s' % (params['cutoff'], params['batch'])
+  try:
+    taskqueue.add(queue_name='seed-stat-counters', name=name, params=params)
+    logging.info('Added seed-stat-counters task: %s', name)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    logging.info('seed-stat-counters task %s already added', name)
+
+
 def email_me(**kwargs):
   """Thin wrapper around mail.send_mail() that handles errors."""
   try:
@@ -207,6 +259,73 @@ def get_webmention_target(url, cache=True):
   return (clean_webmention_url(url), domain, is_html)
 
 
+def resolve_webmention_targets(urls, deadline=RESOLVE_DEADLINE, cache=True):
+  """Runs get_webmention_target() on multiple URLs concurrently.
+
+  URLs whose redirects are already in memcache are resolved inline. The rest
+  are each resolved in their own thread. Waits up to deadline seconds total.
+
+  Args:
+    urls: sequence of string URLs
+    deadline: float, seconds to wait
+    cache: whether to use memcache when following redirects
+
+  Returns: dict mapping string URL to get_webmention_target() tuple. URLs that
+    didn't resolve before the deadline are omitted.
+  """
+  urls = list(set(urls))
+  results = {}
+  if cache:
+    cached = memcache.get_multi(urls, key_prefix='R ')
+    for url in cached:
+      results[url] = get_webmention_target(url)
+
+  results.update(run_concurrently(
+    lambda url: get_webmention_target(url, cache=cache),
+    [url for url in urls if url not in results], deadline))
+
+  missing = set(urls) - set(results)
+  if missing:
+    logging.warning("Couldn't resolve %s within %ss", ' '.join(missing), deadline)
+  return results
+
+
+def run_concurrently(fn, args, deadline):
+  """Calls fn(arg) for each arg, each in its own thread.
+
+  Waits up to deadline seconds total. If there's only one arg, just calls fn
+  inline.
+
+  Args:
+    fn: callable that takes one argument
+    args: sequence of hashable arguments
+    deadline: float, seconds to wait
+
+  Returns: dict mapping arg to fn(arg), for the calls that finished before the
+    deadline.
+  """
+  args = list(args)
+  results = {}
+
+  def run(arg):
+    results[arg] = fn(arg)
+
+  if len(args) == 1:
+    run(args[0])
+    return results
+
+  threads = [threading.Thread(target=run, args=(arg,)) for arg in args]
+  for thread in threads:
+    thread.start()
+
+  end = time.time() + deadline
+  for thread in threads:
+    thread.join(max(end - time.time(), 0))
+
+  # copy, since threads that missed the deadline may still write to results
+  return dict(results)
+
+
 def in_webmention_blacklist(domain):
   """Returns True if the domain or its root domain is in BLACKLIST."""
   return (domain in BLACKLIST or
@@ -238,6 +357,10 @@ def clean_webmention_url(url):
 def prune_activity(activity):
   """Returns an activity dict with just id, url, content, to, and object.
 
+  Also keeps upstreamDuplicates and the url and objectType of 'article' tags,
+  ie the original post URLs that original post discovery found, so that
+  handlers.py can serve the post with the same links we sent webmentions for.
+
   If the object field exists, it's pruned down to the same fields. Any fields
   duplicated in both the activity and the object are removed from the object.
 
@@ -251,10 +374,13 @@ def prune_activity(activity):
 
   Returns: pruned activity dict
   """
-  keep = ['id', 'url', 'content']
+  keep = ['id', 'url', 'content', 'upstreamDuplicates']
   if not source.Source.is_public(activity):
     keep += ['to']
   pruned = {f: activity.get(f) for f in keep}
+  pruned['tags'] = [{'objectType': 'article', 'url': t['url']}
+                    for t in activity.get('tags', [])
+                    if t.get('objectType') == 'article' and t.get('url')]
 
   obj = activity.get('object')
   if obj:
@@ -345,7 +471,6 @@ class Handler(webapp2.RequestHandler):
           self.redirect('/')
         return
 
-      CachedPage.invalidate('/users')
       logging.info('%s.create_new with %s', source_cls.__class__.__name__,
                    (auth_entity.key, state, kwargs))
       source = source_cls.create_new(self, auth_entity=auth_entity,
@@ -476,25 +601,44 @@ class CachedPage(StringIdModel):
 
   Stored in the datastore since datastore entities in memcache (mostly
   Responses) are requested way more often, so it would get evicted
-  out of memcache easily.
+  out of memcache easily. page_cache, an in-process and memcache TieredCache,
+  sits in front of the datastore.
+
+  Expired pages are still served. load() callers should check stale() and
+  call add_refresh_task() to re-render them in the background.
 
   Keys, useful for deleting from memcache:
   /: aglzfmJyaWQtZ3lyEQsSCkNhY2hlZFBhZ2UiAS8M
   /users: aglzfmJyaWQtZ3lyFgsSCkNhY2hlZFBhZ2UiBi91c2Vycww
   """
+  # how long a refresh task holds the lock for its page. at least page_cache's
+  # local_ttl, since other instances may serve the stale page until then.
+  REFRESH_LOCK_TIME = 60  # seconds
+
+  # page_cache handles caching
+  _use_cache = False
+  _use_memcache = False
+
   html = ndb.TextProperty()
   expires = ndb.DateTimeProperty()
 
+  def stale(self):
+    return bool(self.expires and datetime.datetime.now() > self.expires)
+
   @classmethod
   def load(cls, path):
-    cached = CachedPage.get_by_id(path)
+    """Returns the CachedPage for path, possibly stale, or None."""
+    val = page_cache.get(path)
+    if val is not None:
+      cached = CachedPage(id=path, html=val[0], expires=val[1])
+    else:
+      cached = CachedPage.get_by_id(path)
+      if cached:
+        page_cache.set(path, (cached.html, cached.expires))
+
     if cached:
-      if cached.expires and datetime.datetime.now() > cached.expires:
-        logging.info('Deleting expired cached page for %s', path)
-        cached.key.delete()
-        return None
-      else:
-        logging.info('Found cached page for %s', path)
+      logging.info('Found %scached page for %s',
+                   'stale ' if cached.stale() else '', path)
     return cached
 
   @classmethod
@@ -505,8 +649,123 @@ class CachedPage(StringIdModel):
       logging.info('  (expires in %s)', expires)
       expires = datetime.datetime.now() + expires
     CachedPage(id=path, html=html, expires=expires).put()
+    page_cache.set(path, (html, expires))
+
+  @classmethod
+  def refresh_lock_key(cls, path):
+    return 'CachedPage refresh ' + path
+
+  @classmethod
+  def add_refresh_task(cls, path):
+    """Adds a task to re-render a stale page, unless one is already running.
+
+    The lock is a memcache entry that expires after REFRESH_LOCK_TIME. store()
+    doesn't release it, since other instances may still have the stale page in
+    their local page_cache and would otherwise add more refresh tasks.
+    """
+    if not memcache.add(cls.refresh_lock_key(path), True,
+                        time=cls.REFRESH_LOCK_TIME):
+      logging.debug('Refresh task for %s already in progress', path)
+      return
+
+    task = taskqueue.add(queue_name='refresh-page', params={'path': path},
+                         target=taskqueue.DEFAULT_APP_VERSION)
+    logging.info('Added refresh-page task for %s: %s', path, task.name)
 
   @classmethod
   def invalidate(cls, path):
     logging.info('Deleting cached page for %s', path)
+    page_cache.delete_multi([path])
     CachedPage(id=path).key.delete()
+
+  @classmethod
+  def invalidate_prefix(cls, prefix):
+    """Deletes all cached pages whose path starts with prefix."""
+    keys = CachedPage.query(
+      CachedPage.key >= ndb.Key(CachedPage, prefix),
+      CachedPage.key < ndb.Key(CachedPage, prefix + u'\ufffd'),
+      ).fetch(keys_only=True)
+    logging.info('Deleting %d cached pages for %s*', len(keys), prefix)
+    page_cache.delete_multi([key.string_id() for key in keys])
+    ndb.delete_multi(keys)
+
+
+class TieredCache(object):
+  """A two-tier cache: a small in-process LRU in front of memcache.
+
+  The in-process tier is per instance, so entries expire from it after
+  local_ttl seconds. Deletes only clear it on the current instance, so other
+  instances may serve a deleted value for up to local_ttl seconds. It's shared
+  across request threads, so it's guarded by a lock.
+
+  Keys are strings, prefixed with the cache's prefix in memcache.
+  """
+
+  def __init__(self, prefix, max_local=200, local_ttl=60, memcache_ttl=0):
+    """Constructor.
+
+    Args:
+      prefix: string, prepended to memcache keys
+      max_local: integer, maximum number of entries in the in-process tier
+      local_ttl: integer, seconds to keep entries in the in-process tier
+      memcache_ttl: integer, seconds to keep entries in memcache. 0 means
+        until evicted.
+    """
+    self.prefix = prefix
+    self.max_local = max_local
+    self.local_ttl = local_ttl
+    self.memcache_ttl = memcache_ttl
+    self.local = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def memcache_key(self, key):
+    return '%s %s' % (self.prefix, key)
+
+  def get(self, key):
+    """Returns the cached value for key, or None."""
+    with self.lock:
+      entry = self.local.pop(key, None)
+      if entry and entry[0] > time.time():
+        self.local[key] = entry  # move to the end, ie most recently used
+        return entry[1]
+
+    val = memcache.get(self.memcache_key(key))
+    if val is not None:
+      self.set_local(key, val)
+    return val
+
+  def set(self, key, val, memcache_ttl=None):
+    """Caches val for key.
+
+    Args:
+      key: string
+      val: any picklable value
+      memcache_ttl: integer, seconds to keep val in memcache. Defaults to the
+        cache's memcache_ttl.
+    """
+    if memcache_ttl is None:
+      memcache_ttl = self.memcache_ttl
+    memcache.set(self.memcache_key(key), val, time=memcache_ttl)
+    self.set_local(key, val)
+
+  def set_local(self, key, val):
+    with self.lock:
+      self.local.pop(key, None)
+      self.local[key] = (time.time() + self.local_ttl, val)
+      while len(self.local) > self.max_local:
+        self.local.popitem(last=False)
+
+  def delete_multi(self, keys):
+    with self.lock:
+      for key in keys:
+        self.local.pop(key, None)
+    memcache.delete_multi([self.memcache_key(key) for key in keys])
+
+
+# rendered pages from handlers.py, e.g. /comment/twitter/snarfed_org/123/456.
+# key is path, value is dict mapping format and scheme (e.g. 'html https') to
+# (content type, body) tuple.
+item_page_cache = TieredCache('item', memcache_ttl=60 * 60 * 24)
+
+# CachedPage contents. key is path, value is (html, expires datetime) tuple.
+page_cache = TieredCache('page', max_local=50)
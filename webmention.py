@@ -7,6 +7,7 @@ Webmention spec: http://webmention.org/
 
 __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
+import hashlib
 import logging
 import json
 import pprint
@@ -19,6 +20,8 @@ from mf2py import parser
 import requests
 import util
 
+from google.appengine.api import memcache
+
 
 class WebmentionGetHandler(util.Handler):
   """Renders a simple placeholder HTTP page for GETs to webmention endpoints.
@@ -44,11 +47,18 @@ class WebmentionHandler(WebmentionGetHandler):
   Attributes:
     source: the Source for this webmention
     entity: the Publish or Webmention entity for this webmention
+    fetch_cache: dict fetch cache entry for the source URL, if fetch_mf2() was
+      called with cache=True. Includes the HTML and parsed mf2 data.
   """
   source = None
   entity = None
+  fetch_cache = None
+
+  # how long to keep fetched and parsed source pages, e.g. between a preview
+  # and the publish that follows it.
+  FETCH_CACHE_TIME = 60 * 10  # seconds
 
-  def fetch_mf2(self, url):
+  def fetch_mf2(self, url, cache=False):
     """Fetches a URL and extracts its mf2 data.
 
     Side effects: sets self.entity.html on success, calls self.error() on
@@ -56,19 +66,82 @@ class WebmentionHandler(WebmentionGetHandler):
 
     Args:
       url: string
+      cache: boolean, whether to use the fetch cache. If the page was fetched
+        recently, makes a conditional request, and reuses the parsed mf2 if
+        the server says it's unchanged or its content hash matches.
 
     Returns:
       (requests.Response, mf2 data dict) on success, None on failure
     """
+    cache_key = 'F ' + url
+    cached = memcache.get(cache_key) if cache else None
+    headers = {}
+    if cached:
+      if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+      if cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+
     try:
-      fetched = util.requests_get(url)
+      fetched = util.requests_get(url, headers=headers)
       fetched.raise_for_status()
     except BaseException:
       return self.error('Could not fetch source URL %s' % url)
 
+    hash = (hashlib.sha1(fetched.content).hexdigest()
+            if fetched.status_code != 304 else None)
+    if cached and (fetched.status_code == 304 or hash == cached['hash']):
+      logging.info('Source page %s is unchanged, using cached mf2', url)
+      html, data = cached['html'], cached['data']
+    else:
+      html = fetched.text
+      data = self._parse_mf2(fetched)
+      if cache:
+        cached = {
+          'etag': fetched.headers.get('ETag'),
+          'last_modified': fetched.headers.get('Last-Modified'),
+          'hash': hash,
+          'html': html,
+          'data': data,
+        }
+
     if self.entity:
-      self.entity.html = fetched.text
+      self.entity.html = html
+
+    if cache:
+      self.fetch_cache = cached
+      self.fetch_cache_key = cache_key
+      self._store_fetch_cache()
+
+    items = data.get('items', [])
+    if not items or not items[0]:
+      return self.error('No microformats2 data found in ' + fetched.url,
+                        data=data, html="""
+No <a href="http://microformats.org/get-started">microformats</a> or
+<a href="http://microformats.org/wiki/microformats2">microformats2</a> found in
+<a href="%s">%s</a>! See <a href="http://indiewebify.me/">indiewebify.me</a>
+for details (skip to level 2, <em>Publishing on the IndieWeb</em>).
+""" % (fetched.url, util.pretty_link(fetched.url)))
+
+    return fetched, data
 
+  def _store_fetch_cache(self):
+    """Writes self.fetch_cache to memcache."""
+    try:
+      memcache.set(self.fetch_cache_key, self.fetch_cache,
+                   time=self.FETCH_CACHE_TIME)
+    except ValueError:
+      logging.info("Couldn't cache %s, probably too big", self.fetch_cache_key,
+                   exc_info=True)
+
+  def _parse_mf2(self, fetched):
+    """Parses a fetched page's microformats.
+
+    Args:
+      fetched: requests.Response
+
+    Returns: mf2 data dict
+    """
     # .text is decoded unicode string, .content is raw bytes. if the HTTP
     # headers didn't specify a charset, pass raw bytes to BeautifulSoup so it
     # can look for a <meta> tag with a charset and decode.
@@ -96,17 +169,7 @@ class WebmentionHandler(WebmentionGetHandler):
     # parse microformats, convert to ActivityStreams
     data = parser.Parser(doc=doc, url=fetched.url).to_dict()
     logging.debug('Parsed microformats2: %s', json.dumps(data, indent=2))
-    items = data.get('items', [])
-    if not items or not items[0]:
-      return self.error('No microformats2 data found in ' + fetched.url,
-                        data=data, html="""
-No <a href="http://microformats.org/get-started">microformats</a> or
-<a href="http://microformats.org/wiki/microformats2">microformats2</a> found in
-<a href="%s">%s</a>! See <a href="http://indiewebify.me/">indiewebify.me</a>
-for details (skip to level 2, <em>Publishing on the IndieWeb</em>).
-""" % (fetched.url, util.pretty_link(fetched.url)))
-
-    return fetched, data
+    return data
 
   def error(self, error, html=None, status=400, data=None, log_exception=True,
             mail=False):
@@ -111,7 +111,8 @@ class WordPress(models.Source):
     If the last part of the post URL is numeric, e.g. http://site/post/123999,
     it's used as the post id. Otherwise, we extract the last part of
     the path as the slug, e.g. http: / / site / post / the-slug,
-    and look up the post id via the API.
+    and look up the post id via the API. Slug lookups are cached in
+    CachedPostId until the post turns out to be gone.
 
     Args:
       post_url: string
@@ -129,14 +130,19 @@ class WordPress(models.Source):
     if path.endswith('/'):
       path = path[:-1]
     slug = path.split('/')[-1]
+    cached_slug = None
     try:
       post_id = int(slug)
     except ValueError:
-      logging.info('Looking up post id for slug %s', slug)
-      url = API_POST_SLUG_URL % (auth_entity.blog_id, slug)
-      post_id = self.urlopen(auth_entity, url).get('ID')
+      def lookup():
+        logging.info('Looking up post id for slug %s', slug)
+        url = API_POST_SLUG_URL % (auth_entity.blog_id, slug)
+        return self.urlopen(auth_entity, url).get('ID')
+      post_id = models.CachedPostId.get_or_fetch(self, slug, lookup)
       if not post_id:
         return self.error('Could not find post id')
+      post_id = int(post_id)
+      cached_slug = slug
 
     logging.info('Post id is %d', post_id)
 
@@ -148,6 +154,10 @@ class WordPress(models.Source):
       resp = self.urlopen(auth_entity, url, data=urllib.urlencode(data))
     except urllib2.HTTPError, e:
       code, body = util.interpret_http_exception(e)
+      if code == '404' and cached_slug:
+        # the post may have been deleted or its slug reused. look it up again
+        # next time.
+        models.CachedPostId.invalidate(self, cached_slug)
       try:
         parsed = json.loads(body) if body else {}
         if ((code == '400' and parsed.get('error') == 'invalid_input') or